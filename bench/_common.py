@@ -0,0 +1,67 @@
+"""
+Общая обвязка бенчмарков.
+
+Каждый скрипт из bench/ принимает `--repo PATH` — путь к проверяемой копии
+репозитория (по умолчанию текущая). Так один и тот же сценарий запускается
+на двух ревизиях и ускорение воспроизводится напрямую:
+
+    git worktree add /tmp/pb-base <commit>
+    python bench/bench_resolver.py --repo /tmp/pb-base
+    python bench/bench_resolver.py
+
+Генератор данных (tests/synth.py) всегда берётся из текущей копии, чтобы обе
+ревизии измерялись на одинаковых данных.
+"""
+import argparse
+import importlib.util
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def setup(description: str) -> Tuple[argparse.ArgumentParser, Callable[[], argparse.Namespace]]:
+    """
+    Создаёт парсер аргументов с общим флагом --repo.
+
+    Returns:
+        tuple: (parser, parse) — parse() разбирает аргументы и подключает
+        выбранную копию репозитория к sys.path.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--repo', default=str(ROOT), help='Путь к проверяемой копии репозитория')
+
+    def parse() -> argparse.Namespace:
+        args = parser.parse_args()
+        sys.path.insert(0, str(Path(args.repo).resolve()))
+        # Логи модулей не должны искажать замеры
+        logging.disable(logging.CRITICAL)
+        return args
+
+    return parser, parse
+
+
+def load_tests_module(name: str):
+    """Загружает tests/<name>.py текущей копии по пути, не затрагивая пакеты --repo."""
+    spec = importlib.util.spec_from_file_location(f'pb_{name}', ROOT / 'tests' / f'{name}.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_synth():
+    """Генератор синтетических данных tests/synth.py."""
+    return load_tests_module('synth')
+
+
+def best_of(func: Callable[[], object], repeat: int = 3) -> Tuple[float, object]:
+    """Лучшее время из repeat запусков и результат последнего запуска."""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
@@ -0,0 +1,52 @@
+"""
+Бенчмарк форматов контекста (OutputGenerator.OUTPUT_FORMATS): размер одного и того же
+контекста в символах и в токенах TokenCounter.
+
+Синтетический namespace по форме как реальный (формулы, JSON config, null-колонки);
+выборки — один датасет, несколько датасетов с сущностями и все датасеты. Считается
+через ContextService.format_token_report — маскированный и оригинальный вариант.
+Без deepseek_tokenizer/tokenizer.json TokenCounter считает упрощенно (по словам),
+это печатается в первой строке: выигрыш минифицированных форматов тогда завышен.
+
+    python bench/bench_formats.py --scale 1
+"""
+from _common import load_synth, setup
+
+
+def main() -> None:
+    parser, parse = setup(__doc__)
+    parser.add_argument('--scale', type=float, default=1.0, help='Множитель размера namespace')
+    args = parse()
+
+    from core.context_engine import DbDataLoader, OutputGenerator
+    from services.context_service import ContextService
+    from utils.tokenizer import TokenCounter
+
+    def scaled(n: int) -> int:
+        return max(1, int(n * args.scale))
+
+    n_datasets, n_entities = scaled(20), scaled(60)
+    raw = load_synth().make_namespace(n_entities=n_entities, props_per_entity=20, n_vertices=scaled(300),
+                                      n_edges=scaled(100), n_datasets=n_datasets, n_constraints=scaled(100), seed=11)
+    loader = DbDataLoader(raw)
+    selections = {
+        'one dataset': (['ds0'], []),
+        'datasets+entities': ([f'ds{i}' for i in range(0, n_datasets, 4)], [f'entity{i}' for i in range(0, n_entities, 10)]),
+        'all datasets': ([f'ds{i}' for i in range(n_datasets)], []),
+    }
+
+    exact = TokenCounter.get_tokenizer() is not None
+    print(f'repo: {args.repo}')
+    print(f"tokens: {'tokenizer.json' if exact else 'fallback (words), tokenizer.json not found'}")
+    header = f"{'selection':18s} {'variant':8s}" + ''.join(f' {fmt:>23s}' for fmt in OutputGenerator.OUTPUT_FORMATS)
+    print(header)
+    print(f"{'':27s}" + f"{'chars / tokens (ratio)':>24s}" * len(OutputGenerator.OUTPUT_FORMATS))
+    for name, (datasets, entities) in selections.items():
+        for masked in (True, False):
+            report = ContextService.format_token_report(loader, datasets, entities, masked=masked)
+            cells = ''.join(f" {row['chars']:>8d} /{row['tokens']:>6d} ({row['ratio']:.2f})" for row in report)
+            print(f"{name:18s} {'masked' if masked else 'original':8s}{cells}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Бенчмарк маскирования формул с большим словарем (поиск литералов в mask_formula).
+
+Формулы entity_properties и vertex_functions синтетического namespace маскируются
+маскером, в котором уже зарегистрированы сущности, свойства и --values строковых
+значений (как после генерации контекста большого namespace). Каждый повтор — новый
+маскер, поэтому кэш формул не влияет на замер. Отпечаток результата (md5) должен
+совпадать между ревизиями (--repo).
+
+    python bench/bench_formula_literals.py --values 3000
+"""
+import hashlib
+import time
+
+from _common import load_synth, setup
+
+
+def main() -> None:
+    parser, parse = setup(__doc__)
+    parser.add_argument('--values', type=int, default=3000, help='Сколько строковых значений в словаре')
+    parser.add_argument('--repeat', type=int, default=3, help='Повторов (берется лучший)')
+    args = parse()
+
+    from core.context_engine import DbDataLoader
+    from core.masking import ContextMasker
+
+    raw = load_synth().make_namespace(n_entities=150, props_per_entity=40, n_vertices=1500, n_edges=100,
+                                      n_datasets=20, n_constraints=300, seed=5)
+    loader = DbDataLoader(raw)
+    formulas = []
+    for table in ('entity_properties', 'vertex_functions'):
+        for row in loader.db[table].values():
+            formulas += [row[col] for col in ('calculation_func', 'aggregation_func') if row.get(col)]
+
+    best, digest, masks = float('inf'), None, 0
+    for _ in range(args.repeat):
+        masker = ContextMasker()
+        for row in loader.db['entity_properties'].values():
+            masker.register(row['entity_type'], 'ENT')
+            masker.register(row['property_id'], 'P')
+        for i in range(args.values):
+            masker.register(f'value_{i}', 'VAL')
+        masks = len(masker.map_forward)
+        md5 = hashlib.md5()
+        started = time.perf_counter()
+        for formula in formulas:
+            md5.update(masker.mask_formula(formula).encode('utf-8'))
+        best = min(best, time.perf_counter() - started)
+        digest = md5.hexdigest()
+
+    print(f'repo: {args.repo}')
+    print(f'{len(formulas)} formulas, {masks} masks: {best * 1000:.0f} ms  md5 {digest}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Бенчмарк разбора формул: лексер (_mask_formula, с отказами в прежний разбор)
+против последовательных regex-проходов (_mask_formula_passes).
+
+Формулы entity_properties, vertex_functions и constraints синтетического namespace
+(--adversarial N — еще N случайных формул из tests/formula_cases.py, на которых
+лексер чаще отказывает). Кэш формул не используется: каждый повтор — новый маскер
+с теми же сущностями и параметрами. Результаты обоих способов должны совпасть.
+
+    python bench/bench_formula_masking.py --adversarial 2000
+"""
+import time
+
+from _common import load_synth, load_tests_module, setup
+
+
+def main() -> None:
+    parser, parse = setup(__doc__)
+    parser.add_argument('--adversarial', type=int, default=0, help='Сколько добавить случайных формул')
+    parser.add_argument('--repeat', type=int, default=3, help='Повторов (берется лучший)')
+    args = parse()
+
+    from core.context_engine import DbDataLoader
+    from core.masking import ContextMasker
+
+    raw = load_synth().make_namespace(n_entities=150, props_per_entity=40, n_vertices=1500, n_edges=100,
+                                      n_datasets=20, n_constraints=300, seed=5)
+    loader = DbDataLoader(raw)
+    formulas = []
+    for table, columns in (('entity_properties', ('calculation_func', 'aggregation_func')),
+                           ('vertex_functions', ('calculation_func', 'aggregation_func')),
+                           ('constraints', ('condition',))):
+        for row in loader.db[table].values():
+            formulas += [row[col] for col in columns if row.get(col)]
+    if args.adversarial:
+        fuzzer = load_tests_module('formula_cases').FormulaFuzzer(1)
+        formulas += [fuzzer.formula() for _ in range(args.adversarial)]
+    params = {row['parameter_id'] for row in raw['parameters']}
+
+    def run(method: str):
+        best, result, masker = float('inf'), None, None
+        for _ in range(args.repeat):
+            masker = ContextMasker()
+            masker.cache_size = 0
+            masker.set_known_parameters(params)
+            for row in loader.db['entities'].values():
+                masker.register(row['entity_type'], 'ENT')
+            mask = getattr(masker, method)
+            started = time.perf_counter()
+            result = [mask(formula) for formula in formulas]
+            best = min(best, time.perf_counter() - started)
+        return best, result, masker
+
+    passes_time, expected, _ = run('_mask_formula_passes')
+    lexer_time, result, masker = run('_mask_formula')
+    chars = sum(map(len, formulas))
+    print(f'repo: {args.repo}')
+    print(f'{len(formulas)} formulas, {chars} chars')
+    print(f'regex passes: {passes_time * 1000:8.0f} ms  {chars / passes_time / 1e6:6.2f} MB/s')
+    print(f'lexer:        {lexer_time * 1000:8.0f} ms  {chars / lexer_time / 1e6:6.2f} MB/s')
+    print(f"lexer fallbacks: {masker.cache_stats()['lexer_fallbacks']}")
+    print('results equal' if result == expected else 'MISMATCH')
+
+
+if __name__ == '__main__':
+    main()
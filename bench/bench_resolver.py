@@ -0,0 +1,54 @@
+"""
+Бенчмарк подбора контекста (ContextResolver) на синтетическом namespace.
+
+Замеряет загрузку DbDataLoader (включая построение индексов) и серию подборов
+по датасетам и сущностям. Для сравнения с ревизией до индексов запустите
+скрипт с --repo на её копии (см. bench/_common.py); на полном размере
+линейные сканы работают минутами, поэтому для быстрой проверки есть --scale.
+
+    python bench/bench_resolver.py --scale 0.25
+"""
+import time
+
+from _common import best_of, load_synth, setup
+
+
+def main() -> None:
+    parser, parse = setup(__doc__)
+    parser.add_argument('--scale', type=float, default=1.0, help='Множитель размера namespace')
+    parser.add_argument('--picks', type=int, default=10, help='Количество подборов (датасет + сущность)')
+    args = parse()
+
+    from core.context_engine import ContextResolver, DbDataLoader
+
+    k = args.scale
+    n_entities, n_datasets = max(int(200 * k), 10), max(int(300 * k), 10)
+    raw = load_synth().make_namespace(
+        n_entities=n_entities, props_per_entity=100, n_params=max(int(1000 * k), 10),
+        n_vertices=max(int(3000 * k), 10), n_edges=max(int(4000 * k), 10), n_datasets=n_datasets,
+        n_constraints=max(int(2000 * k), 10), seed=5,
+    )
+
+    started = time.perf_counter()
+    loader = DbDataLoader(raw)
+    load_time = time.perf_counter() - started
+
+    step = max(n_datasets // args.picks, 1)
+
+    def run() -> int:
+        nodes = 0
+        for i in range(0, step * args.picks, step):
+            resolver = ContextResolver(loader)
+            resolver.resolve_by_dataset(f'ds{i % n_datasets}')
+            resolver.resolve_by_entity(f'entity{i % n_entities}')
+            nodes += sum(len(v) for v in resolver.context.values())
+        return nodes
+
+    elapsed, nodes = best_of(run, repeat=1)
+    rows = sum(len(v) for v in raw.values())
+    print(f'repo: {args.repo}')
+    print(f'rows: {rows}  load: {load_time:.3f}s  resolve x{args.picks}: {elapsed:.3f}s  nodes: {nodes}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Бенчмарк расшифровки ответа LLM (ContextMasker.unmask_text).
+
+Словарь из --masks масок разных категорий, текст длиной --chars символов:
+маски вперемешку с похожими на маски словами (ENT_999999, DB.TBL_1, X_1).
+Сравнивается с прежним алгоритмом — отдельный re.sub на каждую маску от длинных
+к коротким (реализован здесь же как эталон), результаты должны совпасть.
+
+    python bench/bench_unmask.py --chars 50000 --masks 6000
+"""
+import random
+import re
+
+from _common import best_of, setup
+
+CATEGORIES = ['ENT', 'ENT_NAME', 'P', 'PARAM', 'COL', 'DB.TBL', 'DB.DICT', 'TBL', 'TEN', 'PATH']
+
+
+def unmask_per_mask(masker, text: str) -> str:
+    """Прежний unmask_text: один проход regex по тексту на каждую маску."""
+    for mask, original in sorted(masker.map_reverse.items(), key=lambda x: len(x[0]), reverse=True):
+        text = re.sub(r'\b' + re.escape(mask) + r'\b', original, text)
+    return text
+
+
+def main() -> None:
+    parser, parse = setup(__doc__)
+    parser.add_argument('--chars', type=int, default=50000, help='Длина текста ответа')
+    parser.add_argument('--masks', type=int, default=6000, help='Размер словаря масок')
+    args = parse()
+
+    from core.masking import ContextMasker
+
+    rnd = random.Random(2)
+
+    def word() -> str:
+        return ''.join(rnd.choice('abcdefgh_') for _ in range(rnd.randint(3, 9)))
+
+    masker = ContextMasker()
+    for i in range(args.masks):
+        masker.register(word() + str(i), rnd.choice(CATEGORIES))
+    masks = list(masker.map_reverse)
+    noise = [None, 'ENT_999999', 'DB.TBL_1', 'X_1', 'select', '(', 'DB.', '=', 'ENT_1_2', 'sum']
+
+    parts, size = [], 0
+    while size < args.chars:
+        token = rnd.choice(masks) if rnd.random() < .6 else (rnd.choice(noise) or word())
+        parts.append(token)
+        size += len(token) + 1
+    text = ' '.join(parts)[:args.chars]
+
+    old_time, expected = best_of(lambda: unmask_per_mask(masker, text), repeat=1)
+    first_time, first = best_of(lambda: masker.unmask_text(text), repeat=1)
+    warm_time, result = best_of(lambda: masker.unmask_text(text))
+    print(f'repo: {args.repo}')
+    print(f'text: {len(text)} chars, masks: {len(masker.map_reverse)}')
+    print(f'per-mask re.sub: {old_time * 1000:9.1f} ms')
+    print(f'unmask_text:     {first_time * 1000:9.1f} ms (first call), {warm_time * 1000:.1f} ms (warm)')
+    print('results equal' if first == result == expected else 'MISMATCH')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Бенчмарк обхода графа: рекурсивный ContextResolver против WorklistResolver
+и готового ClosureIndex на одних и тех же выборках.
+
+Печатает среднее время подбора на выборку и время построения индекса замыканий,
+а также проверяет, что контексты всех способов совпадают. В ревизиях без
+WorklistResolver/ClosureIndex (--repo) измеряется только ContextResolver.
+
+    python bench/bench_worklist.py
+"""
+import random
+import time
+
+from _common import load_synth, setup
+
+
+def main() -> None:
+    parser, parse = setup(__doc__)
+    parser.add_argument('--selections', type=int, default=60, help='Количество случайных выборок')
+    args = parse()
+
+    import core.context_engine as engine
+
+    raw = load_synth().make_namespace(n_entities=60, props_per_entity=30, n_params=300, n_vertices=800,
+                                      n_edges=1000, n_datasets=100, n_constraints=500, seed=11)
+    loader = engine.DbDataLoader(raw)
+    rnd = random.Random(3)
+    datasets, entities = [f'ds{i}' for i in range(100)], [f'entity{i}' for i in range(60)]
+    selections = [(rnd.sample(datasets, rnd.randint(1, 15)), rnd.sample(entities, rnd.randint(0, 8)))
+                  for _ in range(args.selections)]
+
+    def by_resolver(resolver_cls):
+        def run(sel_datasets, sel_entities):
+            resolver = resolver_cls(loader)
+            for ds in sel_datasets:
+                resolver.resolve_by_dataset(ds)
+            for ent in sel_entities:
+                resolver.resolve_by_entity(ent)
+            return resolver.context
+        return run
+
+    methods = {'ContextResolver': by_resolver(engine.ContextResolver)}
+    if hasattr(engine, 'WorklistResolver'):
+        methods['WorklistResolver'] = by_resolver(engine.WorklistResolver)
+    if hasattr(engine, 'ClosureIndex'):
+        closures = engine.ClosureIndex(loader)
+        started = time.perf_counter()
+        closures.build()
+        print(f'ClosureIndex.build: {time.perf_counter() - started:.3f}s')
+        methods['ClosureIndex'] = closures.resolve
+
+    reference = None
+    for name, run in methods.items():
+        started = time.perf_counter()
+        contexts = [{t: set(pks) for t, pks in run(ds, ents).items() if pks} for ds, ents in selections]
+        elapsed = time.perf_counter() - started
+        if reference is None:
+            reference = contexts
+        status = 'ok' if contexts == reference else 'MISMATCH'
+        print(f'{name:17s} {elapsed / len(selections) * 1000:8.2f} ms/selection  [{status}]')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,10 @@ load_dotenv()
 # ==========================================
 # Используем pathlib для кроссплатформенности путей (Windows/Linux/Mac)
 VERSIONS_FILE: Path = Path("prompt_versions.json")
+# Каталог для снимков проиндексированных namespace (быстрый "теплый" старт)
+SNAPSHOT_DIR: Path = Path(os.getenv("SNAPSHOT_DIR", "snapshots"))
+# Сколько последних снимков хранить на namespace и режим хранения (старые удаляются после записи нового)
+SNAPSHOT_KEEP: int = int(os.getenv("SNAPSHOT_KEEP", "3"))
 
 # ==========================================
 # 🖥️ КОНФИГУРАЦИЯ СТРАНИЦЫ STREAMLIT
@@ -34,6 +38,60 @@ MAX_TOKENS: int = 128000
 # Обычно 1 слово ≈ 0.75 токена, значит 1 слово * 1.3 ≈ кол-во токенов.
 TOKEN_MULTIPLIER: float = 1.3  
 
+# ==========================================
+# 🗃️ ХРАНЕНИЕ ДАННЫХ NAMESPACE
+# ==========================================
+# Режим хранения строк в DbDataLoader:
+# 'dict' — обычные словари (по умолчанию), 'arrow' — колоночное хранилище pyarrow (меньше памяти).
+LOADER_STORAGE: str = os.getenv("LOADER_STORAGE", "dict")
+
+# Бюджет памяти общего кэша загрузчиков (один DbDataLoader на namespace для всех сессий Streamlit).
+# При превышении вытесняются давно не используемые загрузчики, которые сейчас никем не открыты.
+LOADER_CACHE_MAX_MB: int = int(os.getenv("LOADER_CACHE_MAX_MB", "2048"))
+
+# Предвычислять транзитивные замыкания каждого Dataset/Entity в фоне после загрузки namespace.
+# Тогда подбор контекста — объединение готовых множеств, а не обход графа.
+CONTEXT_CLOSURES: bool = os.getenv("CONTEXT_CLOSURES", "true").lower() in ("1", "true", "yes")
+
+# Обход графа зависимостей, пока замыкания не готовы (или отключены):
+# 'worklist' — очередь без рекурсии с пакетным поиском по индексам, 'recursive' — прежний рекурсивный обход.
+CONTEXT_RESOLVER: str = os.getenv("CONTEXT_RESOLVER", "worklist")
+
+# Сколько последних выборок (datasets + entities) на загрузчик хранить с готовым контекстом и SQL:
+# "Сгенерировать промпт" после "Подобрать контекст" не обходит граф и не генерирует SQL заново.
+RESOLUTION_CACHE_SIZE: int = int(os.getenv("RESOLUTION_CACHE_SIZE", "16"))
+
+# Сколько последних замаскированных формул и JSON-конфигов хранит ContextMasker:
+# одинаковые формулы в разных строках и при повторной генерации не разбираются заново.
+MASKING_CACHE_SIZE: int = int(os.getenv("MASKING_CACHE_SIZE", "4096"))
+
+# Сколько отрендеренных строк SQL (VALUES) на загрузчик хранит общий кэш OutputGenerator (core/row_cache.py):
+# повторная генерация пересекающихся выборок не форматирует и не маскирует строки заново. 0 — без кэша.
+ROW_CACHE_SIZE: int = int(os.getenv("ROW_CACHE_SIZE", "100000"))
+
+# Параллельная генерация SQL: маски регистрируются последовательно (нумерация та же), а строки форматируются
+# в пуле из SQL_RENDER_WORKERS воркеров. 1 — последовательно.
+# SQL_RENDER_EXECUTOR: 'thread' — потоки; 'process' — процессы (строки передаются в воркеры через pickle,
+# выигрыш только на больших контекстах). Пулы общие для процесса и закрываются при его завершении.
+SQL_RENDER_WORKERS: int = int(os.getenv("SQL_RENDER_WORKERS", "1"))
+SQL_RENDER_EXECUTOR: str = os.getenv("SQL_RENDER_EXECUTOR", "thread")
+
+# Формат контекста в промпте (см. OutputGenerator.OUTPUT_FORMATS): sql — INSERT с форматированием,
+# sql_min — минифицированные INSERT, sparse — без null-колонок, csv — таблицы в CSV
+CONTEXT_FORMAT: str = os.getenv("CONTEXT_FORMAT", "sql")
+
+# Дедупликация контекста: строковые значения не короче стольких символов (JSON config, формулы),
+# повторяющиеся в SQL, выводятся один раз в таблице context_values, в строках — ссылки @V1, @V2, ...
+# 0 — выключена; для формата csv не применяется
+CONTEXT_DEDUPE_MIN_CHARS: int = int(os.getenv("CONTEXT_DEDUPE_MIN_CHARS", "0"))
+
+# Бюджет разбора одной формулы. Вызовы dictGet/tupleElement без закрывающей скобки или кавычки
+# заставляют regex просматривать хвост формулы заново для каждого вызова, поэтому оценка работы —
+# длина формулы, умноженная на число таких вызовов плюс глубину вложенности скобок (+1). Формулы длиннее FORMULA_MAX_CHARS символов
+# или с оценкой больше FORMULA_SCAN_BUDGET маскируются упрощенно за линейное время и попадают в лог.
+FORMULA_MAX_CHARS: int = int(os.getenv("FORMULA_MAX_CHARS", "50000"))
+FORMULA_SCAN_BUDGET: int = int(os.getenv("FORMULA_SCAN_BUDGET", "2000000"))
+
 # ==========================================
 # 🎨 UI КОНСТАНТЫ (Интерфейс)
 # ==========================================
@@ -0,0 +1,191 @@
+import json
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from utils.logger import setup_logger
+
+# pyarrow — опциональная зависимость.
+# Если её нет, DbDataLoader остается на обычном хранилище (dict строк).
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pc = None
+
+logger = setup_logger(__name__)
+
+# Способы хранения колонки в ColumnarTable
+ENC_ARROW = 'arrow'   # Нативный тип Arrow (строки, числа, bool, массивы)
+ENC_JSON = 'json'     # dict/list из JSON-колонок: храним текстом, разбираем при первом чтении
+ENC_OBJECT = 'object' # Смешанные типы: храним как обычный список Python
+
+
+def is_arrow_available() -> bool:
+    """Проверяет, установлен ли pyarrow."""
+    return pa is not None
+
+
+class ColumnarTable(Mapping):
+    """
+    Колоночное хранилище одной таблицы qe_config на базе Arrow.
+
+    Снаружи выглядит как обычный словарь {pk -> row} (только чтение),
+    поэтому ContextResolver и OutputGenerator работают с ним без изменений.
+    Внутри держит pa.Table и индекс {pk -> номер строки}; словарь строки
+    собирается лениво, только в момент обращения (например, при рендере SQL).
+    """
+
+    def __init__(self, rows: List[Dict[str, Any]], pks: List[Tuple[str, ...]], cols: List[str]):
+        """
+        Args:
+            rows: Строки таблицы (как их вернул RealDictCursor).
+            pks: PK для каждой строки из rows (тот же порядок).
+            cols: Имена колонок в порядке таблицы.
+        """
+        self.cols = cols
+        # Индекс PK -> смещение строки. Дубликаты PK: побеждает последняя строка (как в dict).
+        self.offsets: Dict[Tuple[str, ...], int] = {}
+        for offset, pk in enumerate(pks):
+            if pk is not None:
+                self.offsets[pk] = offset
+        # Обратный индекс смещение -> PK строится лениво, только для filter_pks
+        self._pk_by_offset: Optional[Dict[int, Tuple[str, ...]]] = None
+        # Разобранные ячейки ENC_JSON: { (колонка, смещение): dict/list }.
+        # Объекты общие для всех чтений ячейки, их нельзя изменять на месте (как DbDataLoader.json_cache).
+        self._decoded: Dict[Tuple[str, int], Any] = {}
+
+        self.encodings: Dict[str, str] = {}
+        # Колонки, которые не удалось уложить в Arrow (ENC_OBJECT)
+        self.object_cols: Dict[str, List[Any]] = {}
+        arrays = {}
+        for col in cols:
+            values = [row.get(col) for row in rows]
+            encoding, array = self._encode_column(values)
+            self.encodings[col] = encoding
+            if encoding == ENC_OBJECT:
+                self.object_cols[col] = values
+            else:
+                arrays[col] = array
+        self.table = pa.table(arrays) if arrays else None
+        # Прямые ссылки на колонки, чтобы не искать их по имени на каждой ячейке
+        self._columns = {col: self.table.column(col) for col in arrays}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Ссылки на колонки и обратный индекс восстанавливаются из таблицы,
+        # иначе буферы Arrow попали бы в снимок дважды
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        state['_pk_by_offset'] = None
+        state['_decoded'] = {}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._decoded = {}
+        self._columns = {} if self.table is None else {
+            name: self.table.column(name) for name in self.table.column_names
+        }
+
+    @staticmethod
+    def _encode_column(values: List[Any]) -> Tuple[str, Any]:
+        """Подбирает представление колонки без потери исходных Python-значений."""
+        present = [v for v in values if v is not None]
+        kinds = {type(v) for v in present}
+
+        if kinds and kinds <= {dict, list} and not ColumnarTable._is_plain_array(present):
+            # JSON-конфиги: текст сжимается в Arrow куда лучше, чем дерево dict
+            try:
+                dumped = [None if v is None else json.dumps(v, ensure_ascii=False) for v in values]
+                return ENC_JSON, pa.array(dumped, type=pa.string())
+            except (TypeError, ValueError):
+                return ENC_OBJECT, None
+
+        if len(kinds) > 1:
+            # Смешанные типы (например, str и int в одной колонке) Arrow сведет к одному, это ломает рендер
+            return ENC_OBJECT, None
+
+        try:
+            return ENC_ARROW, pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError, TypeError):
+            return ENC_OBJECT, None
+
+    @staticmethod
+    def _is_plain_array(values: List[Any]) -> bool:
+        """Проверяет, что колонка — массив PostgreSQL из скаляров одного типа (например, edges)."""
+        if not all(isinstance(v, list) for v in values):
+            return False
+        item_kinds = {type(x) for v in values for x in v if x is not None}
+        return len(item_kinds) <= 1 and not (item_kinds & {dict, list})
+
+    # --- Интерфейс Mapping ---
+
+    def __getitem__(self, pk: Tuple[str, ...]) -> Dict[str, Any]:
+        return self.row_at(self.offsets[pk])
+
+    def __contains__(self, pk: Any) -> bool:
+        return pk in self.offsets
+
+    def __iter__(self) -> Iterator[Tuple[str, ...]]:
+        return iter(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    # --- Чтение данных ---
+
+    def row_at(self, offset: int) -> Dict[str, Any]:
+        """Материализует строку по смещению в обычный dict."""
+        return {col: self.value_at(col, offset) for col in self.cols}
+
+    def value_at(self, col: str, offset: int) -> Any:
+        """Возвращает одно значение ячейки в исходном Python-виде."""
+        encoding = self.encodings.get(col)
+        if encoding is None:
+            return None
+        if encoding == ENC_OBJECT:
+            return self.object_cols[col][offset]
+        if encoding == ENC_JSON:
+            key = (col, offset)
+            try:
+                return self._decoded[key]
+            except KeyError:
+                value = self._columns[col][offset].as_py()
+                value = self._decoded[key] = None if value is None else json.loads(value)
+                return value
+        return self._columns[col][offset].as_py()
+
+    def filter_pks(self, **equals: Any) -> List[Tuple[str, ...]]:
+        """
+        Векторный фильтр по равенству колонок (например, namespace_id=1, tenant_id='').
+        Возвращает PK подходящих строк в порядке таблицы.
+        """
+        mask = None
+        for col, value in equals.items():
+            if self.encodings.get(col) != ENC_ARROW:
+                # Колонка не в Arrow: фильтруем поштучно
+                return self._filter_pks_python(equals)
+            column = self._columns[col]
+            try:
+                cond = pc.equal(column, pa.scalar(value, type=column.type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError):
+                # Тип значения не приводится к типу колонки (например, '1' для int64)
+                return self._filter_pks_python(equals)
+            mask = cond if mask is None else pc.and_(mask, cond)
+        if mask is None:
+            return list(self.offsets)
+        indices = pc.indices_nonzero(pc.fill_null(mask, False)).to_pylist()
+        if self._pk_by_offset is None:
+            # Только строки, которые реально попали в индекс (последний дубликат PK)
+            self._pk_by_offset = {offset: pk for pk, offset in self.offsets.items()}
+        pk_by_offset = self._pk_by_offset
+        return [pk_by_offset[offset] for offset in indices if offset in pk_by_offset]
+
+    def _filter_pks_python(self, equals: Dict[str, Any]) -> List[Tuple[str, ...]]:
+        """Медленный фильтр с построчным сравнением (запасной путь для filter_pks)."""
+        return [pk for pk, offset in self.offsets.items()
+                if all(self.value_at(c, offset) == v for c, v in equals.items())]
+
+    def nbytes(self) -> int:
+        """Размер данных Arrow в байтах (без Python-индекса PK)."""
+        return self.table.nbytes if self.table is not None else 0
@@ -1,13 +1,42 @@
 import re
+import sys
+import copy
+import atexit
 import json
+import time
+import bisect
+import itertools
+import heapq
+import functools
+import threading
 from collections import defaultdict
-from typing import Dict, List, Any, Set, Optional, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Any, Set, Optional, Tuple, Iterable, Iterator, Callable, NamedTuple
 
+from config.settings import (
+    CONTEXT_DEDUPE_MIN_CHARS, CONTEXT_FORMAT, ROW_CACHE_SIZE, SQL_RENDER_WORKERS, SQL_RENDER_EXECUTOR
+)
 from utils.logger import setup_logger
-from core.masking import ContextMasker
+from utils.tokenizer import TokenCounter
+from core.masking import ContextMasker, formula_over_budget
+from core.row_cache import RowFragmentCache
+from core.columnar import ColumnarTable, is_arrow_available
+from core.schema_config import PRIMARY_KEYS, FIELD_MAPPING
 
 logger = setup_logger(__name__)
 
+# Маркер "в ячейке невалидный JSON" для кэша DbDataLoader.get_json()
+_INVALID_JSON = object()
+
+# Regex для поиска зависимостей в формулах
+FORMULA_PROP_RE = re.compile(r'\b([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\b') # Entity.Property
+FORMULA_PARAM_RE = re.compile(r'\{([a-zA-Z0-9_]+)\}') # {param}
+FORMULA_WORD_RE = re.compile(r'\b([a-zA-Z_][a-zA-Z0-9_]*)\b') # Java-style: param != null
+JAVA_KEYWORDS = {'null', 'true', 'false', 'equals', 'not', 'and', 'or', 'if', 'else', 'return'}
+
+# Ссылки формулы: (кортеж пар (entity_type, property_id), кортеж parameter_id)
+FormulaRefs = Tuple[Tuple[Tuple[str, str], ...], Tuple[str, ...]]
+
 # ==========================================
 # 1. DB DATA LOADER (Индексация данных)
 # ==========================================
@@ -15,40 +44,156 @@ class DbDataLoader:
     """
     Класс для загрузки и быстрой индексации "сырых" данных из БД.
     Превращает списки строк в словари {Primary_Key -> Row}.
+
+    Режимы хранения (storage):
+    - 'dict': строки хранятся как есть (dict из RealDictCursor).
+    - 'arrow': каждая таблица хранится колонками в Arrow (ColumnarTable),
+      строки материализуются лениво. Экономит память на больших namespace.
     """
-    def __init__(self, raw_data: Dict[str, List[Dict[str, Any]]]):
+    STORAGE_DICT = 'dict'
+    STORAGE_ARROW = 'arrow'
+    # Версия структуры объекта для снимков на диске (SnapshotStore).
+    # Увеличивать при изменении набора атрибутов, иначе старые снимки не загрузятся корректно.
+    SNAPSHOT_VERSION = 4
+    # Защищает ленивое создание индекса замыканий (загрузчик общий для потоков Streamlit)
+    _closures_lock = threading.Lock()
+
+    def __init__(self, raw_data: Dict[str, List[Dict[str, Any]]], storage: str = STORAGE_DICT):
+        if storage == self.STORAGE_ARROW and not is_arrow_available():
+            logger.warning("pyarrow не установлен. DbDataLoader переключен на хранилище 'dict'.")
+            storage = self.STORAGE_DICT
+        self.storage = storage
         # Основное хранилище: { 'table_name': { (pk_tuple): {row_data} } }
+        # В режиме 'arrow' значением является ColumnarTable с тем же интерфейсом чтения.
         self.db: Dict[str, Dict[Tuple[Any, ...], Dict[str, Any]]] = defaultdict(dict)
         # Кэш имен колонок для каждой таблицы
         self.table_cols: Dict[str, List[str]] = {} 
         
-        # Определение полей Primary Key для каждой таблицы (hardcoded schema)
-        self.pks: Dict[str, List[str]] = {
-            'datasets': ['namespace_id', 'tenant_id', 'dataset_id'],
-            'vertices': ['namespace_id', 'tenant_id', 'vertex_id'],
-            'edges': ['namespace_id', 'tenant_id', 'edge_id'],
-            'entities': ['namespace_id', 'tenant_id', 'entity_type'],
-            'entity_properties': ['namespace_id', 'tenant_id', 'entity_type', 'property_id'],
-            'tables': ['namespace_id', 'tenant_id', 'table_id'],
-            'table_fields': ['namespace_id', 'tenant_id', 'table_id', 'entity_type', 'property_id'],
-            'parameters': ['namespace_id', 'tenant_id', 'parameter_id'],
-            'constraints': ['namespace_id', 'tenant_id', 'constraint_id'],
-            'composed_constraints': ['namespace_id', 'tenant_id', 'constraint_id'],
-            'filters': ['namespace_id', 'tenant_id', 'vertex_id', 'index'],
-            'vertex_functions': ['namespace_id', 'tenant_id', 'vertex_id', 'entity_type', 'property_id'],
-            'aggregation': ['namespace_id', 'tenant_id', 'aggregation_id'],
-            'limitation': ['namespace_id', 'tenant_id', 'limitation_id'],
-            'ordering': ['namespace_id', 'tenant_id', 'ordering_id'],
-            'group_by': ['namespace_id', 'tenant_id', 'group_id', 'index'],
-            'order_by': ['namespace_id', 'tenant_id', 'order_id', 'index'],
-            'namespaces': ['namespace_id'],
-            'tenants': ['tenant_id'],
-            'clients': ['service_id', 'component_id'],
-            'composed_entities': ['namespace_id', 'tenant_id', 'composed_entity', 'entity_type']
+        # Поля Primary Key для каждой таблицы (core/schema_config.py)
+        self.pks: Dict[str, List[str]] = {table: list(fields) for table, fields in PRIMARY_KEYS.items()}
+        # Вторичные индексы: по каким полям PK ContextResolver ищет строки, кроме полного PK.
+        # Формат: 'имя_таблицы': [('поле',), ('поле_1', 'поле_2'), ...]
+        self.index_fields: Dict[str, List[Tuple[str, ...]]] = {
+            'datasets': [('dataset_id',)],
+            'vertices': [('vertex_id',)],
+            'edges': [('edge_id',)],
+            'entities': [('entity_type',)],
+            'entity_properties': [('entity_type',), ('entity_type', 'property_id')],
+            'tables': [('table_id',)],
+            'table_fields': [('table_id',)],
+            'parameters': [('parameter_id',)],
+            'constraints': [('constraint_id',)],
+            'composed_constraints': [('constraint_id',)],
+            'filters': [('vertex_id',)],
+            'vertex_functions': [('vertex_id',)],
+            'aggregation': [('aggregation_id',)],
+            'limitation': [('limitation_id',)],
+            'ordering': [('ordering_id',)],
+            'composed_entities': [('composed_entity',)]
         }
+        # Хранилище индексов: { ('table_name', ('поле', ...)): { значение_ключа: [pk, ...] } }
+        self.indexes: Dict[Tuple[str, Tuple[str, ...]], Dict[Any, List[Tuple[str, ...]]]] = {}
+        # Кэш разобранных JSON-колонок: { ('table_name', pk, 'column'): parsed_json }
+        # Заполняется лениво в get_json(). Объекты общие, их нельзя изменять на месте.
+        self.json_cache: Dict[Tuple[str, Tuple[str, ...], str], Any] = {}
+        # Колонки с формулами, зависимости которых извлекаются при загрузке
+        self.formula_cols: Dict[str, List[str]] = {
+            'entity_properties': ['calculation_func', 'aggregation_func'],
+            'vertex_functions': ['calculation_func', 'aggregation_func'],
+            'edges': ['condition'],
+            'constraints': ['condition'],
+            'composed_constraints': ['condition'],
+            'limitation': ['total_limit', 'group_limit']
+        }
+        # Кэш ссылок формул: { 'текст формулы': FormulaRefs }
+        self.formula_refs_cache: Dict[str, FormulaRefs] = {}
+        # Обратный индекс кандидатов в ссылки: { 'id параметра' или 'Entity.Property': {тексты формул} }.
+        # По нему apply_delta находит формулы, ссылки которых зависят от появившегося или удаленного id.
+        self.formula_ref_index: Dict[str, Set[str]] = defaultdict(set)
+        # Версия загруженных данных для инкрементального обновления (заполняет ContextService):
+        # отпечаток таблиц из DatabaseManager.fetch_namespace_fingerprint и граница xmin для дельты
+        self.fingerprint: Dict[str, Dict[str, int]] = {}
+        self.xmin_horizon: Optional[int] = None
+        # Индекс транзитивных замыканий (ClosureIndex), создается по первому обращению к closures
+        self._closures: Optional['ClosureIndex'] = None
         self._index_data(raw_data)
+        self._precompute_formula_refs()
         total_records = sum(len(v) for v in self.db.values())
-        logger.info(f"DbDataLoader проиндексировал {total_records} записей.")
+        logger.info(f"DbDataLoader проиндексировал {total_records} записей (storage={self.storage}).")
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Кэш JSON не сохраняем в снимок: он заполняется лениво и содержит маркер-синглтон
+        state = self.__dict__.copy()
+        state['json_cache'] = {}
+        # Индекс замыканий строится заново после загрузки снимка (в нем поток и блокировка)
+        state['_closures'] = None
+        return state
+
+    @property
+    def closures(self) -> 'ClosureIndex':
+        """Индекс замыканий Dataset/Entity для этого загрузчика (см. ClosureIndex)."""
+        if self._closures is None:
+            with self._closures_lock:
+                if self._closures is None:
+                    self._closures = ClosureIndex(self)
+        return self._closures
+
+    def copy(self) -> 'DbDataLoader':
+        """
+        Копия загрузчика, которую можно менять (apply_delta), не затрагивая исходный:
+        исходный может быть общим для нескольких сессий (LoaderCache).
+        Копируются только контейнеры; строки и таблицы Arrow общие — на месте они не изменяются.
+        """
+        clone = copy.copy(self)
+        clone.db = defaultdict(dict, {
+            table: rows if isinstance(rows, ColumnarTable) else dict(rows)
+            for table, rows in self.db.items()
+        })
+        clone.table_cols = dict(self.table_cols)
+        clone.indexes = dict(self.indexes)
+        clone.json_cache = dict(self.json_cache)
+        clone.formula_refs_cache = dict(self.formula_refs_cache)
+        clone.formula_ref_index = defaultdict(set, {name: set(f) for name, f in self.formula_ref_index.items()})
+        clone.fingerprint = dict(self.fingerprint)
+        # Замыкания копии станут неактуальны после apply_delta: строятся заново
+        clone._closures = None
+        return clone
+
+    def estimate_nbytes(self, sample_size: int = 50) -> int:
+        """
+        Приблизительный объем памяти под данные загрузчика (для бюджета LoaderCache).
+        Python-объекты оцениваются по выборке первых sample_size элементов; части PK
+        интернированы и общие, поэтому для ключей считаются только кортежи.
+        """
+        def sampled(items: Iterable[Any], count: int, size) -> int:
+            sample = list(itertools.islice(items, sample_size))
+            return sum(size(item) for item in sample) * count // len(sample) if sample else 0
+
+        total = 0
+        for rows in self.db.values():
+            total += sys.getsizeof(rows.offsets if isinstance(rows, ColumnarTable) else rows)
+            if isinstance(rows, ColumnarTable):
+                # Буферы Arrow + Python-индекс PK -> смещение + колонки, оставшиеся списками
+                total += rows.nbytes() + sampled(rows.offsets, len(rows), sys.getsizeof)
+                for values in rows.object_cols.values():
+                    total += sys.getsizeof(values) + sampled(values, len(values), sys.getsizeof)
+                continue
+            total += sampled(rows.items(), len(rows), lambda item: (
+                sys.getsizeof(item[0]) + sys.getsizeof(item[1])
+                + sum(sys.getsizeof(v) for v in item[1].values())
+            ))
+        for index in self.indexes.values():
+            total += sys.getsizeof(index) + sum(sys.getsizeof(pks) for pks in index.values())
+        if self._closures is not None and self._closures.ready:
+            total += self._closures.nbytes()
+        total += sys.getsizeof(self.formula_refs_cache) + sys.getsizeof(self.formula_ref_index)
+        total += sampled(self.formula_ref_index.values(), len(self.formula_ref_index), sys.getsizeof)
+        total += sampled(self.formula_refs_cache.items(), len(self.formula_refs_cache), lambda item: (
+            sys.getsizeof(item[0]) + sys.getsizeof(item[1])
+            + sum(sys.getsizeof(part) for part in item[1])
+            + sum(sys.getsizeof(pair) for pair in item[1][0])
+        ))
+        return total
 
     def _index_data(self, raw_data: Dict[str, List[Dict[str, Any]]]) -> None:
         """Превращает списки словарей в хэш-таблицы по Primary Key."""
@@ -56,18 +201,328 @@ class DbDataLoader:
             if not rows: continue
             # Сохраняем имена колонок из первой строки
             self.table_cols[table] = list(rows[0].keys())
+            if self.storage == self.STORAGE_ARROW:
+                self._index_table_columnar(table, rows)
+                continue
             for row in rows:
                 try:
                     pk = self._get_pk_key(table, row)
                     self.db[table][pk] = row
                 except Exception as e:
                     logger.warning(f"Ошибка индексации строки в {table}: {e}")
+        self._build_secondary_indexes()
+
+    def _index_table_columnar(self, table: str, rows: List[Dict[str, Any]]) -> None:
+        """Укладывает таблицу в Arrow и строит индекс PK -> смещение строки."""
+        pks: List[Optional[Tuple[str, ...]]] = []
+        for row in rows:
+            try:
+                pks.append(self._get_pk_key(table, row))
+            except Exception as e:
+                logger.warning(f"Ошибка индексации строки в {table}: {e}")
+                pks.append(None)
+        try:
+            self.db[table] = ColumnarTable(rows, pks, self.table_cols[table])
+        except Exception as e:
+            # Таблицу не удалось уложить в Arrow: оставляем её в обычном виде
+            logger.warning(f"Таблица {table} не переведена в Arrow: {e}")
+            for pk, row in zip(pks, rows):
+                if pk is not None:
+                    self.db[table][pk] = row
+
+    def get_value(self, table: str, pk: Tuple[str, ...], col: str) -> Any:
+        """Возвращает значение одной ячейки (без материализации всей строки в режиме 'arrow')."""
+        rows = self.db[table]
+        if isinstance(rows, ColumnarTable):
+            return rows.value_at(col, rows.offsets[pk])
+        return rows[pk].get(col)
+
+    def get_json(self, table: str, pk: Tuple[str, ...], col: str) -> Any:
+        """
+        Возвращает разобранный JSON из ячейки. Разбор выполняется один раз,
+        результат кэшируется рядом с данными и переиспользуется резолвером и генератором.
+        Уже разобранные значения (dict/list от psycopg2) возвращаются как есть.
+
+        Raises:
+            ValueError: Если в ячейке невалидный JSON (ошибка тоже кэшируется).
+        """
+        key = (table, pk, col)
+        try:
+            value = self.json_cache[key]
+        except KeyError:
+            raw = self.get_value(table, pk, col)
+            if isinstance(raw, str):
+                try:
+                    value = json.loads(raw)
+                except ValueError:
+                    value = _INVALID_JSON
+            else:
+                value = raw
+            self.json_cache[key] = value
+        if value is _INVALID_JSON:
+            raise ValueError(f"Невалидный JSON в {table}.{col} pk={pk}")
+        return value
+
+    def _precompute_formula_refs(self) -> None:
+        """
+        Один проход по всем формулам namespace при загрузке.
+        После него ContextResolver обходит граф без regex на горячем пути.
+        Формулы сверх бюджета разбора (см. formula_over_budget) пишутся в лог: ссылки в них ищутся
+        как обычно (эти regex линейны), но маскер обработает их упрощенно.
+        """
+        for table, cols in self.formula_cols.items():
+            for pk in self.db.get(table, {}):
+                for col in cols:
+                    formula = self.get_value(table, pk, col)
+                    if formula:
+                        if isinstance(formula, str) and formula not in self.formula_refs_cache \
+                                and formula_over_budget(formula):
+                            logger.warning(f"Формула сверх бюджета разбора в {table}.{col} pk={pk} ({len(formula)} символов)")
+                        self.formula_refs(formula)
+        logger.debug(f"Извлечены зависимости {len(self.formula_refs_cache)} уникальных формул.")
+
+    def formula_refs(self, formula: str) -> FormulaRefs:
+        """
+        Возвращает ссылки формулы: существующие свойства (Entity.Property) и параметры
+        ({param} и Java-style слова). Результат кэшируется по тексту формулы.
+        """
+        if not isinstance(formula, str):
+            return (), ()
+        refs = self.formula_refs_cache.get(formula)
+        if refs is None:
+            candidates = self._formula_candidates(formula)
+            refs = self._extract_formula_refs(formula, candidates)
+            self.formula_refs_cache[formula] = refs
+            pairs, param_ids = candidates
+            for name in itertools.chain((f"{e}.{p}" for e, p in pairs), param_ids):
+                self.formula_ref_index[name].add(formula)
+        return refs
+
+    @staticmethod
+    def _formula_candidates(formula: str) -> Tuple[List[Tuple[str, str]], List[str]]:
+        """Все кандидаты в ссылки формулы: пары (Entity, Property) и id параметров (без проверки существования)."""
+        # 1. SQL-style: Entity.Property
+        pairs = FORMULA_PROP_RE.findall(formula)
+        # 2. SQL-style Params: {param}
+        # 3. Java-style Params: слова, совпадающие с ID параметров (param != null)
+        param_ids = FORMULA_PARAM_RE.findall(formula)
+        param_ids += sorted(set(FORMULA_WORD_RE.findall(formula)) - JAVA_KEYWORDS)
+        return pairs, param_ids
+
+    def _extract_formula_refs(
+        self,
+        formula: str,
+        candidates: Optional[Tuple[List[Tuple[str, str]], List[str]]] = None
+    ) -> FormulaRefs:
+        """Парсит формулу и оставляет только ссылки на объекты, которые есть в namespace."""
+        pairs, param_ids = candidates or self._formula_candidates(formula)
+        props = tuple(dict.fromkeys(
+            pair for pair in pairs
+            if self.lookup('entity_properties', ('entity_type', 'property_id'), pair)
+        ))
+        params = tuple(dict.fromkeys(
+            p_id for p_id in param_ids
+            if self.lookup('parameters', ('parameter_id',), p_id)
+        ))
+        return props, params
+
+    def filter_pks(self, table: str, **equals: Any) -> List[Tuple[str, ...]]:
+        """
+        Возвращает PK строк таблицы, у которых колонки равны переданным значениям.
+        Пример: loader.filter_pks('entities', namespace_id=1, tenant_id='')
+        В режиме 'arrow' фильтрация выполняется векторно через pyarrow.compute.
+        """
+        rows = self.db.get(table, {})
+        if isinstance(rows, ColumnarTable):
+            return rows.filter_pks(**equals)
+        return [pk for pk, row in rows.items()
+                if all(row.get(col) == value for col, value in equals.items())]
+
+    def _build_secondary_indexes(self, tables: Optional[Iterable[str]] = None) -> None:
+        """
+        Строит вторичные хэш-индексы {значение полей PK -> [pk, ...]}.
+        Порядок pk в списке совпадает с порядком строк в self.db, поэтому
+        поиск "первого совпадения" через индекс дает тот же результат, что и полный перебор.
+
+        Args:
+            tables: Перестроить индексы только этих таблиц (по умолчанию — все).
+        """
+        if tables is None:
+            self.indexes.clear()
+            tables = self.index_fields
+        for table in tables:
+            field_sets = self.index_fields.get(table, [])
+            pk_fields = self.pks[table]
+            for fields in field_sets:
+                positions = [pk_fields.index(f) for f in fields]
+                index: Dict[Any, List[Tuple[str, ...]]] = defaultdict(list)
+                if len(positions) == 1:
+                    pos = positions[0]
+                    for pk in self.db.get(table, {}):
+                        index[pk[pos]].append(pk)
+                else:
+                    for pk in self.db.get(table, {}):
+                        index[tuple(pk[p] for p in positions)].append(pk)
+                # Отдаем наружу обычный dict, чтобы get() не создавал пустые ключи
+                self.indexes[(table, fields)] = dict(index)
+
+    def lookup(self, table: str, fields: Tuple[str, ...], key: Any) -> List[Tuple[str, ...]]:
+        """
+        Возвращает PK строк таблицы, у которых поля `fields` равны `key` (O(1)).
+        Для составного индекса `key` передается кортежем в порядке `fields`.
+        """
+        index = self.indexes.get((table, fields))
+        if index is None:
+            return []
+        try:
+            return index.get(key, [])
+        except TypeError:
+            # Нехэшируемое значение (например, список из JSON) не может совпасть с PK
+            return []
+
+    def lookup_many(self, table: str, fields: Tuple[str, ...], keys: Iterable[Any]) -> List[Tuple[str, ...]]:
+        """
+        lookup() для пачки ключей за один проход по индексу: PK всех совпавших строк подряд
+        (в порядке ключей; повторы ключей дают повторы PK).
+        """
+        index = self.indexes.get((table, fields))
+        if index is None:
+            return []
+        get = index.get
+        pks: List[Tuple[str, ...]] = []
+        for key in keys:
+            try:
+                hit = get(key)
+            except TypeError:
+                continue
+            if hit:
+                pks += hit
+        return pks
+
+    def count_after_upsert(self, table: str, rows: List[Dict[str, Any]]) -> int:
+        """Сколько строк будет в таблице после apply_delta(rows), если ничего не удалено."""
+        existing = self.db.get(table, {})
+        new_pks = {self._get_pk_key(table, row) for row in rows}
+        return len(existing) + sum(1 for pk in new_pks if pk not in existing)
+
+    def apply_delta(
+        self,
+        upserts: Dict[str, List[Dict[str, Any]]],
+        live_keys: Optional[Dict[str, List[Dict[str, Any]]]] = None
+    ) -> Dict[str, Dict[str, int]]:
+        """
+        Применяет изменения из БД на месте, без переиндексации всего namespace.
+        Обновляются строки, вторичные индексы и кэши только затронутых таблиц.
+
+        Args:
+            upserts: {'table_name': [rows...]} — новые и измененные строки целиком
+                (DatabaseManager.fetch_namespace_delta).
+            live_keys: {'table_name': [{'pk_col': value, ...}]} — все PK таблицы в БД
+                (DatabaseManager.fetch_namespace_keys). Строки, которых нет в списке, удаляются.
+                Таблицы без списка на удаления не проверяются.
+
+        Returns:
+            Dict: {'table_name': {'inserted': N, 'updated': N, 'deleted': N}}
+
+        Raises:
+            ValueError: Если набор колонок в дельте не совпадает с загруженным (изменилась схема).
+                Проверка выполняется до любых изменений.
+        """
+        live_keys = live_keys or {}
+        for table, rows in upserts.items():
+            cols = self.table_cols.get(table)
+            if cols is not None and any(row.keys() != set(cols) for row in rows):
+                raise ValueError(f"Изменился набор колонок таблицы {table}, нужна полная перезагрузка")
+
+        stats: Dict[str, Dict[str, int]] = {}
+        # PK, которые появились или исчезли (для таблиц, от которых зависят ссылки формул)
+        appeared: Dict[str, List[Tuple[str, ...]]] = defaultdict(list)
+        for table in list(upserts) + [t for t in live_keys if t not in upserts]:
+            rows = upserts.get(table, [])
+            if rows and table not in self.table_cols:
+                self.table_cols[table] = list(rows[0].keys())
+
+            current = self.db.get(table)
+            # ColumnarTable только для чтения: правим обычный dict и укладываем таблицу в Arrow заново
+            rebuild = isinstance(current, ColumnarTable) or (current is None and self.storage == self.STORAGE_ARROW)
+            if rebuild:
+                target = {pk: current[pk] for pk in current} if current is not None else {}
+            else:
+                target = self.db[table]
+
+            changed: List[Tuple[str, ...]] = []
+            inserted = updated = 0
+            for row in rows:
+                pk = self._get_pk_key(table, row)
+                if pk in target:
+                    updated += 1
+                else:
+                    inserted += 1
+                    appeared[table].append(pk)
+                target[pk] = row
+                changed.append(pk)
+
+            deleted = 0
+            if table in live_keys:
+                live = {self._get_pk_key(table, key_row) for key_row in live_keys[table]}
+                gone = [pk for pk in target if pk not in live]
+                for pk in gone:
+                    del target[pk]
+                changed.extend(gone)
+                appeared[table].extend(gone)
+                deleted = len(gone)
+
+            if rebuild:
+                self.db.pop(table, None)
+                if target:
+                    self._index_table_columnar(table, list(target.values()))
+                else:
+                    self.db[table] = {}
+
+            # Разобранный JSON измененных и удаленных строк больше не актуален
+            for pk in changed:
+                for col in self.table_cols.get(table, []):
+                    self.json_cache.pop((table, pk, col), None)
+            stats[table] = {'inserted': inserted, 'updated': updated, 'deleted': deleted}
+
+        touched = [table for table, st in stats.items() if any(st.values())]
+        self._build_secondary_indexes(touched)
+        if touched:
+            # Граф зависимостей изменился: индекс замыканий строится заново
+            self._closures = None
+
+        # Ссылки формул зависят от того, какие свойства и параметры существуют:
+        # пересчитываем только формулы, у которых появившийся или удаленный id среди кандидатов
+        # (обратный индекс formula_ref_index, без поиска подстрок по всем формулам)
+        param_pos = self.pks['parameters'].index('parameter_id')
+        ent_pos = self.pks['entity_properties'].index('entity_type')
+        prop_pos = self.pks['entity_properties'].index('property_id')
+        names = [pk[param_pos] for pk in appeared.get('parameters', [])]
+        names += [f"{pk[ent_pos]}.{pk[prop_pos]}" for pk in appeared.get('entity_properties', [])]
+        if names:
+            stale = {f for name in names for f in self.formula_ref_index.get(name, ())
+                     if f in self.formula_refs_cache}
+            # Кандидаты зависят только от текста формулы: обратный индекс остается верным
+            for formula in stale:
+                self.formula_refs_cache[formula] = self._extract_formula_refs(formula)
+        for table in touched:
+            for row in upserts.get(table, []):
+                for col in self.formula_cols.get(table, []):
+                    formula = row.get(col)
+                    if formula:
+                        self.formula_refs(formula)
+
+        logger.info(f"DbDataLoader: применена дельта по {len(touched)} таблицам: "
+                    + ", ".join(f"{t} +{s['inserted']} ~{s['updated']} -{s['deleted']}"
+                                for t, s in stats.items() if t in touched))
+        return stats
 
     def _get_pk_key(self, table_name: str, row: Dict[str, Any]) -> Tuple[str, ...]:
         """Формирует кортеж PK для строки."""
         if table_name in self.pks:
-            # Приводим все части ключа к строке для надежности
-            return tuple(str(row.get(k, '')) for k in self.pks[table_name])
+            # Приводим все части ключа к строке для надежности.
+            # intern: одинаковые id (namespace, tenant, vertex_id...) хранятся в памяти один раз.
+            return tuple(sys.intern(str(row.get(k, ''))) for k in self.pks[table_name])
         # Если для таблицы нет PK в конфиге, используем все значения (fallback)
         return tuple(row.values())
 
@@ -79,179 +534,377 @@ class ContextResolver:
     """
     Класс для рекурсивного поиска зависимостей.
     Например: Если выбран Dataset -> нужно найти все его Vertices -> для каждой Vertex найти Table -> Entity -> Properties и т.д.
+
+    Граф задается функциями _expand_*: для строки (узла) они возвращают её прямые зависимости
+    в виде списка узлов (table, pk). Обход добавляет узел в контекст и раскрывает его один раз.
+    Те же функции использует ClosureIndex для предвычисления замыканий.
+
+    Для выборки, которая меняется по одному элементу, есть инкрементальный режим:
+    add_root/remove_root/sync (вместо resolve_by_*). Каждый узел контекста хранит счетчик корней,
+    из которых он достижим, поэтому удаление Dataset убирает только то, что больше ниоткуда не достижимо.
     """
+    # Корни инкрементального режима: ('dataset', dataset_id) или ('entity', entity_type)
+    ROOT_DATASET = 'dataset'
+    ROOT_ENTITY = 'entity'
+
+    # Важность таблиц при подборе с бюджетом токенов (меньше — важнее).
+    # При равном расстоянии от выбранных корней сначала берутся строки более важных таблиц.
+    TABLE_PRIORITY = {
+        'datasets': 0, 'edges': 1, 'vertices': 1,
+        'entities': 2, 'composed_entities': 2, 'entity_properties': 3, 'parameters': 3,
+        'tables': 4, 'table_fields': 4, 'constraints': 5, 'composed_constraints': 5,
+        'vertex_functions': 6, 'filters': 6, 'aggregation': 7, 'limitation': 7, 'ordering': 7,
+    }
+
     def __init__(self, loader: DbDataLoader):
         self.loader = loader
         # Результат работы: { 'table_name': {set_of_pks} }
         self.context: Dict[str, Set[Tuple]] = defaultdict(set)
-        
-        # Regex для поиска зависимостей в формулах
-        self.prop_regex = re.compile(r'\b([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)\b') # Entity.Property
-        self.param_regex = re.compile(r'\{([a-zA-Z0-9_]+)\}') # {param}
+        # Инкрементальный режим: замыкание каждого выбранного корня и счетчики корней по узлам
+        self._root_closures: Dict[Tuple[str, str], Dict[str, Set[Tuple]]] = {}
+        self._refcounts: Dict[str, Dict[Tuple, int]] = defaultdict(dict)
+        # Раскрытие узла по таблице. Таблицы без записи (parameters, aggregation, ordering) — листья.
+        self._expanders = {
+            'datasets': self._expand_dataset,
+            'edges': self._expand_edge,
+            'vertices': self._expand_vertex,
+            'vertex_functions': self._expand_vertex_function,
+            'filters': self._expand_filter,
+            'tables': self._expand_table,
+            'table_fields': self._expand_table_field,
+            'constraints': self._expand_constraint,
+            'composed_constraints': self._expand_composed_constraint,
+            'limitation': self._expand_limitation,
+            'entity_properties': self._expand_property,
+            'entities': self._expand_entity,
+            'composed_entities': self._expand_composed_entity,
+        }
 
     def resolve_by_dataset(self, dataset_id: str) -> bool:
         """Точка входа: Найти всё, что связано с Dataset."""
-        found = False
-        # Ищем во всех строках таблицы datasets (pk[2] == dataset_id)
-        for pk, row in self.loader.db['datasets'].items():
-            if pk[2] == dataset_id:
-                self._add_dataset(pk)
-                found = True
-        return found
+        nodes = self.dataset_root(dataset_id)
+        for table, pk in nodes:
+            self._add(table, pk)
+        return bool(nodes)
     
     def resolve_by_entity(self, entity_type: str) -> bool:
         """Точка входа: Найти всё, что связано с Entity."""
-        found = False
-        for pk, row in self.loader.db['entities'].items():
-            if pk[2] == entity_type:
-                self._add_entity(pk)
-                self._add_all_properties_for_entity(pk)
-                found = True
-        return found
-
-    # --- Внутренние методы рекурсивного обхода ---
-
-    def _add_dataset(self, pk: Tuple):
-        if pk in self.context['datasets']: return
-        self.context['datasets'].add(pk)
-        
-        row = self.loader.db['datasets'][pk]
+        nodes = self.entity_root(entity_type)
+        for table, pk in nodes:
+            self._add(table, pk)
+        return bool(nodes)
+
+    # --- Инкрементальный режим ---
+
+    def add_root(self, kind: str, key: str) -> Set[str]:
+        """
+        Добавляет в выборку Dataset (kind='dataset') или Entity (kind='entity').
+        Returns:
+            Set[str]: Таблицы, в контексте которых появились новые PK.
+        """
+        root = (kind, key)
+        if root in self._root_closures:
+            return set()
+        closure = self._root_closures[root] = self._root_closure(kind, key)
+        changed = set()
+        for table, pks in closure.items():
+            counts = self._refcounts[table]
+            for pk in pks:
+                n = counts.get(pk, 0)
+                counts[pk] = n + 1
+                if not n:
+                    self.context[table].add(pk)
+                    changed.add(table)
+        return changed
+
+    def remove_root(self, kind: str, key: str) -> Set[str]:
+        """
+        Убирает корень из выборки: из контекста уходят узлы, которые не достижимы из других корней.
+        Returns:
+            Set[str]: Таблицы, из контекста которых удалены PK.
+        """
+        closure = self._root_closures.pop((kind, key), None)
+        if closure is None:
+            return set()
+        changed = set()
+        for table, pks in closure.items():
+            counts = self._refcounts[table]
+            for pk in pks:
+                n = counts[pk] - 1
+                if n:
+                    counts[pk] = n
+                    continue
+                del counts[pk]
+                self.context[table].discard(pk)
+                changed.add(table)
+            if not self.context.get(table):
+                self.context.pop(table, None)
+        return changed
+
+    def sync(self, datasets: Iterable[str], entities: Iterable[str]) -> Set[str]:
+        """
+        Приводит инкрементальную выборку к указанным datasets/entities (лишние корни убираются, новые добавляются).
+        Returns:
+            Set[str]: Таблицы, набор PK которых изменился.
+        """
+        wanted = {(self.ROOT_DATASET, ds) for ds in datasets} | {(self.ROOT_ENTITY, ent) for ent in entities}
+        changed = set()
+        for kind, key in [root for root in self._root_closures if root not in wanted]:
+            changed |= self.remove_root(kind, key)
+        for kind, key in wanted:
+            changed |= self.add_root(kind, key)
+        return changed
+
+    def _root_closure(self, kind: str, key: str) -> Dict[str, Set[Tuple]]:
+        """Всё, что достижимо из одного корня: из готового ClosureIndex или обходом графа."""
+        closures = self.loader._closures
+        context = None
+        if closures is not None:
+            context = (closures.resolve([key], []) if kind == self.ROOT_DATASET
+                       else closures.resolve([], [key]))
+        if context is None:
+            resolver = type(self)(self.loader)
+            if kind == self.ROOT_DATASET:
+                resolver.resolve_by_dataset(key)
+            else:
+                resolver.resolve_by_entity(key)
+            context = resolver.context
+        return {table: pks for table, pks in context.items() if pks}
+
+    # --- Подбор с бюджетом токенов ---
+
+    def resolve_budgeted(
+        self,
+        datasets: Iterable[str],
+        entities: Iterable[str],
+        max_tokens: int,
+        estimator: 'OutputGenerator'
+    ) -> Dict[str, Any]:
+        """
+        Подбирает контекст, пока он укладывается в max_tokens.
+        Узлы раскрываются по приоритету: расстояние от выбранных корней, затем важность таблицы
+        (TABLE_PRIORITY). Стоимость каждой строки оценивает estimator — OutputGenerator в том формате,
+        в котором контекст будет выведен (см. OutputGenerator.row_tokens).
+        Строка, которая не помещается, пропускается (ее зависимости не обходятся), а обход продолжается:
+        следующие строки поменьше еще могут уложиться. Когда бюджет исчерпан полностью, все ожидающие
+        в очереди узлы тоже попадают в отчет как пропущенные.
+
+        Returns:
+            Dict: Отчет {'max_tokens', 'used_tokens', 'truncated', 'included': {table: N},
+                  'omitted': {table: N}, 'omitted_nodes': [(table, pk), ...]}.
+        """
+        priority = self.TABLE_PRIORITY
+        heap: List[Tuple[int, int, int, str, Tuple]] = []
+        queued: Set[Tuple[str, Tuple]] = set()
+        counter = itertools.count()
+
+        def push(nodes: Iterable[Tuple[str, Tuple]], distance: int) -> None:
+            for table, pk in nodes:
+                node = (table, pk)
+                if node in queued or pk in self.context.get(table, ()):
+                    continue
+                queued.add(node)
+                heapq.heappush(heap, (distance, priority.get(table, len(priority)), next(counter), table, pk))
+
+        for dataset_id in datasets:
+            push(self.dataset_root(dataset_id), 0)
+        for entity_type in entities:
+            push(self.entity_root(entity_type), 0)
+
+        used = estimator.base_tokens()
+        skipped: List[Tuple[str, Tuple]] = []
+        while heap and used < max_tokens:
+            distance, _, _, table, pk = heapq.heappop(heap)
+            cost = estimator.row_tokens(table, pk)
+            if not self.context.get(table):
+                cost += estimator.table_tokens(table)
+            if used + cost > max_tokens:
+                # Строка не помещается: пропускаем ее, следующие (меньшие) строки еще могут уложиться
+                skipped.append((table, pk))
+                continue
+            used += cost
+            self.context[table].add(pk)
+            push(self.successors(table, pk), distance + 1)
+
+        omitted_nodes = skipped + [(table, pk) for _, _, _, table, pk in sorted(heap)]
+        truncated = bool(omitted_nodes)
+        omitted: Dict[str, int] = defaultdict(int)
+        for table, _ in omitted_nodes:
+            omitted[table] += 1
+        return {
+            'max_tokens': max_tokens,
+            'used_tokens': used,
+            'truncated': truncated,
+            'included': {table: len(pks) for table, pks in self.context.items() if pks},
+            'omitted': dict(omitted),
+            'omitted_nodes': omitted_nodes,
+        }
+
+    def dataset_root(self, dataset_id: str) -> List[Tuple[str, Tuple]]:
+        """Узлы, с которых начинается обход для выбранного Dataset."""
+        # Ищем строки таблицы datasets по индексу (pk[2] == dataset_id)
+        return self._dataset_nodes(dataset_id)
+
+    def entity_root(self, entity_type: str) -> List[Tuple[str, Tuple]]:
+        """Узлы, с которых начинается обход для выбранной Entity: сама сущность и все её свойства."""
+        nodes = []
+        for pk in self.loader.lookup('entities', ('entity_type',), entity_type):
+            nodes += self._entity_nodes(pk)
+            nodes += self._all_property_nodes(pk[2])
+        return nodes
+
+    # --- Обход графа ---
+
+    def _add(self, table: str, pk: Tuple):
+        if pk in self.context[table]: return
+        self.context[table].add(pk)
+        for node in self.successors(table, pk):
+            self._add(*node)
+
+    def successors(self, table: str, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        """Прямые зависимости строки: список узлов (table, pk)."""
+        expand = self._expanders.get(table)
+        return expand(pk) if expand else []
+
+    # --- Раскрытие узлов по таблицам ---
+
+    def _expand_dataset(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
         # 1. Сканируем JSON конфиг датасета
-        self._scan_json_config(row.get('config'))
+        nodes = self._json_nodes(self._row_json('datasets', pk, 'config'))
         # 2. Добавляем ребра (edges)
-        edges = row.get('edges')
+        edges = self._value('datasets', pk, 'edges')
         if edges:
-            for edge_id in edges: self._find_and_add_edge(str(edge_id))
-
-    def _find_and_add_edge(self, edge_id_str: str):
-        for pk in self.loader.db['edges']:
-            if str(pk[2]) == edge_id_str:
-                self._add_edge(pk)
-                return 
-
-    def _add_edge(self, pk: Tuple):
-        if pk in self.context['edges']: return
-        self.context['edges'].add(pk)
-        row = self.loader.db['edges'][pk]
-        
+            for edge_id in edges: nodes += self._first_node('edges', ('edge_id',), str(edge_id))
+        return nodes
+
+    def _expand_edge(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        value = self._value
         # Зависимости ребра: вершины source и target
-        self._find_and_add_vertex(str(row.get('source_vertex')))
-        self._find_and_add_vertex(str(row.get('target_vertex')))
-        
-        self._process_constraints_list(row.get('constraints'))
-        self._scan_json_config(row.get('config'))
-        self._scan_formula(row.get('condition')) 
-
-    def _find_and_add_vertex(self, vertex_id_str: str):
-        for pk in self.loader.db['vertices']:
-            if str(pk[2]) == vertex_id_str:
-                self._add_vertex(pk)
-                return
+        nodes = self._first_node('vertices', ('vertex_id',), str(value('edges', pk, 'source_vertex')))
+        nodes += self._first_node('vertices', ('vertex_id',), str(value('edges', pk, 'target_vertex')))
+        nodes += self._constraint_list_nodes(value('edges', pk, 'constraints'))
+        nodes += self._json_nodes(self._row_json('edges', pk, 'config'))
+        nodes += self._formula_nodes(value('edges', pk, 'condition'))
+        return nodes
 
-    def _add_vertex(self, pk: Tuple):
-        if pk in self.context['vertices']: return
-        self.context['vertices'].add(pk)
-        row = self.loader.db['vertices'][pk]
-        
-        v_type = row.get('vertex_type')
-        config_obj = row.get('config')
+    def _expand_vertex(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        nodes = []
+        v_type = self._value('vertices', pk, 'vertex_type')
+        # JSON конфиг разбирается один раз (кэш загрузчика) и используется дважды
+        conf = self._row_json('vertices', pk, 'config')
         
         # Если вершина - это датасет или таблица, нужно найти их определения
         if v_type == 'dataset':
-             conf = self._get_json(config_obj)
-             if conf and 'dataset' in conf: self.resolve_by_dataset(conf['dataset'])
+             if conf and 'dataset' in conf: nodes += self._dataset_nodes(conf['dataset'])
         elif v_type == 'table':
-             conf = self._get_json(config_obj)
-             if conf and 'table' in conf: self._find_and_add_table_by_id(conf['table'])
+             if conf and 'table' in conf: nodes += self._first_node('tables', ('table_id',), str(conf['table']))
              
-        self._process_constraints_list(row.get('constraints'))
-        self._scan_json_config(config_obj)
-        self._add_vertex_functions(pk)
-        self._add_vertex_filters(pk)
-
-    def _add_vertex_functions(self, vertex_pk: Tuple):
-        for vf_pk, row in self.loader.db['vertex_functions'].items():
-            # Связь по vertex_id (индекс 2 в PK)
-            if str(vf_pk[2]) == str(vertex_pk[2]):
-                if vf_pk not in self.context['vertex_functions']:
-                    self.context['vertex_functions'].add(vf_pk)
-                    self._scan_formula(row.get('calculation_func'))
-                    self._scan_formula(row.get('aggregation_func'))
-                    # Ссылка на свойство сущности
-                    self._find_and_add_property(vf_pk[3], vf_pk[4])
-
-    def _add_vertex_filters(self, vertex_pk: Tuple):
-        for f_pk, row in self.loader.db['filters'].items():
-            if str(f_pk[2]) == str(vertex_pk[2]):
-                 if f_pk not in self.context['filters']:
-                    self.context['filters'].add(f_pk)
-                    self._scan_json_config(row.get('config'))
-
-    def _find_and_add_table_by_id(self, table_id: str):
-        found_pk = None
-        for pk in self.loader.db['tables']:
-            if str(pk[2]) == str(table_id):
-                found_pk = pk
-                break 
-        if found_pk:
-            if found_pk not in self.context['tables']:
-                self.context['tables'].add(found_pk)
-                self._add_table_fields(found_pk)
-
-    def _add_table_fields(self, table_pk: Tuple):
-        for tf_pk, row in self.loader.db['table_fields'].items():
-             if str(tf_pk[2]) == str(table_pk[2]):
-                 self.context['table_fields'].add(tf_pk)
-                 self._find_and_add_property(tf_pk[3], tf_pk[4])
-
-    def _process_constraints_list(self, constraints: Any):
-        if not constraints or not isinstance(constraints, list): return
-        for cid in constraints: self._find_and_add_constraint(int(cid))
-
-    def _find_and_add_constraint(self, cid: int):
-        # Обычные constraints
-        for cpk in self.loader.db['constraints']:
-            if int(cpk[2]) == cid:
-                if cpk not in self.context['constraints']:
-                    self.context['constraints'].add(cpk)
-                    row = self.loader.db['constraints'][cpk]
-                    self._scan_json_config(row.get('config'))
-                    self._scan_formula(row.get('condition'))
-                    if row.get('entity_type') and row.get('property_id'):
-                        self._find_and_add_property(row['entity_type'], row['property_id'])
-                return
-        # Составные constraints
-        for cpk in self.loader.db['composed_constraints']:
-            if int(cpk[2]) == cid:
-                if cpk not in self.context['composed_constraints']:
-                    self.context['composed_constraints'].add(cpk)
-                    row = self.loader.db['composed_constraints'][cpk]
-                    self._process_constraints_list(row.get('constraints'))
-                    self._scan_formula(row.get('condition'))
-                return
+        nodes += self._constraint_list_nodes(self._value('vertices', pk, 'constraints'))
+        nodes += self._json_nodes(conf)
+        # Функции и фильтры вершины: связь по vertex_id (индекс 2 в PK)
+        nodes += [('vertex_functions', vf_pk) for vf_pk in self.loader.lookup('vertex_functions', ('vertex_id',), pk[2])]
+        nodes += [('filters', f_pk) for f_pk in self.loader.lookup('filters', ('vertex_id',), pk[2])]
+        return nodes
+
+    def _expand_vertex_function(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        nodes = self._formula_nodes(self._value('vertex_functions', pk, 'calculation_func'))
+        nodes += self._formula_nodes(self._value('vertex_functions', pk, 'aggregation_func'))
+        # Ссылка на свойство сущности
+        nodes += self._property_nodes(pk[3], pk[4])
+        return nodes
+
+    def _expand_filter(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        return self._json_nodes(self._row_json('filters', pk, 'config'))
+
+    def _expand_table(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        return [('table_fields', tf_pk) for tf_pk in self.loader.lookup('table_fields', ('table_id',), pk[2])]
+
+    def _expand_table_field(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        return self._property_nodes(pk[3], pk[4])
+
+    def _expand_constraint(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        nodes = self._json_nodes(self._row_json('constraints', pk, 'config'))
+        nodes += self._formula_nodes(self._value('constraints', pk, 'condition'))
+        entity_type = self._value('constraints', pk, 'entity_type')
+        property_id = self._value('constraints', pk, 'property_id')
+        if entity_type and property_id:
+            nodes += self._property_nodes(entity_type, property_id)
+        return nodes
+
+    def _expand_composed_constraint(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        nodes = self._constraint_list_nodes(self._value('composed_constraints', pk, 'constraints'))
+        nodes += self._formula_nodes(self._value('composed_constraints', pk, 'condition'))
+        return nodes
+
+    def _expand_limitation(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        # У limitation внутри формулы
+        return (self._formula_nodes(self._value('limitation', pk, 'total_limit'))
+                + self._formula_nodes(self._value('limitation', pk, 'group_limit')))
+
+    def _expand_property(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        # Родительская сущность свойства (с fallback на глобальный тенант)
+        ns, tenant, entity_type, _ = pk
+        nodes = self._entity_nodes((ns, tenant, entity_type))
+        nodes += self._formula_nodes(self._value('entity_properties', pk, 'calculation_func'))
+        nodes += self._formula_nodes(self._value('entity_properties', pk, 'aggregation_func'))
+        return nodes
+
+    def _expand_entity(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        # Если сущность составная (Composed), добавляем родителя
+        return [('composed_entities', c_pk) for c_pk in self.loader.lookup('composed_entities', ('composed_entity',), pk[2])]
+
+    def _expand_composed_entity(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        parent_type = pk[3]
+        ns, tenant = pk[0], pk[1]
+        candidates = [(ns, tenant, parent_type), (ns, '', parent_type)]
+        for cand in candidates:
+            if cand in self.loader.db['entities']:
+                return [('entities', cand)] + self._all_property_nodes(cand[2])
+        return []
 
-    def _scan_json_config(self, config_obj: Any):
+    # --- Поиск узлов по ссылкам ---
+
+    def _first_node(self, table: str, fields: Tuple[str, ...], key: Any) -> List[Tuple[str, Tuple]]:
+        """Первая строка с таким id (edges, vertices, tables ссылаются на одну строку)."""
+        for pk in self.loader.lookup(table, fields, key):
+            return [(table, pk)]
+        return []
+
+    def _dataset_nodes(self, dataset_id: Any) -> List[Tuple[str, Tuple]]:
+        return [('datasets', pk) for pk in self.loader.lookup('datasets', ('dataset_id',), dataset_id)]
+
+    def _constraint_list_nodes(self, constraints: Any) -> List[Tuple[str, Tuple]]:
+        if not constraints or not isinstance(constraints, list): return []
+        nodes = []
+        for cid in constraints:
+            # Сначала обычные constraints, затем составные
+            cid_str = str(int(cid))
+            nodes += (self._first_node('constraints', ('constraint_id',), cid_str)
+                      or self._first_node('composed_constraints', ('constraint_id',), cid_str))
+        return nodes
+
+    def _json_nodes(self, data: Any) -> List[Tuple[str, Tuple]]:
             """Рекурсивно ищет ссылки на сущности, параметры и т.д. внутри JSON."""
-            data = self._get_json(config_obj)
-            if not data: return
+            nodes = []
+            if not data: return nodes
             
             def recursive_search(obj):
                 if isinstance(obj, dict):
                     if 'entity' in obj and 'property' in obj:
-                        self._find_and_add_property(obj['entity'], obj['property'])
+                        nodes.extend(self._property_nodes(obj['entity'], obj['property']))
                     if 'valueExpr' in obj:
-                        self._scan_formula(obj['valueExpr'])
+                        nodes.extend(self._formula_nodes(obj['valueExpr']))
                     if 'parameter' in obj:
-                        self._find_and_add_parameter(obj['parameter'])
+                        nodes.extend(self._parameter_nodes(obj['parameter']))
                     if 'dataset' in obj:
-                        self.resolve_by_dataset(obj['dataset'])
+                        nodes.extend(self._dataset_nodes(obj['dataset']))
                     
                     for key in ['aggregation', 'limitation', 'ordering']:
                         if key in obj:
-                            self._find_and_add_obj(key, obj[key])
+                            nodes.extend((key, pk) for pk in self.loader.lookup(key, (f'{key}_id',), str(obj[key])))
 
                     if 'table' in obj:
-                        self._find_and_add_table_by_id(obj['table'])
+                        nodes.extend(self._first_node('tables', ('table_id',), str(obj['table'])))
                         
                     for k, v in obj.items():
                         recursive_search(v)
@@ -259,119 +912,59 @@ class ContextResolver:
                     for item in obj: recursive_search(item)
                     
             recursive_search(data)
+            return nodes
 
-    def _find_and_add_parameter(self, param_id: str):
-        for pk in self.loader.db['parameters']:
-            if str(pk[2]) == str(param_id): 
-                self.context['parameters'].add(pk)
+    def _parameter_nodes(self, param_id: Any) -> List[Tuple[str, Tuple]]:
+        return [('parameters', pk) for pk in self.loader.lookup('parameters', ('parameter_id',), str(param_id))]
 
-    def _find_and_add_obj(self, table: str, obj_id: str):
-        """Универсальный метод добавления объекта по ID."""
-        for pk in self.loader.db[table]:
-            if str(pk[-1]) == str(obj_id): 
-                if pk not in self.context[table]:
-                    self.context[table].add(pk)
-                    
-                    row = self.loader.db[table][pk]
-                    # Если добавляем limitation, нужно просканировать формулы внутри
-                    if table == 'limitation':
-                        self._scan_formula(row.get('total_limit'))
-                        self._scan_formula(row.get('group_limit'))
-
-    def _scan_formula(self, formula: Optional[str]):
-        """Парсит формулы для поиска зависимостей (Entity.Property, {param})."""
-        if not formula: return
-        
-        # 1. SQL-style: Entity.Property
-        matches = self.prop_regex.findall(formula)
-        for entity_type, prop_id in matches:
-            if self._is_valid_property(entity_type, prop_id):
-                self._find_and_add_property(entity_type, prop_id)
-        
-        # 2. SQL-style Params: {param}
-        params = self.param_regex.findall(formula)
+    def _formula_nodes(self, formula: Optional[str]) -> List[Tuple[str, Tuple]]:
+        """
+        Зависимости формулы (Entity.Property, {param}, Java-параметры).
+        Текст формулы разобран загрузчиком заранее, здесь только поиск узлов.
+        """
+        if not formula: return []
+        props, params = self.loader.formula_refs(formula)
+        nodes = []
+        for entity_type, prop_id in props:
+            nodes += self._property_nodes(entity_type, prop_id)
         for p_id in params:
-            self._find_and_add_parameter(p_id)
+            nodes += self._parameter_nodes(p_id)
+        return nodes
 
-        # 3. Java-style Params: param != null
-        self._scan_java_condition(formula)
+    def _is_valid_property(self, entity: str, prop: str) -> bool:
+        return bool(self.loader.lookup('entity_properties', ('entity_type', 'property_id'), (entity, prop)))
 
-    def _scan_java_condition(self, condition: str):
-        """Ищет параметры, используемые без фигурных скобок (Java syntax)."""
-        words = re.findall(r'\b([a-zA-Z_][a-zA-Z0-9_]*)\b', condition)
-        ignore_keywords = {'null', 'true', 'false', 'equals', 'not', 'and', 'or', 'if', 'else', 'return'}
-        
-        candidates = set(words) - ignore_keywords
-        if not candidates: return
+    def _property_nodes(self, entity: Any, prop: Any) -> List[Tuple[str, Tuple]]:
+        return [('entity_properties', pk) for pk in self.loader.lookup('entity_properties', ('entity_type', 'property_id'), (entity, prop))]
 
-        # Проверяем кандидатов в базе параметров
-        for param_id in candidates:
-             found = False
-             for pk in self.loader.db['parameters']:
-                 if pk[2] == param_id:
-                     self.context['parameters'].add(pk)
-                     found = True
+    def _all_property_nodes(self, entity_type: str) -> List[Tuple[str, Tuple]]:
+        return [('entity_properties', pk) for pk in self.loader.lookup('entity_properties', ('entity_type',), entity_type)]
 
-    def _is_valid_property(self, entity: str, prop: str) -> bool:
-        for pk in self.loader.db['entity_properties']:
-            if pk[2] == entity and pk[3] == prop: return True
-        return False
-
-    def _find_and_add_property(self, entity: str, prop: str):
-        for pk, row in self.loader.db['entity_properties'].items():
-            if pk[2] == entity and pk[3] == prop:
-                if pk not in self.context['entity_properties']:
-                    self.context['entity_properties'].add(pk)
-                    self._add_entity_from_property_pk(pk)
-                    self._scan_formula(row.get('calculation_func'))
-                    self._scan_formula(row.get('aggregation_func'))
-
-    def _add_entity_from_property_pk(self, prop_pk: Tuple):
-        """Добавляет родительскую сущность для свойства."""
-        ns, tenant, entity_type, _ = prop_pk
-        target_pk = (ns, tenant, entity_type)
-        if target_pk in self.loader.db['entities']:
-            self._add_entity_pk_direct(target_pk)
-            return
-        # Fallback на глобальный тенант (если пусто)
-        if tenant != '':
-            fallback_pk = (ns, '', entity_type)
-            if fallback_pk in self.loader.db['entities']:
-                self._add_entity_pk_direct(fallback_pk)
-
-    def _add_entity(self, pk: Tuple):
+    def _entity_nodes(self, pk: Tuple) -> List[Tuple[str, Tuple]]:
+        """Сущность по PK; если её нет у тенанта — fallback на глобальный тенант ('')."""
         if pk in self.loader.db['entities']:
-            self._add_entity_pk_direct(pk)
-        else:
-            if pk[1] != '':
-                fallback = (pk[0], '', pk[2])
-                if fallback in self.loader.db['entities']:
-                    self._add_entity_pk_direct(fallback)
-
-    def _add_entity_pk_direct(self, pk: Tuple):
-        if pk not in self.context['entities']:
-            self.context['entities'].add(pk)
-            # Если сущность составная (Composed), добавляем родителя
-            self._check_composed(pk[2])
-
-    def _add_all_properties_for_entity(self, entity_pk: Tuple):
-        for pk, row in self.loader.db['entity_properties'].items():
-            if pk[2] == entity_pk[2]:
-                self._find_and_add_property(pk[2], pk[3])
-
-    def _check_composed(self, entity_type: str):
-        for pk, row in self.loader.db.get('composed_entities', {}).items():
-            if pk[2] == entity_type:
-                if pk not in self.context['composed_entities']:
-                    self.context['composed_entities'].add(pk)
-                    parent_type = pk[3]
-                    ns, tenant = pk[0], pk[1]
-                    candidates = [(ns, tenant, parent_type), (ns, '', parent_type)]
-                    for cand in candidates:
-                        if cand in self.loader.db['entities']:
-                            self._add_entity_pk_direct(cand)
-                            self._add_all_properties_for_entity(cand)
-                            break
+            return [('entities', pk)]
+        if pk[1] != '':
+            fallback = (pk[0], '', pk[2])
+            if fallback in self.loader.db['entities']:
+                return [('entities', fallback)]
+        return []
+
+    def _value(self, table: str, pk: Tuple, col: str) -> Any:
+        """
+        Одна колонка строки. В режиме 'arrow' читается только эта ячейка (через смещение PK),
+        без сборки всей строки: раскрытию узла нужны лишь колонки-ссылки.
+        """
+        return self.loader.get_value(table, pk, col)
+
+    def _row_json(self, table: str, pk: Tuple, col: str) -> Any:
+        """Аналог _get_json для колонки строки: текст JSON разбирается один раз на загрузчик."""
+        raw = self.loader.get_value(table, pk, col)
+        if isinstance(raw, str):
+            try: return self.loader.get_json(table, pk, col)
+            except ValueError: return None
+        return self._get_json(raw)
+
     def _get_json(self, obj: Any) -> Any:
         if isinstance(obj, dict): return obj
         if isinstance(obj, str):
@@ -379,49 +972,499 @@ class ContextResolver:
             except: return None
         return None
 
+class WorklistResolver(ContextResolver):
+    """
+    Тот же обход графа, что у ContextResolver, но без рекурсии: узлы раскрываются из явной
+    очереди волнами, и каждая волна сгруппирована по таблицам. Глубокие цепочки
+    Dataset -> Vertex -> Dataset -> ... не упираются в лимит рекурсии Python, а для
+    простых связей (tables, table_fields, entities) вся пачка PK ищется в индексе разом (lookup_many).
+
+    Результат (context) совпадает с ContextResolver: узлы и их зависимости те же,
+    меняется только порядок раскрытия.
+    """
+    def __init__(self, loader: DbDataLoader):
+        super().__init__(loader)
+        # Раскрытие сразу пачки PK одной таблицы. Для остальных таблиц — _expanders по одной строке.
+        self._batch_expanders = {
+            'tables': self._expand_tables_batch,
+            'table_fields': self._expand_table_fields_batch,
+            'entities': self._expand_entities_batch,
+        }
+
+    def resolve_by_dataset(self, dataset_id: str) -> bool:
+        nodes = self.dataset_root(dataset_id)
+        self._run(nodes)
+        return bool(nodes)
+
+    def resolve_by_entity(self, entity_type: str) -> bool:
+        nodes = self.entity_root(entity_type)
+        self._run(nodes)
+        return bool(nodes)
+
+    # --- Обход графа ---
+
+    def _add(self, table: str, pk: Tuple):
+        self._run([(table, pk)])
+
+    def _run(self, nodes: Iterable[Tuple[str, Tuple]]) -> None:
+        """Добавляет узлы в контекст и раскрывает всё достижимое из них, волна за волной."""
+        frontier: Dict[str, List[Tuple]] = defaultdict(list)
+        self._push(nodes, frontier)
+        while frontier:
+            wave, frontier = frontier, defaultdict(list)
+            for table, pks in wave.items():
+                self._push(self.successors_many(table, pks), frontier)
+
+    def _push(self, nodes: Iterable[Tuple[str, Tuple]], frontier: Dict[str, List[Tuple]]) -> None:
+        """Новые (еще не посещенные) узлы — в контекст и в следующую волну."""
+        context = self.context
+        for table, pk in nodes:
+            seen = context[table]
+            if pk not in seen:
+                seen.add(pk)
+                frontier[table].append(pk)
+
+    def successors_many(self, table: str, pks: List[Tuple]) -> List[Tuple[str, Tuple]]:
+        """Прямые зависимости пачки строк одной таблицы (объединение successors по каждой)."""
+        expand_batch = self._batch_expanders.get(table)
+        if expand_batch:
+            return expand_batch(pks)
+        expand = self._expanders.get(table)
+        if not expand:
+            return []
+        nodes = []
+        for pk in pks:
+            nodes += expand(pk)
+        return nodes
+
+    # --- Пакетное раскрытие ---
+
+    def _expand_tables_batch(self, pks: List[Tuple]) -> List[Tuple[str, Tuple]]:
+        keys = dict.fromkeys(pk[2] for pk in pks)
+        return [('table_fields', tf_pk) for tf_pk in self.loader.lookup_many('table_fields', ('table_id',), keys)]
+
+    def _expand_table_fields_batch(self, pks: List[Tuple]) -> List[Tuple[str, Tuple]]:
+        keys = dict.fromkeys((pk[3], pk[4]) for pk in pks)
+        return [('entity_properties', p_pk) for p_pk in
+                self.loader.lookup_many('entity_properties', ('entity_type', 'property_id'), keys)]
+
+    def _expand_entities_batch(self, pks: List[Tuple]) -> List[Tuple[str, Tuple]]:
+        keys = dict.fromkeys(pk[2] for pk in pks)
+        return [('composed_entities', c_pk) for c_pk in
+                self.loader.lookup_many('composed_entities', ('composed_entity',), keys)]
+
+# Номера битов, установленных в байте: _BYTE_BITS[0b1010] == (1, 3)
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256))
+
+
+class ClosureIndex:
+    """
+    Предвычисленные транзитивные замыкания зависимостей каждого Dataset и Entity namespace.
+
+    Граф строк строится один раз через ContextResolver.successors, замыкания считаются
+    одним проходом по компонентам сильной связности (Tarjan) и хранятся битовыми масками
+    (int, бит = номер узла). Подбор контекста для любой выборки — OR масок и декодирование;
+    результат совпадает с ContextResolver для тех же корней.
+    Построение можно запустить в фоне (start_background): пока индекс не готов, resolve() возвращает None.
+    """
+
+    def __init__(self, loader: DbDataLoader):
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # Узлы пронумерованы по таблицам: узлы таблицы _tables[i] имеют номера [_bounds[i], _bounds[i + 1])
+        self._tables: List[str] = []
+        self._bounds: List[int] = [0]
+        self._pks: List[Tuple] = []
+        self._mask_bytes = 0
+        # Замыкания корней: { ('dataset', dataset_id) | ('entity', entity_type): маска }
+        self._closures: Dict[Tuple[str, Any], int] = {}
+        self.ready = False
+
+    def start_background(self) -> None:
+        """Запускает build() в фоновом потоке (повторные вызовы ничего не делают)."""
+        with self._lock:
+            if self.ready or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._build_safe, name='closure-index', daemon=True)
+            self._thread.start()
+
+    def _build_safe(self) -> None:
+        try:
+            self.build()
+        except Exception as e:
+            logger.error(f"Не удалось построить индекс замыканий: {e}", exc_info=True)
+
+    def resolve(self, datasets: Iterable[str], entities: Iterable[str]) -> Optional[Dict[str, Set[Tuple]]]:
+        """
+        Контекст для выборки (как ContextResolver.context после resolve_by_*).
+        Returns:
+            None, если индекс еще не построен.
+        """
+        if not self.ready:
+            return None
+        mask = 0
+        for dataset_id in datasets:
+            mask |= self._closures.get(('dataset', dataset_id), 0)
+        for entity_type in entities:
+            mask |= self._closures.get(('entity', entity_type), 0)
+        return self._decode(mask)
+
+    def _decode(self, mask: int) -> Dict[str, Set[Tuple]]:
+        """Превращает маску в { 'table_name': {pk, ...} }."""
+        ids: List[int] = []
+        for byte_no, byte in enumerate(mask.to_bytes(self._mask_bytes, 'little')):
+            if byte:
+                base = byte_no << 3
+                ids.extend([base + bit for bit in _BYTE_BITS[byte]])
+        # Номера упорядочены по таблицам: режем отсортированный список по границам таблиц
+        context: Dict[str, Set[Tuple]] = defaultdict(set)
+        start = 0
+        for table, end_id in zip(self._tables, self._bounds[1:]):
+            end = bisect.bisect_left(ids, end_id, start)
+            if end > start:
+                context[table] = set(map(self._pks.__getitem__, ids[start:end]))
+            start = end
+        return context
+
+    def nbytes(self) -> int:
+        """Память под готовый индекс (маски корней и список узлов)."""
+        return sum(sys.getsizeof(mask) for mask in self._closures.values()) + sys.getsizeof(self._pks)
+
+    def build(self) -> None:
+        """Строит граф namespace и замыкания всех Dataset и Entity."""
+        with self._lock:
+            if self.ready:
+                return
+            started = time.perf_counter()
+            resolver = ContextResolver(self.loader)
+
+            # 1. Граф: узлы (table, pk) с временными номерами и списки прямых зависимостей.
+            # Корни — псевдоузлы без собственного бита, их зависимости — точки входа resolve_by_*.
+            node_id: Dict[Tuple[str, Tuple], int] = {}
+            nodes: List[Tuple[str, Tuple]] = []
+            succ: List[Optional[List[int]]] = []
+
+            def get_id(node: Tuple[str, Tuple]) -> int:
+                i = node_id.get(node)
+                if i is None:
+                    i = node_id[node] = len(nodes)
+                    nodes.append(node)
+                    succ.append(None)
+                return i
+
+            root_keys = [('dataset', pk[2]) for pk in self.loader.db.get('datasets', {})]
+            root_keys += [('entity', pk[2]) for pk in self.loader.db.get('entities', {})]
+            root_keys = list(dict.fromkeys(root_keys))
+            root_succ = [
+                sorted({get_id(n) for n in (resolver.dataset_root(key) if kind == 'dataset' else resolver.entity_root(key))})
+                for kind, key in root_keys
+            ]
+            stack = list(range(len(nodes)))
+            while stack:
+                i = stack.pop()
+                if succ[i] is not None:
+                    continue
+                out = {get_id(n) for n in resolver.successors(*nodes[i])}
+                out.discard(i)
+                succ[i] = list(out)
+                stack.extend(j for j in succ[i] if succ[j] is None)
+
+            node_count = len(nodes)
+            first_root = node_count
+            succ.extend(root_succ)
+
+            # 2. Номера битов: узлы сгруппированы по таблицам (быстрое декодирование)
+            order = sorted(range(node_count), key=lambda i: nodes[i][0])
+            bit_of = [0] * node_count
+            tables: List[str] = []
+            bounds: List[int] = []
+            for bit, i in enumerate(order):
+                bit_of[i] = bit
+                if not tables or tables[-1] != nodes[i][0]:
+                    tables.append(nodes[i][0])
+                    bounds.append(bit)
+            bounds.append(node_count)
+            mask_bytes = (node_count + 7) // 8
+
+            def to_mask(bits: List[int]) -> int:
+                buf = bytearray(mask_bytes)
+                for bit in bits:
+                    buf[bit >> 3] |= 1 << (bit & 7)
+                return int.from_bytes(buf, 'little')
+
+            # 3. Компоненты сильной связности (итеративный Tarjan).
+            # Компоненты появляются в обратном топологическом порядке: зависимости раньше зависящих.
+            comps = self._strongly_connected(succ)
+            comp_of = [0] * len(succ)
+            for c, members in enumerate(comps):
+                for v in members:
+                    comp_of[v] = c
+            comp_succ = []
+            refs = [0] * len(comps)
+            for c, members in enumerate(comps):
+                out = {comp_of[w] for v in members for w in succ[v]}
+                out.discard(c)
+                comp_succ.append(out)
+                for d in out:
+                    refs[d] += 1
+
+            # 4. Замыкание компоненты = её узлы | замыкания зависимостей.
+            # Листья (один узел без зависимостей) маску не хранят — их бит добавляет родитель.
+            # Маска освобождается, как только её использовали все зависящие компоненты.
+            leaf = [len(members) == 1 and not comp_succ[c] for c, members in enumerate(comps)]
+            masks: List[Optional[int]] = [None] * len(comps)
+            closures: Dict[Tuple[str, Any], int] = {}
+            for c, members in enumerate(comps):
+                if leaf[c] and members[0] < first_root:
+                    continue
+                bits = [bit_of[v] for v in members if v < first_root]
+                mask = 0
+                for d in comp_succ[c]:
+                    if leaf[d]:
+                        bits.append(bit_of[comps[d][0]])
+                        continue
+                    mask |= masks[d]
+                    refs[d] -= 1
+                    if refs[d] == 0:
+                        masks[d] = None
+                mask |= to_mask(bits)
+                if members[0] >= first_root:
+                    # Корень — всегда отдельная компонента (на псевдоузлы никто не ссылается)
+                    closures[root_keys[members[0] - first_root]] = mask
+                else:
+                    masks[c] = mask
+
+            self._tables = tables
+            self._bounds = bounds
+            self._pks = [nodes[i][1] for i in order]
+            self._mask_bytes = mask_bytes
+            self._closures = closures
+            self.ready = True
+            logger.info(f"Индекс замыканий построен за {time.perf_counter() - started:.2f} с: "
+                        f"{len(closures)} корней, {node_count} узлов, {len(comps)} компонент")
+
+    @staticmethod
+    def _strongly_connected(succ: List[List[int]]) -> List[List[int]]:
+        """Итеративный алгоритм Тарьяна (без рекурсии: граф namespace может быть глубоким)."""
+        count = len(succ)
+        index = [-1] * count
+        low = [0] * count
+        on_stack = [False] * count
+        stack: List[int] = []
+        comps: List[List[int]] = []
+        counter = 0
+        for start in range(count):
+            if index[start] != -1:
+                continue
+            index[start] = low[start] = counter
+            counter += 1
+            stack.append(start)
+            on_stack[start] = True
+            work = [(start, 0)]
+            while work:
+                v, pos = work[-1]
+                if pos < len(succ[v]):
+                    work[-1] = (v, pos + 1)
+                    w = succ[v][pos]
+                    if index[w] == -1:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, 0))
+                    elif on_stack[w] and index[w] < low[v]:
+                        low[v] = index[w]
+                    continue
+                work.pop()
+                if work and low[v] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[v]
+                if low[v] == index[v]:
+                    members = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        members.append(w)
+                        if w == v:
+                            break
+                    comps.append(members)
+        return comps
+
 # ==========================================
 # 3. OUTPUT GENERATOR (SQL Генерация)
 # ==========================================
 
+# Строковый литерал SQL ('' внутри — экранированная кавычка)
+SQL_LITERAL_RE = re.compile(r"'[^']*(?:''[^']*)*'")
+# Литерал или ссылка на повторяющееся значение (OutputGenerator.expand_values)
+VALUE_TOKEN_RE = re.compile(r"'[^']*(?:''[^']*)*'|@V\d+")
+# Начало блока определений повторяющихся значений и одна его строка
+VALUES_HEAD_RE = re.compile(r"\n(-- context_values \(\d+\)\n)?INSERT INTO context_values ?\(name, ?value\) VALUES")
+VALUES_ROW_RE = re.compile(r"\n?\('(@V\d+)', ?('[^']*(?:''[^']*)*')\)([,;])")
+
+# Пулы для параллельного форматирования строк SQL: {(вид, число воркеров): пул}, создаются при первом обращении
+_RENDER_POOLS: Dict[Tuple[str, int], Executor] = {}
+_RENDER_POOLS_LOCK = threading.Lock()
+
+
+def _render_pool(kind: str, workers: int) -> Executor:
+    """Общий пул процессов ('process') или потоков ('thread') для OutputGenerator."""
+    key = (kind, workers)
+    with _RENDER_POOLS_LOCK:
+        pool = _RENDER_POOLS.get(key)
+        if pool is None:
+            pool_cls = ThreadPoolExecutor if kind == 'thread' else ProcessPoolExecutor
+            pool = _RENDER_POOLS[key] = pool_cls(max_workers=workers)
+        return pool
+
+
+@atexit.register
+def _shutdown_render_pools() -> None:
+    """Останавливает пулы _render_pool (при завершении процесса; следующий вызов создаст пул заново)."""
+    with _RENDER_POOLS_LOCK:
+        pools = list(_RENDER_POOLS.values())
+        _RENDER_POOLS.clear()
+    for pool in pools:
+        pool.shutdown(wait=True)
+
+
+def _sql_null(val: None) -> str:
+    return "null"
+
+
+def _sql_bool(val: bool) -> str:
+    return "true" if val else "false"
+
+
+def _sql_str(val: str) -> str:
+    return "'" + val.replace("'", "''") + "'"
+
+
+def _csv_null(val: None) -> str:
+    return ""
+
+
+def _csv_text(text: str) -> str:
+    """Поле csv: кавычки, только если без них нельзя (пустая строка в кавычках, чтобы отличалась от null)."""
+    if not text or text != text.strip() or any(ch in text for ch in ',"\n\r'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+# Форматирование частых типов значений по точному типу (остальные — OutputGenerator._format_val / _csv_val)
+SQL_VALUE_FORMATTERS: Dict[type, Callable[[Any], str]] = {
+    type(None): _sql_null, bool: _sql_bool, int: str, float: str, str: _sql_str,
+}
+CSV_VALUE_FORMATTERS: Dict[type, Callable[[Any], str]] = {
+    type(None): _csv_null, bool: _sql_bool, int: str, float: str, str: _csv_text,
+}
+
+
+class TablePlan(NamedTuple):
+    """
+    План рендеринга таблицы, скомпилированный из FIELD_MAPPING под колонки загрузчика (OutputGenerator._table_plan).
+    maskers — только маскируемые колонки в порядке вывода: (индекс колонки, колонка, функция маскирования).
+    """
+    cols: List[str]
+    maskers: Tuple[Tuple[int, str, Callable[[str, Tuple, str, Any], Any]], ...]
+    complex_table: bool
+
+
+def _format_rows(rows: List[Tuple[str, bool, List[str], List[Any]]]) -> List[Optional[str]]:
+    """
+    Вторая фаза параллельной генерации: строки по уже замаскированным значениям (None — ошибка).
+    rows: [(формат, таблица из COMPLEX_TABLES, колонки, значения)].
+    """
+    result = []
+    for output_format, complex_table, cols, vals in rows:
+        try:
+            result.append(OutputGenerator._format_row(complex_table, vals, output_format, cols))
+        except Exception:
+            result.append(None)
+    return result
+
+
 class OutputGenerator:
     """
     Класс, отвечающий за формирование INSERT SQL выражений на основе собранного контекста.
     Также применяет маскирование, если передан masker.
+    SQL каждой таблицы запоминается: generate_sql(changed_tables) перегенерирует только изменившиеся таблицы.
+    generate_sql_dual() за один обход строк строит и маскированный, и оригинальный SQL.
     """
-    def __init__(self, loader: DbDataLoader, context: Dict[str, Set[tuple]], masker: Optional[ContextMasker] = None):
+    # Порядок вставки важен для целостности (FK constraint logic)
+    TABLE_ORDER = [
+        'namespaces', 'tenants', 'clients',
+        'parameters',
+        'entities', 'composed_entities', 'entity_properties',
+        'tables', 'table_fields',
+        'aggregation', 'limitation', 'ordering', 'group_by', 'order_by',
+        'constraints', 'composed_constraints',
+        'vertices', 'vertex_functions', 'edges', 'filters',
+        'datasets'
+    ]
+    # Таблицы с длинными значениями (формулы) выводятся построчно
+    COMPLEX_TABLES = ['entity_properties', 'vertex_functions', 'limitation']
+    # Строк в одной задаче параллельного форматирования
+    RENDER_CHUNK_ROWS = 500
+    # Форматы контекста:
+    # sql — INSERT с комментариями и построчным выводом длинных строк (по умолчанию);
+    # sql_min — те же INSERT одной строкой на таблицу, без комментариев и пробелов;
+    # sparse — как sql_min, но null-колонки не перечисляются: строки с одинаковым набором
+    #          заполненных колонок идут одним INSERT, пропущенные колонки получают DEFAULT (null);
+    # csv — на таблицу комментарий с именем, строка колонок и строки значений (пустое поле — null).
+    OUTPUT_FORMATS = ('sql', 'sql_min', 'sparse', 'csv')
+    # Разделитель колонок и VALUES в строке формата sparse (в именах колонок не встречается)
+    SPARSE_SEP = '\x1f'
+    # Таблица определений повторяющихся значений (дедупликация, dedupe_min_chars > 0)
+    VALUES_TABLE = 'context_values'
+    # Таблицы, маскированные строки которых зависят от текущего словаря маскера (формулы и JSON
+    # маскируют Entity.Property, имена таблиц и т.п., только если они уже зарегистрированы).
+    # Маски остальных колонок (категории, ARRAY_PATH) от словаря не зависят.
+    DICTIONARY_TABLES = frozenset(
+        table for table, actions in FIELD_MAPPING.items() if {'JSON', 'FORMULA'} & set(actions.values())
+    )
+
+    def __init__(
+        self,
+        loader: DbDataLoader,
+        context: Dict[str, Set[tuple]],
+        masker: Optional[ContextMasker] = None,
+        workers: int = SQL_RENDER_WORKERS,
+        output_format: str = CONTEXT_FORMAT,
+        dedupe_min_chars: int = CONTEXT_DEDUPE_MIN_CHARS
+    ):
+        if output_format not in self.OUTPUT_FORMATS:
+            raise ValueError(f"Неизвестный формат контекста: {output_format} (доступны {', '.join(self.OUTPUT_FORMATS)})")
         self.loader = loader
         self.context = context
         self.masker = masker
-        
-        # Ссылка на конфигурацию маскирования (из schema_config.py или hardcoded)
-        # Здесь продублируем для наглядности логики, но в идеале импортировать.
-        self.field_mapping = {
-            'tenants': {'tenant_id': 'TEN', 'tenant_name': 'TEN_NAME'},
-            'entities': {'tenant_id': 'TEN', 'entity_type': 'ENT', 'entity_name': 'ENT_NAME'},
-            'composed_entities': {'tenant_id': 'TEN', 'composed_entity': 'ENT', 'entity_type': 'ENT'},
-            'entity_properties': {
-                'tenant_id': 'TEN', 'entity_type': 'ENT', 'property_id': 'P',
-                'calculation_func': 'FORMULA', 'aggregation_func': 'FORMULA', 'conversion_func': 'FORMULA'
-            },
-            'parameters': {'tenant_id': 'TEN', 'parameter_id': 'PARAM', 'request_path': 'ARRAY_PATH'},
-            'datasets': {'tenant_id': 'TEN', 'dataset_id': 'DS', 'entity_type': 'ENT', 'config': 'JSON'},
-            'tables': {'tenant_id': 'TEN', 'table_id': 'TBL', 'physical_name': 'DB.TBL'},
-            'table_fields': {'tenant_id': 'TEN', 'table_id': 'TBL', 'entity_type': 'ENT', 'property_id': 'P', 'field_name': 'COL'},
-            'vertices': {'tenant_id': 'TEN', 'config': 'JSON', 'constraints': 'JSON'},
-            'edges': {'tenant_id': 'TEN', 'condition': 'FORMULA', 'config': 'JSON'},
-            'vertex_functions': {'tenant_id': 'TEN', 'entity_type': 'ENT', 'property_id': 'P', 'calculation_func': 'FORMULA', 'aggregation_func': 'FORMULA'},
-            'constraints': {'tenant_id': 'TEN', 'entity_type': 'ENT', 'property_id': 'P', 'config': 'JSON', 'condition': 'FORMULA'},
-            'composed_constraints': {'tenant_id': 'TEN', 'condition': 'FORMULA'},
-            'filters': {'tenant_id': 'TEN', 'config': 'JSON'},
-            'aggregation': {'tenant_id': 'TEN', 'aggregation_id': 'AGG'},
-            'limitation': {'tenant_id': 'TEN', 'limitation_id': 'LIM', 'total_limit': 'FORMULA'},
-            'ordering': {'tenant_id': 'TEN', 'ordering_id': 'ORD'},
-            'group_by': {'tenant_id': 'TEN', 'entity_type': 'ENT', 'property_id': 'P'},
-            'order_by': {'tenant_id': 'TEN', 'entity_type': 'ENT', 'property_id': 'P'}
-        }
+        self.output_format = output_format
+        # Минимальная длина литерала для дедупликации (0 — выключена). В csv нет однозначной
+        # границы литерала, ссылку нельзя отличить от значения — там дедупликация не выполняется.
+        self.dedupe_min_chars = dedupe_min_chars if output_format != 'csv' else 0
+        # Воркеров для полной генерации (generate_sql/iter_sql без changed_tables); 1 — последовательно
+        self.workers = workers
+        # SQL таблиц с прошлой генерации: { 'table_name': [строки] } и VALUES их строк { 'table_name': {pk: str} }
+        self._table_blocks: Dict[str, List[str]] = {}
+        self._table_rows: Dict[str, Dict[Tuple, Optional[str]]] = {}
+        # То же для оригинального SQL (без маскирования), который строит generate_sql_dual
+        self._table_blocks_original: Dict[str, List[str]] = {}
+        self._table_rows_original: Dict[str, Dict[Tuple, Optional[str]]] = {}
+        # Состояние маскера (epoch, version), которому соответствуют запомненные маскированные строки
+        self._masker_state: Optional[Tuple[int, int]] = None
+        # Общий кэш отрендеренных строк (между генераторами и сессиями), None — без кэша
+        self.row_cache: Optional[RowFragmentCache] = RowFragmentCache.instance() if ROW_CACHE_SIZE > 0 else None
+        # Оценки токенов обвязки таблиц (table_tokens)
+        self._token_costs: Dict[str, int] = {}
+        # Скомпилированные планы рендеринга таблиц (_table_plan): { 'table_name': TablePlan }
+        self._plans: Dict[str, TablePlan] = {}
 
-    def _ensure_tenants_exist(self):
-        """Гарантирует, что определения тенантов попадут в SQL, если они используются в других таблицах."""
+    def _ensure_tenants_exist(self) -> bool:
+        """
+        Гарантирует, что определения тенантов попадут в SQL, если они используются в других таблицах.
+        Returns:
+            bool: Изменился ли набор тенантов с прошлого вызова (для инкрементальной генерации).
+        """
         used_ids = set()
         for table, pks in self.context.items():
             if table in ['namespaces', 'tenants', 'clients']: continue
@@ -429,15 +1472,17 @@ class OutputGenerator:
                 if len(pk) >= 2 and pk[1]: # pk[1] is tenant_id
                     used_ids.add(pk[1])
         
-        if 'tenants' not in self.context:
-            self.context['tenants'] = set()
-            
         used_ids.add('') # Дефолтный тенант
-            
+        
+        tenants = set()
         for tid in used_ids:
             pk = (tid,)
             if pk in self.loader.db.get('tenants', {}):
-                self.context['tenants'].add(pk)
+                tenants.add(pk)
+
+        changed = tenants != self.context.get('tenants')
+        self.context['tenants'] = tenants
+        return changed
 
     def _prefill_known_parameters(self):
         """Собирает известные параметры для маскера (чтобы он видел их в Java-формулах)."""
@@ -454,108 +1499,689 @@ class OutputGenerator:
         for pid in param_ids:
             self.masker.register(pid, 'PARAM')
 
-    def generate_sql(self) -> str:
-        """Генерирует финальный SQL скрипт."""
-        lines = []
-        lines.append("SET SEARCH_PATH to qe_config;\n")
-        
+    def generate_sql(self, changed_tables: Optional[Iterable[str]] = None) -> str:
+        """
+        Генерирует финальный SQL скрипт.
+
+        Args:
+            changed_tables: Таблицы, набор PK которых изменился с прошлого вызова (ContextResolver.sync).
+                Остальные таблицы берутся из прошлой генерации этого же объекта без повторного рендеринга,
+                а в изменившихся рендерятся только новые строки. None — сгенерировать все таблицы заново.
+        """
+        return "".join(self.iter_sql(changed_tables))
+
+    def iter_sql(self, changed_tables: Optional[Iterable[str]] = None) -> Iterator[str]:
+        """
+        Тот же SQL, что generate_sql, по частям: заголовок скрипта, затем блок каждой непустой таблицы.
+        Таблица рендерится, когда до нее доходит итерация, поэтому большой контекст можно писать
+        в файл или поток, не собирая весь скрипт в памяти. "".join(iter_sql()) == generate_sql().
+
+        ⚠️ С дедупликацией (dedupe_min_chars > 0, CONTEXT_DEDUPE_MIN_CHARS) поток не ограничивает память:
+        таблица context_values идет перед таблицами, а собрать ее можно только по всем строкам, поэтому
+        до первого блока таблицы рендерятся и держатся в памяти все блоки — пиковая память как у generate_sql.
+        """
+        yield self._script_header()
+        blocks: Iterable[List[str]] = (block for block, _ in self._iter_blocks(changed_tables, dual=False))
+        if self.dedupe_min_chars:
+            logger.debug("iter_sql с дедупликацией: все блоки таблиц строятся до выдачи первого")
+            blocks = self._dedupe(list(blocks))
+        for block in blocks:
+            if block:
+                yield "\n" + "\n".join(block)
+
+    def generate_sql_dual(self, changed_tables: Optional[Iterable[str]] = None) -> Tuple[str, str]:
+        """
+        Маскированный и оригинальный SQL за один обход контекста: сортировка PK, колонки таблиц
+        и форматирование значений, которые маскирование не изменило, общие для обоих вариантов.
+        Результат совпадает с generate_sql() этого генератора и генератора без маскера.
+
+        Returns:
+            Tuple[str, str]: (маскированный SQL, оригинальный SQL)
+        """
+        lines = [self._script_header()]
+        original_lines = list(lines)
+        pairs = list(self._iter_blocks(changed_tables, dual=True))
+        blocks = [block for block, _ in pairs]
+        original_blocks = [original_block for _, original_block in pairs]
+        if self.dedupe_min_chars:
+            blocks = self._dedupe(blocks)
+            original_blocks = self._dedupe(original_blocks)
+        for block in blocks:
+            lines.extend(block)
+        for original_block in original_blocks:
+            original_lines.extend(original_block)
+        return "\n".join(lines), "\n".join(original_lines)
+
+    def _dedupe(self, blocks: List[List[str]]) -> List[List[str]]:
+        """
+        Дедупликация: строковые литералы не короче dedupe_min_chars символов (JSON config, формулы),
+        которые встречаются в блоках больше одного раза, заменяются ссылками @V1, @V2, ... (по порядку
+        первого вхождения), а сами значения выводятся один раз таблицей context_values перед остальными.
+        Исходный SQL восстанавливается expand_values().
+        """
+        min_chars = self.dedupe_min_chars
+        counts: Dict[str, int] = {}
+        for block in blocks:
+            for line in block:
+                if len(line) < min_chars:
+                    continue
+                for literal in SQL_LITERAL_RE.findall(line):
+                    if len(literal) >= min_chars:
+                        counts[literal] = counts.get(literal, 0) + 1
+        refs: Dict[str, str] = {}
+        for literal, count in counts.items():
+            if count > 1:
+                refs[literal] = f"@V{len(refs) + 1}"
+        if not refs:
+            return blocks
+
+        def replace(match: re.Match) -> str:
+            literal = match.group(0)
+            return refs.get(literal, literal)
+
+        deduped = [
+            [SQL_LITERAL_RE.sub(replace, line) if len(line) >= min_chars else line for line in block]
+            for block in blocks
+        ]
+        cols = ['name', 'value']
+        values_rows = [
+            self._join_row(self.output_format, False, cols, [ref, literal], [f"'{ref}'", literal])
+            for literal, ref in refs.items()
+        ]
+        logger.info(f"Дедупликация: {len(refs)} повторяющихся значений вынесено в {self.VALUES_TABLE}")
+        return [self._table_lines(self.VALUES_TABLE, len(refs), cols, values_rows)] + deduped
+
+    @staticmethod
+    def expand_values(sql: str) -> str:
+        """
+        Точное обратное преобразование дедупликации: убирает блок context_values и подставляет
+        значения вместо ссылок @V<n>. SQL без дедупликации возвращается без изменений.
+        """
+        head = VALUES_HEAD_RE.search(sql)
+        if head is None:
+            return sql
+        values: Dict[str, str] = {}
+        pos = head.end()
+        while True:
+            row = VALUES_ROW_RE.match(sql, pos)
+            if row is None:
+                raise ValueError(f"Некорректный блок context_values (позиция {pos})")
+            values[row.group(1)] = row.group(2)
+            pos = row.end()
+            if row.group(3) == ';':
+                break
+        # В формате sql за блоком таблицы идет пустая строка
+        if head.group(1) and sql.startswith("\n", pos):
+            pos += 1
+
+        def expand(match: re.Match) -> str:
+            token = match.group(0)
+            return values.get(token, token) if token[0] == '@' else token
+
+        return sql[:head.start()] + VALUE_TOKEN_RE.sub(expand, sql[pos:])
+
+    def register_masks(self) -> None:
+        """
+        Регистрирует в маскере все маски контекста в том же порядке, что генерация SQL, но без
+        форматирования строк, — повторяя обход, пока словарь не перестанет меняться: маскирование формул
+        и JSON зависит от уже известных масок. После этого генерация не добавляет масок, и каждая строка
+        маскируется полным словарем контекста. Так маскированный промпт строят и generate_final_prompts,
+        и потоковый iter_final_prompt (там системный промпт идет перед SQL).
+
+        ⚠️ Результат отличается от однопроходной generate_sql на свежем маскере: имя, которое впервые
+        встречается ниже по контексту (например, сущность в JSON датасета), маскируется и в формулах выше
+        ('sum(person.salary)' -> 'sum(ENT_2.P_2)' вместо открытого текста), и в словаре появляются маски
+        для таких свойств. Обычно хватает двух обходов; второй (проверочный) берет формулы и JSON из кэшей
+        маскера. Закреплено тестом test_final_prompt.py::test_late_masks_golden.
+        """
         self._ensure_tenants_exist()
         self._prefill_known_parameters()
+        masker = self.masker
+        if not masker:
+            return
+        version = None
+        while version != masker.version:
+            version = masker.version
+            self._register_masks_once()
+
+    def _register_masks_once(self) -> None:
+        """Один обход register_masks: маскирующие функции колонок для всех строк контекста."""
+        for table in self.TABLE_ORDER:
+            pks = self.context.get(table)
+            if not pks:
+                continue
+            plan, sorted_pks = self._table_header(table, pks)
+            rows = self.loader.db[table]
+            for pk in sorted_pks:
+                if pk not in rows:
+                    continue
+                row = rows[pk]
+                try:
+                    for _, col, mask_fn in plan.maskers:
+                        val = row.get(col)
+                        if val is not None:
+                            mask_fn(table, pk, col, val)
+                except Exception as e:
+                    logger.error(f"Ошибка маскирования строки для {table} pk={pk}: {e}")
+
+    def _iter_blocks(
+        self, changed_tables: Optional[Iterable[str]], dual: bool
+    ) -> Iterator[Tuple[List[str], Optional[List[str]]]]:
+        """
+        Блоки таблиц в порядке TABLE_ORDER: (строки SQL, строки оригинального SQL или None без dual).
+        Общая часть generate_sql, iter_sql и generate_sql_dual.
+
+        При инкрементальной генерации (changed_tables) маскированные строки прошлых вызовов
+        переиспользуются, только пока словарь маскера не изменился: новые маски (например,
+        сущность из добавленного Dataset) должны закрыть имена и в уже показанных формулах и JSON.
+        Поэтому строки DICTIONARY_TABLES рендерятся заново, пока словарь не перестанет меняться, —
+        результат совпадает с полной генерацией с тем же маскером.
+        """
+        tenants_changed = self._ensure_tenants_exist()
+        self._prefill_known_parameters()
+        masker = self.masker
+
+        if changed_tables is None:
+            self._table_blocks.clear()
+            self._table_rows.clear()
+            self._table_blocks_original.clear()
+            self._table_rows_original.clear()
+            # Строки полной генерации маскируются словарем, который растет по ходу обхода:
+            # следующая инкрементальная генерация сверит их с итоговым словарем
+            self._masker_state = (masker.epoch, masker.version) if masker else None
+            if not dual and self.workers > 1:
+                self._render_tables_parallel()
+        else:
+            stale = set(changed_tables)
+            if tenants_changed:
+                stale.add('tenants')
+            for table in stale:
+                self._table_blocks.pop(table, None)
+                self._table_blocks_original.pop(table, None)
+            if masker:
+                if self._masker_state is not None and self._masker_state[0] != masker.epoch:
+                    # Маскер сброшен: прежние маски недействительны во всех таблицах
+                    self._forget_masked(self.TABLE_ORDER)
+                elif self._masker_state != (masker.epoch, masker.version):
+                    self._forget_masked(self.DICTIONARY_TABLES)
+                # Блоки рендерятся заранее: пока рендеринг добавляет маски, зависящие от словаря
+                # строки перерисовываются (число масок конечно, цикл сходится)
+                while True:
+                    version = masker.version
+                    for table in self.TABLE_ORDER:
+                        self._table_block(table, dual)
+                    if masker.version == version:
+                        break
+                    self._forget_masked(self.DICTIONARY_TABLES)
+                self._masker_state = (masker.epoch, masker.version)
+
+        for table in self.TABLE_ORDER:
+            yield self._table_block(table, dual)
+
+    def _table_block(self, table: str, dual: bool) -> Tuple[List[str], Optional[List[str]]]:
+        """Блок таблицы из прошлой генерации или отрендеренный заново (с оригинальным блоком при dual)."""
+        block = self._table_blocks.get(table)
+        original_block = None
+        if dual:
+            original_block = self._table_blocks_original.get(table)
+            if block is None or original_block is None:
+                block, original_block = self._render_table_dual(table)
+                self._table_blocks[table] = block
+                self._table_blocks_original[table] = original_block
+        elif block is None:
+            block = self._table_blocks[table] = self._render_table(table)
+        return block, original_block
+
+    def _forget_masked(self, tables: Iterable[str]) -> None:
+        """Забывает маскированные блоки и строки таблиц (оригинальные от маскера не зависят и остаются)."""
+        for table in tables:
+            self._table_blocks.pop(table, None)
+            self._table_rows.pop(table, None)
+
+    def _table_header(self, table: str, pks: Set[Tuple]) -> Tuple[TablePlan, List[Tuple]]:
+        """План рендеринга таблицы и отсортированные PK контекста."""
+        cols = self.loader.table_cols.get(table, [])
+        if not cols and pks:
+            first = next(iter(pks))
+            cols = list(self.loader.db[table][first].keys())
+        return self._table_plan(table, cols), sorted(list(pks))
+
+    def _table_plan(self, table: str, cols: List[str]) -> TablePlan:
+        """
+        План таблицы: компилируется из FIELD_MAPPING один раз на таблицу (заново — если изменились колонки).
+        Действие колонки (JSON, FORMULA, ARRAY_PATH или категория) выбирается здесь, а не для каждой ячейки.
+        """
+        plan = self._plans.get(table)
+        if plan is None or plan.cols != cols:
+            actions = FIELD_MAPPING.get(table, {})
+            maskers = tuple(
+                (i, col, self._value_masker(actions[col])) for i, col in enumerate(cols) if col in actions
+            )
+            plan = self._plans[table] = TablePlan(list(cols), maskers, table in self.COMPLEX_TABLES)
+        return plan
+
+    def _value_masker(self, action: str) -> Callable[[str, Tuple, str, Any], Any]:
+        """Функция маскирования значения колонки (table, pk, col, val) по действию из FIELD_MAPPING."""
+        if action == 'JSON':
+            return self._mask_json
+        if action == 'FORMULA':
+            return self._mask_formula
+        if action == 'ARRAY_PATH':
+            return self._mask_array_path
+        return functools.partial(self._mask_category, action)
+
+    def _script_header(self) -> str:
+        """Первая строка скрипта (для csv — подсказка о формате вместо SET SEARCH_PATH)."""
+        if self.output_format == 'sql':
+            return "SET SEARCH_PATH to qe_config;\n"
+        if self.output_format == 'csv':
+            return "-- qe_config, CSV: по таблице строка колонок и строки значений, пустое поле — null"
+        return "SET SEARCH_PATH to qe_config;"
+
+    def _table_lines(self, table: str, count: int, cols: List[str], values_rows: List[str]) -> List[str]:
+        """Блок таблицы: для sql — комментарий, INSERT со строками VALUES и пустая строка."""
+        if self.output_format != 'sql':
+            return self._table_lines_compact(table, cols, values_rows)
+        lines = [f"-- {table} ({count})"]
+        if values_rows:
+            header = f"INSERT INTO {table} ({', '.join(cols)}) VALUES"
+            body = ",\n".join(values_rows)
+            lines.append(f"{header}\n{body};")
+        lines.append("")
+        return lines
+
+    def _table_lines_compact(self, table: str, cols: List[str], values_rows: List[str]) -> List[str]:
+        """Блок таблицы в форматах sql_min, sparse и csv (без строк — пустой)."""
+        if not values_rows:
+            return []
+        if self.output_format == 'csv':
+            return [f"-- {table}", ','.join(cols)] + values_rows
+        if self.output_format == 'sql_min':
+            return [f"INSERT INTO {table}({','.join(cols)}) VALUES{','.join(values_rows)};"]
+        # sparse: строки с одинаковым набором заполненных колонок — одним INSERT (в порядке первой строки)
+        groups: Dict[str, List[str]] = {}
+        for row_str in values_rows:
+            columns, values = row_str.split(self.SPARSE_SEP, 1)
+            groups.setdefault(columns, []).append(values)
+        return [f"INSERT INTO {table}({columns}) VALUES{','.join(rows)};" for columns, rows in groups.items()]
+
+    def _render_table(self, table: str) -> List[str]:
+        """Строки SQL одной таблицы: комментарий, INSERT со всеми строками контекста и пустая строка."""
+        pks = self.context.get(table, set())
+        if not pks:
+            self._table_rows.pop(table, None)
+            return []
         
-        # Порядок вставки важен для целостности (FK constraint logic)
-        order = [
-            'namespaces', 'tenants', 'clients',
-            'parameters',
-            'entities', 'composed_entities', 'entity_properties',
-            'tables', 'table_fields',
-            'aggregation', 'limitation', 'ordering', 'group_by', 'order_by',
-            'constraints', 'composed_constraints',
-            'vertices', 'vertex_functions', 'edges', 'filters',
-            'datasets'
-        ]
+        # Получаем колонки таблицы
+        plan, sorted_pks = self._table_header(table, pks)
+        values_rows = []
+        # Строки, уже отрендеренные этим генератором (инкрементальная генерация), не рендерятся повторно
+        previous = self._table_rows.get(table, {})
+        rendered: Dict[Tuple, Optional[str]] = {}
+        
+        for pk in sorted_pks:
+            if pk in previous:
+                row_str = rendered[pk] = previous[pk]
+            else:
+                # ЗАЩИТА ОТ ОШИБОК: Если одна запись битая, пропускаем её, а не падаем
+                try:
+                    row_str = self._render_row_cached(table, pk, plan)
+                except Exception as e:
+                    logger.error(f"Ошибка генерации строки для {table} pk={pk}: {e}")
+                    row_str = None
+                rendered[pk] = row_str
+            if row_str is not None:
+                values_rows.append(row_str)
+        self._table_rows[table] = rendered
         
-        for table in order:
+        return self._table_lines(table, len(pks), plan.cols, values_rows)
+
+    def _render_table_dual(self, table: str) -> Tuple[List[str], List[str]]:
+        """Как _render_table, но одним обходом строк — маскированный и оригинальный блоки таблицы."""
+        pks = self.context.get(table, set())
+        if not pks:
+            self._table_rows.pop(table, None)
+            self._table_rows_original.pop(table, None)
+            return [], []
+
+        plan, sorted_pks = self._table_header(table, pks)
+        values_rows = []
+        original_rows = []
+        previous = self._table_rows.get(table, {})
+        previous_original = self._table_rows_original.get(table, {})
+        rendered: Dict[Tuple, Optional[str]] = {}
+        rendered_original: Dict[Tuple, Optional[str]] = {}
+
+        for pk in sorted_pks:
+            if pk in previous and pk in previous_original:
+                row_str, original_str = previous[pk], previous_original[pk]
+            else:
+                try:
+                    row_str, original_str = self._render_row_dual_cached(table, pk, plan)
+                except Exception as e:
+                    logger.error(f"Ошибка генерации строки для {table} pk={pk}: {e}")
+                    row_str = None
+                    # Оригинальная строка не зависит от маскирования — как у генератора без маскера
+                    try:
+                        original_str = self._render_row(table, pk, plan, mask=False)
+                    except Exception:
+                        original_str = None
+            rendered[pk] = row_str
+            rendered_original[pk] = original_str
+            if row_str is not None:
+                values_rows.append(row_str)
+            if original_str is not None:
+                original_rows.append(original_str)
+        self._table_rows[table] = rendered
+        self._table_rows_original[table] = rendered_original
+
+        return (self._table_lines(table, len(pks), plan.cols, values_rows),
+                self._table_lines(table, len(pks), plan.cols, original_rows))
+
+    def _row_key(self, table: str, pk: Tuple, masked: bool) -> Tuple:
+        """Ключ строки в RowFragmentCache: маскированная строка зависит от состояния словаря маскера."""
+        return (table, pk, masked, self.masker.fingerprint if masked else None, self.output_format)
+
+    def _render_row_cached(self, table: str, pk: Tuple, plan: TablePlan) -> Optional[str]:
+        """_render_row через RowFragmentCache: при попадании маски строки регистрируются из журнала."""
+        cache = self.row_cache
+        if cache is None:
+            return self._render_row(table, pk, plan)
+        masker = self.masker
+        key = self._row_key(table, pk, masker is not None)
+        fragment = cache.get(self.loader, key)
+        if fragment is not None:
+            row_str, journal = fragment
+            for value, category in journal:
+                masker.register(value, category)
+            return row_str
+
+        if masker is None:
+            row_str = self._render_row(table, pk, plan)
+            cache.put(self.loader, key, (row_str, ()))
+            return row_str
+        state = masker.start_journal()
+        try:
+            row_str = self._render_row(table, pk, plan)
+        finally:
+            journal = masker.stop_journal(state)
+        cache.put(self.loader, key, (row_str, tuple(journal)))
+        return row_str
+
+    def _render_row_dual_cached(self, table: str, pk: Tuple, plan: TablePlan) -> Tuple[Optional[str], Optional[str]]:
+        """_render_row_dual через RowFragmentCache (обе строки в кэше — без рендеринга)."""
+        cache = self.row_cache
+        masker = self.masker
+        if cache is None or masker is None:
+            return self._render_row_dual(table, pk, plan)
+        key = self._row_key(table, pk, True)
+        original_key = self._row_key(table, pk, False)
+        fragment = cache.get(self.loader, key)
+        original = cache.get(self.loader, original_key)
+        if fragment is not None and original is not None:
+            row_str, journal = fragment
+            for value, category in journal:
+                masker.register(value, category)
+            return row_str, original[0]
+
+        state = masker.start_journal()
+        try:
+            row_str, original_str = self._render_row_dual(table, pk, plan)
+        finally:
+            journal = masker.stop_journal(state)
+        cache.put(self.loader, key, (row_str, tuple(journal)))
+        cache.put(self.loader, original_key, (original_str, ()))
+        return row_str, original_str
+
+    def _render_row_dual(self, table: str, pk: Tuple, plan: TablePlan) -> Tuple[Optional[str], Optional[str]]:
+        """VALUES одной строки: (маскированная, оригинальная). Не измененные маскированием значения форматируются один раз."""
+        rows = self.loader.db[table]
+        if pk not in rows: return None, None
+        row = rows[pk]
+
+        output_format = self.output_format
+        formatters, fallback = self._value_formatters(output_format)
+        cols = plan.cols
+        original_raw = [row.get(col) for col in cols]
+        original_vals = [formatters.get(val.__class__, fallback)(val) for val in original_raw]
+        original_str = self._join_row(output_format, plan.complex_table, cols, original_raw, original_vals)
+
+        raw = vals = None
+        if self.masker:
+            # Колонки без категории маскирование не меняет
+            for i, col, mask_fn in plan.maskers:
+                val = original_raw[i]
+                if val is None:
+                    continue
+                val_to_write = mask_fn(table, pk, col, val)
+                if val_to_write is not val:
+                    if raw is None:
+                        raw, vals = list(original_raw), list(original_vals)
+                    raw[i] = val_to_write
+                    vals[i] = formatters.get(val_to_write.__class__, fallback)(val_to_write)
+        if raw is None:
+            return original_str, original_str
+        return self._join_row(output_format, plan.complex_table, cols, raw, vals), original_str
+
+    def _render_row(self, table: str, pk: Tuple, plan: TablePlan, mask: bool = True) -> Optional[str]:
+        """VALUES одной строки (None, если строки нет в загрузчике). mask=False — без маскирования."""
+        vals = self._mask_row(table, pk, plan, mask)
+        if vals is None:
+            return None
+        return self._format_row(plan.complex_table, vals, self.output_format, plan.cols)
+
+    def _mask_row(self, table: str, pk: Tuple, plan: TablePlan, mask: bool = True) -> Optional[List[Any]]:
+        """Значения строки для записи в SQL (после маскирования), None — строки нет в загрузчике."""
+        rows = self.loader.db[table]
+        if pk not in rows: return None
+        row = rows[pk]
+
+        vals = [row.get(col) for col in plan.cols]
+        # --- ЛОГИКА МАСКИРОВАНИЯ ---
+        if mask and self.masker:
+            for i, col, mask_fn in plan.maskers:
+                val = vals[i]
+                if val is not None:
+                    vals[i] = mask_fn(table, pk, col, val)
+        return vals
+
+    @staticmethod
+    def _format_row(complex_table: bool, vals: List[Any], output_format: str = 'sql', cols: List[str] = ()) -> str:
+        """Строка таблицы из значений в формате output_format (см. OUTPUT_FORMATS)."""
+        formatters, fallback = OutputGenerator._value_formatters(output_format)
+        formatted = [formatters.get(val.__class__, fallback)(val) for val in vals]
+        return OutputGenerator._join_row(output_format, complex_table, cols, vals, formatted)
+
+    @staticmethod
+    def _value_formatters(output_format: str) -> Tuple[Dict[type, Callable[[Any], str]], Callable[[Any], str]]:
+        """Таблица форматирования частых типов и общий форматтер для остальных значений."""
+        if output_format == 'csv':
+            return CSV_VALUE_FORMATTERS, OutputGenerator._csv_val
+        return SQL_VALUE_FORMATTERS, OutputGenerator._format_val
+
+    @staticmethod
+    def _join_row(output_format: str, complex_table: bool, cols: List[str], vals: List[Any], formatted: List[str]) -> str:
+        """Собирает строку из отформатированных значений (vals — исходные, для пропуска null в sparse)."""
+        # Форматирование вывода SQL
+        if output_format == 'sql':
+            if complex_table:
+                return OutputGenerator._format_row_pretty(formatted)
+            return f"({', '.join(formatted)})"
+        if output_format == 'csv':
+            return ','.join(formatted)
+        if output_format == 'sparse':
+            present = [i for i, val in enumerate(vals) if val is not None]
+            return ','.join(cols[i] for i in present) + OutputGenerator.SPARSE_SEP + \
+                '(' + ','.join(formatted[i] for i in present) + ')'
+        return '(' + ','.join(formatted) + ')'
+
+    # --- Параллельная генерация (SQL_RENDER_WORKERS > 1) ---
+
+    def _render_tables_parallel(self) -> None:
+        """
+        Полная генерация в две фазы, результат байт в байт как у последовательной.
+        1. В порядке TABLE_ORDER и отсортированных PK маскируются значения всех строк (или строка
+           берется из RowFragmentCache) — маски регистрируются в том же порядке, что при
+           последовательной генерации, поэтому нумерация ENT_n та же.
+        2. Форматирование строк (не зависит от маскера) — частями по RENDER_CHUNK_ROWS в пуле
+           SQL_RENDER_EXECUTOR. Заполняет _table_blocks и _table_rows, как _render_table.
+        """
+        cache = self.row_cache
+        masked = self.masker is not None
+        pending: List[Tuple[str, bool, List[str], List[Any]]] = []
+        # Строки, которые после форматирования попадут в RowFragmentCache: (индекс в pending, ключ, журнал)
+        to_cache: List[Tuple[int, Tuple, Tuple[Tuple[str, str], ...]]] = []
+        # Для каждой таблицы: (таблица, колонки, число PK, [(pk, готовая строка или индекс в pending)])
+        layout = []
+
+        for table in self.TABLE_ORDER:
             pks = self.context.get(table, set())
-            if not pks: continue
-            
-            lines.append(f"-- {table} ({len(pks)})")
-            
-            # Получаем колонки таблицы
-            cols = self.loader.table_cols.get(table, [])
-            if not cols and pks:
-                first = next(iter(pks))
-                cols = list(self.loader.db[table][first].keys())
-                
-            table_map = self.field_mapping.get(table, {})
-            sorted_pks = sorted(list(pks))
-            values_rows = []
-            
+            if not pks:
+                self._table_rows.pop(table, None)
+                self._table_blocks[table] = []
+                continue
+            plan, sorted_pks = self._table_header(table, pks)
+            entries = []
             for pk in sorted_pks:
-                # ЗАЩИТА ОТ ОШИБОК: Если одна запись битая, пропускаем её, а не падаем
+                key = self._row_key(table, pk, masked) if cache is not None else None
+                fragment = cache.get(self.loader, key) if cache is not None else None
+                if fragment is not None:
+                    for value, category in fragment[1]:
+                        self.masker.register(value, category)
+                    entries.append((pk, fragment[0]))
+                    continue
+                state = self.masker.start_journal() if masked else None
                 try:
-                    if pk not in self.loader.db[table]: continue
-                    row = self.loader.db[table][pk]
-                    
-                    vals = []
-                    for col in cols:
-                        val = row.get(col)
-                        val_to_write = val
-                        
-                        # --- ЛОГИКА МАСКИРОВАНИЯ ---
-                        if self.masker and val is not None:
-                            action = table_map.get(col)
-                            
-                            if action == 'JSON':
-                                # Парсим -> Маскируем -> Сериализуем обратно
-                                try:
-                                    if isinstance(val, str):
-                                        json_obj = json.loads(val)
-                                        masked_obj = self.masker.mask_json(json_obj)
-                                        val_to_write = json.dumps(masked_obj, ensure_ascii=False)
-                                    elif isinstance(val, (dict, list)):
-                                        masked_obj = self.masker.mask_json(val)
-                                        val_to_write = json.dumps(masked_obj, ensure_ascii=False)
-                                except:
-                                    # Если не парсится JSON, маскируем как текст
-                                    val_to_write = self.masker.mask_text(str(val))
-                                    
-                            elif action == 'FORMULA':
-                                if isinstance(val, str):
-                                    val_to_write = self.masker.mask_formula(val)
-                                    
-                            elif action == 'ARRAY_PATH':
-                                # Обработка SQL-массивов '{a,b}'
-                                arr = self._parse_array(val)
-                                masked_arr = [self.masker.register(x, 'PATH') for x in arr]
-                                val_to_write = masked_arr 
-                                
-                            elif action and action not in ['JSON', 'FORMULA', 'ARRAY_PATH']:
-                                # Прямая замена по категории
-                                if isinstance(val, str) and val:
-                                    val_to_write = self.masker.register(val, action)
-                        
-                        vals.append(self._format_val(val_to_write))
-                    
-                    # Форматирование вывода SQL
-                    complex_tables = ['entity_properties', 'vertex_functions', 'limitation']
-                    if table in complex_tables:
-                        row_str = self._format_row_pretty(vals)
-                    else:
-                        row_str = f"({', '.join(vals)})"
-                    
-                    values_rows.append(row_str)
-                    
+                    vals = self._mask_row(table, pk, plan)
                 except Exception as e:
                     logger.error(f"Ошибка генерации строки для {table} pk={pk}: {e}")
-            
-            if values_rows:
-                header = f"INSERT INTO {table} ({', '.join(cols)}) VALUES"
-                body = ",\n".join(values_rows)
-                lines.append(f"{header}\n{body};")
-            
-            lines.append("")
-            
-        return "\n".join(lines)
+                    entries.append((pk, None))
+                    continue
+                finally:
+                    journal = tuple(self.masker.stop_journal(state)) if masked else ()
+                if vals is None:
+                    if cache is not None:
+                        cache.put(self.loader, key, (None, journal))
+                    entries.append((pk, None))
+                    continue
+                if cache is not None:
+                    to_cache.append((len(pending), key, journal))
+                entries.append((pk, len(pending)))
+                pending.append((self.output_format, plan.complex_table, plan.cols, vals))
+            layout.append((table, plan.cols, len(pks), entries))
+
+        formatted = self._format_pending(pending)
+        if cache is not None:
+            for index, key, journal in to_cache:
+                if formatted[index] is not None:
+                    cache.put(self.loader, key, (formatted[index], journal))
+
+        for table, cols, count, entries in layout:
+            rendered: Dict[Tuple, Optional[str]] = {}
+            values_rows = []
+            for pk, row in entries:
+                if isinstance(row, int):
+                    row = formatted[row]
+                    if row is None:
+                        logger.error(f"Ошибка форматирования строки для {table} pk={pk}")
+                rendered[pk] = row
+                if row is not None:
+                    values_rows.append(row)
+            self._table_rows[table] = rendered
+            self._table_blocks[table] = self._table_lines(table, count, cols, values_rows)
+
+    def _format_pending(self, pending: List[Tuple[str, bool, List[str], List[Any]]]) -> List[Optional[str]]:
+        """Вторая фаза: форматирование строк частями в пуле (одна часть — без пула)."""
+        size = self.RENDER_CHUNK_ROWS
+        chunks = [pending[i:i + size] for i in range(0, len(pending), size)]
+        if len(chunks) <= 1:
+            return _format_rows(pending)
+        pool = _render_pool(SQL_RENDER_EXECUTOR, self.workers)
+        formatted: List[Optional[str]] = []
+        for part in pool.map(_format_rows, chunks):
+            formatted.extend(part)
+        return formatted
+
+    def _mask_json(self, table: str, pk: Tuple, col: str, val: Any) -> Any:
+        """JSON: парсим -> маскируем -> сериализуем обратно."""
+        try:
+            if isinstance(val, str):
+                # Разбор из кэша загрузчика (общий с ContextResolver и другими проходами)
+                json_obj = self.loader.get_json(table, pk, col)
+                return self.masker.mask_json_dumps(json_obj, source=val)
+            elif isinstance(val, (dict, list)):
+                return self.masker.mask_json_dumps(val)
+        except:
+            # Если не парсится JSON, маскируем как текст
+            return self.masker.mask_text(str(val))
+        return val
+
+    def _mask_formula(self, table: str, pk: Tuple, col: str, val: Any) -> Any:
+        if isinstance(val, str):
+            return self.masker.mask_formula(val, row=(table, pk, col))
+        return val
+
+    def _mask_array_path(self, table: str, pk: Tuple, col: str, val: Any) -> Any:
+        """Обработка SQL-массивов '{a,b}'."""
+        arr = self._parse_array(val)
+        return [self.masker.register(x, 'PATH') for x in arr]
+
+    def _mask_category(self, category: str, table: str, pk: Tuple, col: str, val: Any) -> Any:
+        """Прямая замена по категории."""
+        if isinstance(val, str) and val:
+            return self.masker.register(val, category)
+        return val
+
+    # --- Оценка размера в токенах (для ContextResolver.resolve_budgeted) ---
+
+    def base_tokens(self) -> int:
+        """Токены заголовка скрипта (SET SEARCH_PATH или подсказка формата csv)."""
+        return TokenCounter.count_tokens(self._script_header())
+
+    def table_tokens(self, table: str) -> int:
+        """Токены обвязки таблицы в формате output_format: комментарий и заголовок INSERT (без строк)."""
+        cost = self._token_costs.get(table)
+        if cost is None:
+            cols = self.loader.table_cols.get(table, [])
+            if self.output_format == 'sql':
+                frame = f"-- {table} (0)\nINSERT INTO {table} ({', '.join(cols)}) VALUES\n;"
+            elif self.output_format == 'sql_min':
+                frame = f"INSERT INTO {table}({','.join(cols)}) VALUES;"
+            elif self.output_format == 'sparse':
+                # Список колонок sparse входит в строку (row_tokens) — оценка с запасом
+                frame = f"INSERT INTO {table}() VALUES;"
+            else:
+                frame = f"-- {table}\n{','.join(cols)}"
+            cost = self._token_costs[table] = TokenCounter.count_tokens(frame)
+        return cost
+
+    def row_tokens(self, table: str, pk: Tuple) -> int:
+        """
+        Оценка токенов одной строки в формате output_format (значения и разделитель).
+        У генератора с маскером строка рендерится один раз в обоих вариантах (_render_row_dual),
+        а токенизируется только маскированная — она уходит в модель. Оригинальная оценивается
+        по длине: столько же токенов на символ; если маскирование строку не изменило, это та же строка.
+        Берется больший вариант: бюджет должен выдержать и маскированный, и оригинальный промпт.
+        Маскер для оценки — отдельный (не маскер сессии), иначе оценка зарегистрирует маски.
+        """
+        try:
+            cols = self.loader.table_cols.get(table, [])
+            if not cols and pk in self.loader.db.get(table, {}):
+                cols = list(self.loader.db[table][pk].keys())
+            plan = self._table_plan(table, cols)
+            if self.masker is None:
+                row_str, original_str = self._render_row(table, pk, plan), None
+            else:
+                row_str, original_str = self._render_row_dual(table, pk, plan)
+        except Exception as e:
+            logger.error(f"Ошибка оценки строки для {table} pk={pk}: {e}")
+            return 0
+        if row_str is None:
+            return 0
+        tokens = TokenCounter.count_tokens(row_str)
+        if original_str is not None and original_str is not row_str and len(original_str) > len(row_str):
+            tokens = -(-tokens * len(original_str) // len(row_str))
+        return tokens + 1
 
     def _parse_array(self, val: Any) -> List[str]:
         """Парсит строковое представление массива PostgreSQL."""
@@ -576,7 +2202,8 @@ class OutputGenerator:
             return res
         return []
 
-    def _format_val(self, val: Any) -> str:
+    @staticmethod
+    def _format_val(val: Any) -> str:
         """Форматирует значение для вставки в SQL (экранирование кавычек)."""
         if val is None: return "null"
         if isinstance(val, bool): return "true" if val else "false"
@@ -602,7 +2229,22 @@ class OutputGenerator:
             
         return f"'{str(val)}'"
 
-    def _format_row_pretty(self, vals: List[str]) -> str:
+    @staticmethod
+    def _csv_val(val: Any) -> str:
+        """Значение для формата csv: null — пустое поле, кавычки только там, где без них нельзя."""
+        if val is None: return ""
+        if isinstance(val, bool): return "true" if val else "false"
+        if isinstance(val, (int, float)): return str(val)
+        if isinstance(val, list):
+            text = "{" + ", ".join(f'"{x}"' for x in val if x is not None) + "}"
+        elif isinstance(val, dict):
+            text = json.dumps(val, ensure_ascii=False)
+        else:
+            text = str(val)
+        return _csv_text(text)
+
+    @staticmethod
+    def _format_row_pretty(vals: List[str]) -> str:
         """Красивое форматирование VALUES (...) с переносами строк для читаемости."""
         lines = []
         current_line = "  "
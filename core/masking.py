@@ -1,12 +1,87 @@
+import json
 import re
-from collections import defaultdict
-from typing import Dict, Any, Optional, Set, Tuple
+from collections import OrderedDict, defaultdict
+from typing import Dict, Any, List, Optional, Set, Tuple
 
+from config.settings import FORMULA_MAX_CHARS, FORMULA_SCAN_BUDGET, MASKING_CACHE_SIZE
 from utils.logger import setup_logger
 
 # Настраиваем логгер
 logger = setup_logger(__name__)
 
+# Круглые скобки формулы (для оценки глубины вложенности в formula_over_budget)
+_RE_PARENS = re.compile(r'[()]')
+
+
+def _trie_regex(words) -> str:
+    """
+    Регулярное выражение, совпадающее с любым из слов, в виде префиксного дерева:
+    общие префиксы записаны один раз, поэтому проверка в каждой позиции текста не перебирает все слова.
+    Более длинное продолжение пробуется раньше короткого (жадный `?`), так что при откате
+    (например, из-за границы слова после совпадения) выбирается самое длинное подходящее слово.
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = None
+
+    # Итеративный обход в обратном порядке: длина слов не ограничена глубиной рекурсии
+    order = []
+    stack = [trie]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(child for ch, child in node.items() if ch)
+    patterns: Dict[int, str] = {}
+    for node in reversed(order):
+        branches = [re.escape(ch) + patterns[id(child)] for ch, child in sorted(node.items(), key=lambda x: x[0]) if ch]
+        if not branches:
+            pattern = ''
+        elif len(branches) == 1 and '' not in node:
+            pattern = branches[0]
+        else:
+            pattern = '(?:' + '|'.join(branches) + ')'
+            if '' in node:
+                pattern += '?'
+        patterns[id(node)] = pattern
+    return patterns[id(trie)]
+
+
+def formula_over_budget(text: str) -> bool:
+    """
+    Превышает ли формула бюджет разбора (FORMULA_MAX_CHARS, FORMULA_SCAN_BUDGET).
+    Вызов dictGet/tupleElement без закрывающей скобки или кавычки regex просматривает до конца формулы,
+    поэтому время разбора растет как длина формулы, умноженная на число таких вызовов.
+    Вложенные вызовы (глубокие скобки, цепочки if(..., if(...))) лексер отдает прежнему разбору,
+    который проходит формулу заново на каждом уровне: к числу вызовов добавляется глубина вложенности.
+    """
+    if len(text) > FORMULA_MAX_CHARS:
+        return True
+    calls = text.count('dictGet')
+    if 'tupleelement' in text.lower():
+        calls += text.lower().count('tupleelement')
+    # Число скобок — верхняя граница глубины; точную глубину считаем, только если граница не проходит
+    opens = text.count('(')
+    if len(text) * (calls + 1 + opens) <= FORMULA_SCAN_BUDGET:
+        return False
+    return len(text) * (calls + 1 + _paren_depth(text)) > FORMULA_SCAN_BUDGET
+
+
+def _paren_depth(text: str) -> int:
+    """Максимальная глубина вложенности круглых скобок (скобки внутри литералов тоже считаются)."""
+    depth = max_depth = 0
+    for bracket in _RE_PARENS.findall(text):
+        if bracket == '(':
+            depth += 1
+            if depth > max_depth:
+                max_depth = depth
+        elif depth:
+            depth -= 1
+    return max_depth
+
+
 class ContextMasker:
     """
     Класс, отвечающий за маскирование чувствительных данных.
@@ -15,6 +90,26 @@ class ContextMasker:
     2. Unmasking: Маски -> Реальные данные (ENT_1 -> person)
     """
 
+    # Слова, которые разбор формулы сам вставляет в результат (кроме масок)
+    FORMULA_OUTPUT_WORDS = frozenset({'DB', 'dictGet', 'tuple', 'tupleElement'})
+
+    # Причины, по которым лексер формул отдает формулу прежнему разбору (_mask_formula_lexer).
+    # Других нет; на каждую есть пример в tests/formula_cases.py.
+    # Параметр назван как маска или слово, которое вставляет разбор (ENT_1, tuple...)
+    FALLBACK_PARAMS_COLLIDE = 'params_collide'
+    # Непарная кавычка вне литерала
+    FALLBACK_UNPAIRED_QUOTE = 'unpaired_quote'
+    # dictGet/tupleElement внутри литерала
+    FALLBACK_NESTED_CALL = 'nested_call'
+    # dictGet/tupleElement в аргументах tuple(...) у dictGet
+    FALLBACK_CALL_IN_TUPLE = 'call_in_tuple'
+    # Кавычка сразу после dictGet('dict', 'col'
+    FALLBACK_QUOTE_AFTER_DICTGET = 'quote_after_dictget'
+    # dictGet/tupleElement, который лексер не взял токеном (например, внутри слова), а прежний разбор маскирует
+    FALLBACK_UNLEXED_CALL = 'unlexed_call'
+    # 'DB' зарегистрирован как сущность или таблица, а в формуле есть словари DB.DICT_N
+    FALLBACK_DB_ENTITY = 'db_entity'
+
     def __init__(self) -> None:
         # Прямой словарь: {(категория, реальное_значение): 'MASK_ID'}
         # Пример: {('ENT', 'person'): 'ENT_1'}
@@ -23,13 +118,54 @@ class ContextMasker:
         # Обратный словарь: {'MASK_ID': 'реальное_значение'}
         # Пример: {'ENT_1': 'person'}
         self.map_reverse: Dict[str, str] = {}
+
+        # Индекс по значению: {'реальное_значение': 'MASK_ID'} для литералов в формулах.
+        # Если значение зарегистрировано в нескольких категориях, хранится маска первой регистрации.
+        self.value_index: Dict[str, str] = {}
         
         # Счетчики для генерации уникальных ID масок (ENT_1, ENT_2...)
         self.counters: Dict[str, int] = defaultdict(int)
         
+        # Версия состояния: растет при каждом изменении словарей (clear, новая маска, known_parameters).
+        # По ней кэши понимают, что SQL, замаскированный раньше, все еще соответствует словарю.
+        self.version: int = 0
+        # Номер "поколения" масок: растет только при clear(). Внутри поколения маски лишь добавляются,
+        # поэтому SQL, замаскированный раньше, остается согласован со словарем.
+        self.epoch: int = 0
+        # Отпечаток содержимого словаря: хэш последовательности регистраций (и known_parameters) с последнего clear().
+        # В отличие от version, одинаков у маскеров (и поколений одного маскера), пришедших к словарю
+        # одними и теми же шагами, — по нему кэш строк SQL (core/row_cache.py) узнает то же состояние после clear().
+        self.fingerprint: int = 0
+        # Журнал новых масок [(значение, категория)] для кэша строк SQL: повторная регистрация
+        # в том же порядке из того же состояния дает те же маски (start_journal/stop_journal, OutputGenerator._render_row_cached)
+        self._journal: Optional[List[Tuple[str, str]]] = None
+
+        # Скомпилированный поиск для mask_text: ((epoch, число масок), regex, {значение: маска}).
+        # Внутри поколения маски только добавляются, поэтому ключа достаточно, чтобы понять, что словарь изменился.
+        self._text_matcher: Optional[Tuple[Tuple[int, int], Any, Dict[str, str]]] = None
+        # Маски, не подходящие под re_mask_token, для unmask_text: ((epoch, число масок), [(маска, значение)])
+        self._irregular_masks: Optional[Tuple[Tuple[int, int], List[Tuple[str, str]]]] = None
+
+        # LRU-кэши результатов mask_formula и сериализованного mask_json: {вход: [результат, version, пробы]}.
+        # "Пробы" — значения, которых не было в словаре при маскировании (литерал без маски,
+        # левая часть A.B, не известная как ENT/TBL). Найденное в словаре уже не меняется,
+        # поэтому при другой version запись верна, пока ни одна проба не появилась в словаре.
+        self.cache_size: int = MASKING_CACHE_SIZE
+        self._formula_cache: 'OrderedDict[str, list]' = OrderedDict()
+        self._json_cache: 'OrderedDict[str, list]' = OrderedDict()
+        # Пробы текущего вычисления (mask_json собирает пробы вложенных mask_formula)
+        self._probes: Optional[List[Tuple[Optional[str], str]]] = None
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+        # Сколько формул лексер отдал прежнему разбору, по причинам (FALLBACK_*)
+        self.lexer_fallbacks: Dict[str, int] = defaultdict(int)
+
         # Множество известных параметров, загружаемых из БД.
         # Нужен для корректного парсинга Java-условий, где параметры пишутся без спецсимволов.
         self.known_parameters: Set[str] = set()
+        # Есть ли среди параметров слова, которые появляются в замаскированной формуле
+        # (маски, dictGet, tuple...): тогда лексер формул не используется (см. _mask_formula_lexer)
+        self._params_collide: bool = False
 
         # Список слов, которые НЕЛЬЗЯ маскировать (ключевые слова ClickHouse, SQL, типы данных).
         # Если случайно замаскировать 'sum' или 'count', сломается логика запроса.
@@ -51,7 +187,8 @@ class ContextMasker:
         
         # 1. dictGet с кортежем: dictGet('dictionary_name', tuple('col1', 'col2'))
         # Ищет вызовы словарей со сложными ключами.
-        self.re_dict_tuple = re.compile(r"dictGet\s*\(\s*'([^']+)'\s*,\s*tuple\s*\((.*?)\)", re.DOTALL)
+        # (аргументы кортежа — [^)]* до первой скобки, то же, что ленивое .*? с DOTALL, но без откатов)
+        self.re_dict_tuple = re.compile(r"dictGet\s*\(\s*'([^']+)'\s*,\s*tuple\s*\(([^)]*)\)")
         
         # 2. dictGet одиночный: dictGet('dictionary_name', 'key_column')
         self.re_dict_single = re.compile(r"dictGet\s*\(\s*'([^']+)'\s*,\s*'([^']+)'", re.DOTALL)
@@ -74,20 +211,119 @@ class ContextMasker:
         # 7. Отдельные слова (для Java-style условий): variable != null
         self.re_word = re.compile(r"\b([a-zA-Z_][a-zA-Z0-9_]*)\b")
 
+        # Сгенерированная маска целиком (см. _is_generated_mask)
+        self.re_generated_mask = re.compile(r'^(DB\.[A-Z]+|[A-Z]+)_\d+$')
+
+        # 8. Токен в форме маски: КАТЕГОРИЯ_N или DB.КАТЕГОРИЯ_N (ENT_1, ENT_NAME_2, DB.DICT_3)
+        self.re_mask_token = re.compile(r"\b(?:DB\.)?[A-Z][A-Z_]*_\d+\b")
+
+        # 9. Лексер формул для mask_formula: те же конструкции, что в пунктах 1-7, одной альтернативой
+        # (см. _formula_lexer_regex: слова — только известные параметры, поэтому regex собирается под них).
+        self.re_formula_token = self._formula_lexer_regex(set())
+        self.re_tuple_element_word = re.compile(r"(?i)tupleElement")
+
     def clear(self) -> None:
         """Сброс состояния маскера (очистка всех словарей)."""
         logger.debug("Очистка словарей маскирования")
         self.map_forward.clear()
         self.map_reverse.clear()
+        self.value_index.clear()
         self.counters.clear()
         self.known_parameters.clear()
+        self._params_collide = False
+        self.re_formula_token = self._formula_lexer_regex(set())
+        self._clear_caches()
+        self.version += 1
+        self.epoch += 1
+        self.fingerprint = 0
 
     def set_known_parameters(self, params: Set[str]) -> None:
         """
         Загружает список известных ID параметров.
         Это помогает отличить параметр 'client_id' от простого слова в условии 'if client_id != null'.
         """
-        self.known_parameters = params
+        if params != self.known_parameters:
+            self.known_parameters = params
+            self._params_collide = any(
+                isinstance(p, str) and (p in self.FORMULA_OUTPUT_WORDS or self.re_mask_token.fullmatch(p))
+                for p in params
+            )
+            self.re_formula_token = self._formula_lexer_regex(params)
+            # Java-style параметры в формулах маскируются по known_parameters — старые результаты неверны
+            self._clear_caches()
+            self.version += 1
+            self.fingerprint = hash((self.fingerprint, 'known_parameters', frozenset(params)))
+
+    # ==========================================
+    # КЭШ МАСКИРОВАНИЯ ФОРМУЛ И JSON
+    # ==========================================
+
+    def _clear_caches(self) -> None:
+        self._formula_cache.clear()
+        self._json_cache.clear()
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Статистика кэшей маскирования (для логов и подбора MASKING_CACHE_SIZE)."""
+        return {
+            'formulas': len(self._formula_cache),
+            'json': len(self._json_cache),
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'lexer_fallbacks': dict(self.lexer_fallbacks),
+        }
+
+    def _probes_hold(self, probes: Tuple[Tuple[Optional[str], str], ...]) -> bool:
+        """True, если ни одно из отсутствовавших значений не появилось в словаре."""
+        for category, value in probes:
+            if category is None:
+                if value in self.value_index:
+                    return False
+            elif (category, value) in self.map_forward:
+                return False
+        return True
+
+    def _cache_get(self, cache: 'OrderedDict[str, list]', key: str) -> Optional[str]:
+        entry = cache.get(key)
+        if entry is not None and entry[1] != self.version:
+            if self._probes_hold(entry[2]):
+                entry[1] = self.version
+            else:
+                del cache[key]
+                entry = None
+        if entry is None:
+            self.cache_misses += 1
+            return None
+
+        cache.move_to_end(key)
+        self.cache_hits += 1
+        if self._probes is not None:
+            self._probes.extend(entry[2])
+        return entry[0]
+
+    def _cached(self, cache: 'OrderedDict[str, list]', key: str, compute) -> str:
+        """Результат compute() для key из кэша или вычисленный (с записью проб)."""
+        result = self._cache_get(cache, key)
+        if result is not None:
+            return result
+
+        outer = self._probes
+        self._probes = probes = []
+        try:
+            result = compute()
+        finally:
+            self._probes = outer
+        if outer is not None:
+            outer.extend(probes)
+
+        # Запоминаем, только если пробы верны и после вычисления (например, в JSON сущность
+        # могла зарегистрироваться уже после формулы, где она встречается)
+        probes = tuple(set(probes))
+        if self._probes_hold(probes):
+            cache[key] = [result, self.version, probes]
+            cache.move_to_end(key)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return result
 
     def _is_generated_mask(self, val: str) -> bool:
         """
@@ -100,7 +336,7 @@ class ContextMasker:
             return False
             
         # Regex проверяет: Начало строки, (Префикс или DB.Префикс), подчеркивание, цифры, Конец строки.
-        return bool(re.match(r'^(DB\.[A-Z]+|[A-Z]+)_\d+$', val))
+        return bool(self.re_generated_mask.match(val))
 
     def register(self, value: Any, category: str) -> str:
         """
@@ -128,9 +364,31 @@ class ContextMasker:
         # Сохраняем в оба словаря
         self.map_forward[key] = mask
         self.map_reverse[mask] = val_str
+        self.value_index.setdefault(val_str, mask)
+        self.version += 1
+        self.fingerprint = hash((self.fingerprint, category, val_str))
+        if self._journal is not None:
+            self._journal.append((val_str, category))
         
         return mask
 
+    def start_journal(self) -> Tuple[Optional[list], List[Tuple[str, str]]]:
+        """
+        Начинает запись новых масок [(значение, категория)]. Возвращает (внешний журнал, новый журнал)
+        для stop_journal; записи вложенного журнала попадают и во внешний.
+        """
+        outer = self._journal
+        self._journal = journal = []
+        return outer, journal
+
+    def stop_journal(self, state: Tuple[Optional[list], List[Tuple[str, str]]]) -> List[Tuple[str, str]]:
+        """Завершает запись, начатую start_journal, и возвращает записанные маски."""
+        outer, journal = state
+        self._journal = outer
+        if outer is not None:
+            outer.extend(journal)
+        return journal
+
     def mask_text(self, text: str) -> str:
         """
         Маскирует обычный текст (не код).
@@ -139,21 +397,31 @@ class ContextMasker:
         """
         if not text: return ""
         
-        # Сортируем замены от длинных к коротким.
-        # Это важно! Если есть 'user_id' и 'user', сначала надо заменить 'user_id'.
-        # Иначе 'user_id' превратится в 'ENT_1_id'.
+        pattern, lookup = self._get_text_matcher()
+        if pattern is None:
+            return text
+        # Один проход по тексту: в каждой позиции берется самое длинное значение из словаря,
+        # ограниченное границами слов (\b), и заменяется его маской
+        return pattern.sub(lambda m: lookup[m.group(0)], text)
+
+    def _get_text_matcher(self) -> Tuple[Any, Dict[str, str]]:
+        """Regex и таблица замен для mask_text; перестраиваются, только если словарь изменился."""
+        key = (self.epoch, len(self.map_forward))
+        if self._text_matcher is not None and self._text_matcher[0] == key:
+            return self._text_matcher[1], self._text_matcher[2]
+
+        # Значение, зарегистрированное в нескольких категориях, получает маску первой по длине/порядку записи
+        # (как при последовательной замене от длинных к коротким).
+        # Не заменяем системные слова (null, true), если они вдруг попали в словарь.
         sorted_items = sorted(self.map_forward.items(), key=lambda x: len(x[0][1]), reverse=True)
-        
-        masked_text = text
+        lookup: Dict[str, str] = {}
         for (cat, val), mask in sorted_items:
-            # Не заменяем системные слова (null, true), если они вдруг попали в словарь
             if val.lower() in ['null', 'true', 'false']: continue
-            
-            # Используем границы слов (\b), чтобы менять только целые слова
-            pattern = r'\b' + re.escape(val) + r'\b'
-            masked_text = re.sub(pattern, mask, masked_text)
-            
-        return masked_text
+            lookup.setdefault(val, mask)
+
+        pattern = re.compile(r'\b' + _trie_regex(lookup) + r'\b') if lookup else None
+        self._text_matcher = (key, pattern, lookup)
+        return pattern, lookup
 
     def unmask_text(self, text: str) -> str:
         """
@@ -166,16 +434,41 @@ class ContextMasker:
         if not self.map_reverse:
             return text
         
-        # Сортируем маски по убыванию длины (DB.DICT_10 раньше, чем P_1)
-        sorted_masks = sorted(self.map_reverse.items(), key=lambda x: len(x[0]), reverse=True)
-        
-        unmasked_text = text
-        for mask, original_value in sorted_masks:
+        # Один проход: находим все токены в форме маски (ENT_12, DB.DICT_3, ENT_NAME_1)
+        # и подставляем значение из map_reverse; неизвестные токены остаются как есть
+        unmasked_text = self.re_mask_token.sub(self._unmask_token, text)
+
+        # Маски нестандартной формы (если такие попали в словарь) заменяем по одной, как раньше
+        for mask, original_value in self._get_irregular_masks():
             pattern = r'\b' + re.escape(mask) + r'\b'
             unmasked_text = re.sub(pattern, original_value, unmasked_text)
         
         return unmasked_text
 
+    def _unmask_token(self, match) -> str:
+        token = match.group(0)
+        value = self.map_reverse.get(token)
+        if value is not None:
+            return value
+        # DB.TBL_5 может не быть маской целиком, но содержать маску TBL_5 (граница слова после точки)
+        if token.startswith('DB.'):
+            value = self.map_reverse.get(token[3:])
+            if value is not None:
+                return 'DB.' + value
+        return token
+
+    def _get_irregular_masks(self) -> List[Tuple[str, str]]:
+        """Маски, которые не находит re_mask_token (по убыванию длины); пересчитываются, только если словарь изменился."""
+        key = (self.epoch, len(self.map_reverse))
+        if self._irregular_masks is None or self._irregular_masks[0] != key:
+            irregular = [
+                (mask, value) for mask, value in self.map_reverse.items()
+                if not self.re_mask_token.fullmatch(mask)
+            ]
+            irregular.sort(key=lambda x: len(x[0]), reverse=True)
+            self._irregular_masks = (key, irregular)
+        return self._irregular_masks[1]
+
     def mask_json(self, data: Any) -> Any:
         """
         Рекурсивно обходит JSON (dict/list) и маскирует ключи и значения
@@ -203,6 +496,14 @@ class ContextMasker:
             return [self.mask_json(item) for item in data]
         return data
 
+    def mask_json_dumps(self, data: Any, source: Optional[str] = None) -> str:
+        """
+        Маскирует JSON и сериализует результат (json.dumps, ensure_ascii=False).
+        Результат кэшируется по исходному тексту source (если не задан — по сериализованному data).
+        """
+        key = source if source is not None else json.dumps(data, ensure_ascii=False)
+        return self._cached(self._json_cache, key, lambda: json.dumps(self.mask_json(data), ensure_ascii=False))
+
     def _infer_json_category(self, key: str) -> Optional[str]:
         """Определяет категорию маски по имени поля в JSON."""
         mapping = {
@@ -215,12 +516,32 @@ class ContextMasker:
         }
         return mapping.get(key)
 
-    def mask_formula(self, text: str) -> str:
+    def mask_formula(self, text: str, row: Any = None) -> str:
         """
         Интеллектуальное маскирование SQL/Code формул.
         Использует набор регулярных выражений для поиска сущностей, параметров и функций.
+        Результат кэшируется (см. _cached): одинаковые формулы разбираются один раз.
+        row — откуда формула (например, (таблица, pk, колонка)), только для лога формул сверх бюджета.
         """
         if not text: return text
+        return self._cached(self._formula_cache, text, lambda: self._mask_formula(text, row))
+
+    def _mask_formula(self, text: str, row: Any = None) -> str:
+        """Один проход лексера; формулы, которые он не берет (см. _mask_formula_lexer), — прежним разбором."""
+        if formula_over_budget(text):
+            logger.warning(
+                f"Формула сверх бюджета разбора ({len(text)} символов, строка {row}), "
+                f"маскируется упрощенно: {text[:80]!r}..."
+            )
+            return self._mask_formula_conservative(text)
+        masked, fallback = self._mask_formula_lexer(text)
+        if fallback is not None:
+            self.lexer_fallbacks[fallback] += 1
+            masked = self._mask_formula_passes(text)
+        return masked
+
+    def _mask_formula_passes(self, text: str) -> str:
+        """Прежний разбор формулы: семь последовательных замен regex."""
         
         # 1. dictGet с TUPLE (Сложные вызовы словарей)
         def replace_tuple_dict(match):
@@ -266,57 +587,323 @@ class ContextMasker:
 
         # 5. Entity.Property (Точечная нотация)
         def replace_prop(match):
-            left = match.group(1)
-            right = match.group(2)
-            
-            # Проверяем, похоже ли левое слово на сущность или таблицу
-            is_entity = (('ENT', left) in self.map_forward) or \
-                        (('TBL', left) in self.map_forward) or \
-                        left.startswith('ENT_') or left.startswith('TBL_')
-            
-            if is_entity:
-                # Если мы точно знаем, что слева сущность, маскируем правую часть как свойство (P)
-                cat = 'ENT' if ('ENT', left) in self.map_forward or left.startswith('ENT_') else 'TBL'
-                mask_l = self.register(left, cat)
-                mask_r = self.register(right, 'P')
-                return f"{mask_l}.{mask_r}"
-            
-            return match.group(0)
+            masked = self._mask_prop(match.group(1), match.group(2))
+            return match.group(0) if masked is None else masked
         text = self.re_dot_prop.sub(replace_prop, text)
         
         # 6. Java-style параметры (просто слова, если они есть в known_parameters)
         def replace_java_var(match):
-            word = match.group(1)
-            if word in self.known_parameters:
-                return self.register(word, 'PARAM')
-            return word
+            return self._mask_java_word(match.group(1))
         
         text = self.re_word.sub(replace_java_var, text)
 
         # 7. Литералы в кавычках 'value'
         def replace_lit(match):
-            val = match.group(1)
-            
-            # Пропускаем зарезервированные слова
-            if val in self.reserved_literals:
-                return f"'{val}'"
+            return f"'{self._mask_literal(match.group(1))}'"
 
-            # Пропускаем сложные конструкции (содержат скобки или запятые)
-            if ')' in val or '(' in val or (',' in val and ' ' not in val):
-                 return f"'{val}'"
+        text = self.re_literal.sub(replace_lit, text)
+        
+        return text
 
-            # Если похоже на имя таблицы схемы (schema.name), маскируем как словарь
-            if '.' in val and '_' in val and ' ' not in val:
-                 return f"'{self.register(val, 'DB.DICT')}'"
+    def _mask_formula_conservative(self, text: str) -> str:
+        """
+        Упрощенное маскирование формулы сверх бюджета: только правила, которые regex проверяет за линейное время
+        ({param}, A.B, слова-параметры, литералы), без разбора dictGet/tupleElement.
+        Имена словарей и колонок в вызовах остаются литералами, поэтому любой литерал, не похожий
+        на зарезервированное слово, маскируется: найденной маской, как DB.DICT (schema.name) или как COL.
+        Точность ниже, чем у полного разбора, но реальные значения в результат не попадают.
+        """
+        text = self.re_param_braces.sub(lambda m: f"{{{self.register(m.group(1), 'PARAM')}}}", text)
 
-            # Если это значение уже было зарегистрировано где-то ранее, используем эту маску.
-            # Это сохраняет целостность данных.
-            for (cat, real_val), mask in self.map_forward.items():
-                if real_val == val:
-                    return f"'{mask}'"
+        def replace_prop(match):
+            masked = self._mask_prop(match.group(1), match.group(2))
+            return match.group(0) if masked is None else masked
+        text = self.re_dot_prop.sub(replace_prop, text)
+        text = self.re_word.sub(lambda m: self._mask_java_word(m.group(1)), text)
 
-            return f"'{val}'"
+        def replace_lit(match):
+            val = match.group(1)
+            if not val or val in self.reserved_literals:
+                return match.group(0)
+            mask = self.value_index.get(val)
+            if mask is None:
+                category = 'DB.DICT' if '.' in val and '_' in val and ' ' not in val else 'COL'
+                mask = self.register(val, category)
+            return f"'{mask}'"
+        return self.re_literal.sub(replace_lit, text)
 
-        text = self.re_literal.sub(replace_lit, text)
+    def _mask_prop(self, left: str, right: str) -> Optional[str]:
+        """Entity.Property: маскирует обе части, если слева сущность или таблица, иначе None."""
+        probes = self._probes
+
+        # Проверяем, похоже ли левое слово на сущность или таблицу
+        is_entity = (('ENT', left) in self.map_forward) or \
+                    (('TBL', left) in self.map_forward) or \
+                    left.startswith('ENT_') or left.startswith('TBL_')
+        
+        if is_entity:
+            # Если мы точно знаем, что слева сущность, маскируем правую часть как свойство (P)
+            cat = 'ENT' if ('ENT', left) in self.map_forward or left.startswith('ENT_') else 'TBL'
+            if cat == 'TBL' and probes is not None:
+                probes.append(('ENT', left))
+            mask_l = self.register(left, cat)
+            mask_r = self.register(right, 'P')
+            return f"{mask_l}.{mask_r}"
         
-        return text
\ No newline at end of file
+        if probes is not None:
+            probes.append(('ENT', left))
+            probes.append(('TBL', left))
+        return None
+
+    def _mask_java_word(self, word: str) -> str:
+        """Слово формулы: маска PARAM, если это известный параметр."""
+        if word in self.known_parameters:
+            return self.register(word, 'PARAM')
+        return word
+
+    def _mask_literal(self, val: str) -> str:
+        """Содержимое литерала в кавычках (без кавычек) после маскирования."""
+        # Пропускаем зарезервированные слова
+        if val in self.reserved_literals:
+            return val
+
+        # Пропускаем сложные конструкции (содержат скобки или запятые)
+        if ')' in val or '(' in val or (',' in val and ' ' not in val):
+             return val
+
+        # Если похоже на имя таблицы схемы (schema.name), маскируем как словарь
+        if '.' in val and '_' in val and ' ' not in val:
+             return self.register(val, 'DB.DICT')
+
+        # Если это значение уже было зарегистрировано где-то ранее, используем эту маску.
+        # Это сохраняет целостность данных.
+        mask = self.value_index.get(val)
+        if mask is not None:
+            return mask
+
+        if self._probes is not None:
+            self._probes.append((None, val))
+        return val
+
+    # ==========================================
+    # ЛЕКСЕР ФОРМУЛ
+    # ==========================================
+
+    @staticmethod
+    def _formula_lexer_regex(params: Set[str]) -> Any:
+        """
+        Regex токенов формулы для _mask_formula_lexer. Находит только то, что может быть замаскировано;
+        остальной текст finditer пропускает без вызовов Python.
+        Токены начинаются там же, где их нашли бы отдельные проходы: dictGet/tupleElement — не внутри слова,
+        A.B и слова — на границе слова; слово (пункт 6) — только известный параметр.
+        """
+        words = [p for p in params if isinstance(p, str) and re.fullmatch(r'[a-zA-Z_][a-zA-Z0-9_]*', p)]
+        word = r"| (?P<word>\b(?:" + _trie_regex(words) + r")\b)" if words else ""
+        # Первая строка — быстрый отсев позиций: токен начинается с этих символов и не внутри слова
+        # (кроме литерала и {param}); без нее каждая буква каждого слова пробовалась бы всеми альтернативами.
+        return re.compile(r"""
+            (?=[dtT'{a-zA-Z_])(?:(?<!\w)|(?=['{]))
+            (?:
+              (?<!\w)(?P<dt>dictGet\s*\(\s*'(?P<dt_name>[^']+)'\s*,\s*tuple\s*\((?P<dt_args>[^)]*)\))
+            | (?<!\w)(?P<ds>dictGet\s*\(\s*'(?P<ds_name>[^']+)'\s*,\s*'(?P<ds_col>[^']+)')
+            | (?<!\w)(?P<te>(?i:tupleElement)\s*\(\s*(?P<te_prefix>[a-zA-Z0-9_\.]+)\s*,\s*'(?P<te_col>(?:''|[^'])*)'\s*\))
+            | (?P<lit>'(?P<lit_val>(?:''|[^'])*)')
+            | (?P<br>\{(?P<br_name>[a-zA-Z_][a-zA-Z0-9_]*)\})
+            | (?P<dot>\b(?P<dot_left>[a-zA-Z][a-zA-Z0-9_]*)\.(?P<dot_right>[a-zA-Z0-9_]+)\b)
+            """ + word + r"""
+            | (?P<quote>')
+            )
+        """, re.VERBOSE | re.DOTALL)
+
+    def _mask_formula_lexer(self, text: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Маскирует формулу за один проход re_formula_token вместо семи проходов regex.
+        Правила те же. Найденные токены раскладываются по фазам прежнего разбора
+        (1 — dictGet с tuple, 2 — dictGet, 3 — tupleElement, 4 — {param}, 5 — A.B, 6 — слова, 7 — литералы),
+        и маски регистрируются фаза за фазой, поэтому их номера совпадают с прежним разбором.
+
+        Последовательные проходы видели результат предыдущих (например, A.B внутри литерала
+        или слово из маски), лексер воспроизводит это явно. Там, где проходы влияли друг на друга
+        сложнее, возвращает причину FALLBACK_* — такие формулы маскируются прежним разбором.
+        Результат: (замаскированная формула, None) или (None, причина).
+        """
+        if self._params_collide:
+            return None, self.FALLBACK_PARAMS_COLLIDE
+
+        parts: List[str] = []
+        phases: List[list] = [[], [], [], [], [], [], [], []]
+        starts: Set[int] = set()
+        fallback = self._lex_formula(text, 'text', parts, phases, starts)
+        if fallback is not None:
+            return None, fallback
+        if not parts:
+            return text, None
+
+        # dictGet/tupleElement, которые лексер не взял токеном (внутри слова, литерала или другого токена),
+        # прежний разбор мог замаскировать — такие формулы отдаем ему
+        pos = text.find('dictGet')
+        while pos != -1:
+            if pos not in starts and (self.re_dict_tuple.match(text, pos) or self.re_dict_single.match(text, pos)):
+                return None, self.FALLBACK_UNLEXED_CALL
+            pos = text.find('dictGet', pos + 1)
+        # (регистр не важен: в словах "tupleelement" нет букв с особыми правилами lower())
+        if 'tupleelement' in text.lower():
+            for m in self.re_tuple_element_word.finditer(text):
+                if m.start() not in starts and self.re_tuple_element.match(text, m.start()):
+                    return None, self.FALLBACK_UNLEXED_CALL
+
+        if phases[1] or phases[2]:
+            # Маски словарей DB.DICT_N проходят через правило A.B: слева 'DB' не должен быть сущностью
+            if self._probes is not None:
+                self._probes.append(('ENT', 'DB'))
+                self._probes.append(('TBL', 'DB'))
+            if ('ENT', 'DB') in self.map_forward or ('TBL', 'DB') in self.map_forward:
+                return None, self.FALLBACK_DB_ENTITY
+
+        # Регистрация масок в порядке прежних проходов
+        register = self.register
+        for phase in (1, 2, 3, 4):
+            for idx, value, category in phases[phase]:
+                parts[idx] = register(value, category)
+        for idx, left, right in phases[5]:
+            masked = self._mask_prop(left, right)
+            if masked is not None:
+                parts[idx] = masked
+        for item in phases[6]:
+            if len(item) == 2:
+                parts[item[0]] = self._mask_java_word(item[1])
+            else:
+                # A.B, не оказавшееся свойством сущности (текст не изменился): слова по отдельности.
+                # У свойства сущности обе части уже маски, параметрами они быть не могут (_params_collide).
+                idx, left, right = item
+                if parts[idx] == f"{left}.{right}":
+                    left = self._mask_java_word(left)
+                    if not right[0].isdigit():
+                        right = self._mask_java_word(right)
+                    parts[idx] = f"{left}.{right}"
+        for start, end in phases[7]:
+            val = parts[start] if end - start == 1 else ''.join(parts[start:end])
+            parts[start] = self._mask_literal(val)
+            for i in range(start + 1, end):
+                parts[i] = ''
+        return ''.join(parts), None
+
+    def _lex_formula(self, s: str, mode: str, parts: List[str], phases: List[list], starts: Set[int]) -> Optional[str]:
+        """
+        Разбивает s на токены, дописывая текст в parts и отложенные маскирования в phases.
+        mode: 'text' — формула целиком, 'args' — аргументы tuple(...) в dictGet (литералы — колонки),
+        'lit' — содержимое литерала, 'prefix' — первый аргумент tupleElement.
+        Возвращает None или причину FALLBACK_*, по которой формулу нужно отдать прежнему разбору.
+        """
+        known = self.known_parameters
+        # Текст без масок копируется кусками между токенами
+        last = 0
+        for m in self.re_formula_token.finditer(s):
+            kind = m.lastgroup
+            if kind == 'word':
+                # 6. Известный параметр
+                if m.start() > last:
+                    parts.append(s[last:m.start()])
+                phases[6].append((len(parts), m.group(0)))
+                parts.append(m.group(0))
+                last = m.end()
+                continue
+            if kind == 'quote':
+                # Непарная кавычка: прежний разбор мог сопоставить ее с кавычкой из вставленной маски
+                if mode == 'lit':
+                    continue
+                return self.FALLBACK_UNPAIRED_QUOTE
+            if kind == 'lit' and mode == 'lit':
+                # Внутри литерала кавычки идут парами ('') — это просто текст
+                continue
+
+            if m.start() > last:
+                parts.append(s[last:m.start()])
+            last = m.end()
+
+            if kind == 'dot':
+                # 5. A.B; если это не свойство сущности — слова по отдельности (6)
+                item = (len(parts), m.group('dot_left'), m.group('dot_right'))
+                phases[5].append(item)
+                if known and (item[1] in known or item[2] in known):
+                    phases[6].append(item)
+                parts.append(m.group(0))
+
+            elif kind == 'lit':
+                val = m.group('lit_val')
+                parts.append("'")
+                if mode == 'args':
+                    # 1. Литералы внутри tuple(...) — имена колонок
+                    if val:
+                        phases[1].append((len(parts), val, 'COL'))
+                    parts.append(val)
+                else:
+                    # 7. Литерал: содержимое сначала проходит правила 4-6, затем маскируется целиком
+                    start = len(parts)
+                    if '.' in val or '{' in val or (known and self.re_formula_token.search(val)):
+                        fallback = self._lex_formula(val, 'lit', parts, phases, starts)
+                        if fallback is not None:
+                            return fallback
+                        if len(parts) == start:
+                            parts.append('')
+                    else:
+                        parts.append(val)
+                    phases[7].append((start, len(parts)))
+                parts.append("'")
+
+            elif kind == 'br':
+                # 4. {param}
+                parts.append('{')
+                phases[4].append((len(parts), m.group('br_name'), 'PARAM'))
+                parts.append(m.group('br_name'))
+                parts.append('}')
+
+            elif mode != 'text':
+                # dictGet/tupleElement внутри литерала: проходы влияли бы друг на друга.
+                # (В аргументах tuple(...) и префиксе tupleElement вызовов не бывает: см. 'dt' и re_formula_token.)
+                return self.FALLBACK_NESTED_CALL
+
+            elif kind == 'dt':
+                # 1. dictGet('dict', tuple(...))
+                args = m.group('dt_args')
+                if 'dictGet' in args or 'tupleelement' in args.lower():
+                    return self.FALLBACK_CALL_IN_TUPLE
+                starts.add(m.start())
+                parts.append("dictGet('")
+                phases[1].append((len(parts), m.group('dt_name'), 'DB.DICT'))
+                parts.append(m.group('dt_name'))
+                parts.append("', tuple(")
+                fallback = self._lex_formula(args, 'args', parts, phases, starts)
+                if fallback is not None:
+                    return fallback
+                parts.append(")")
+
+            elif kind == 'ds':
+                # 2. dictGet('dict', 'col'
+                # Кавычка сразу после токена слилась бы со вставленным литералом в прежнем разборе
+                if s.startswith("'", m.end()):
+                    return self.FALLBACK_QUOTE_AFTER_DICTGET
+                starts.add(m.start())
+                parts.append("dictGet('")
+                phases[2].append((len(parts), m.group('ds_name'), 'DB.DICT'))
+                parts.append(m.group('ds_name'))
+                parts.append("', '")
+                phases[2].append((len(parts), m.group('ds_col'), 'COL'))
+                parts.append(m.group('ds_col'))
+                parts.append("'")
+
+            else:
+                # 3. tupleElement(prefix, 'col')
+                starts.add(m.start())
+                parts.append("tupleElement(")
+                fallback = self._lex_formula(m.group('te_prefix'), 'prefix', parts, phases, starts)
+                if fallback is not None:
+                    return fallback
+                parts.append(", '")
+                phases[3].append((len(parts), m.group('te_col'), 'COL'))
+                parts.append(m.group('te_col'))
+                parts.append("')")
+
+        if last < len(s):
+            parts.append(s[last:])
+        return None
@@ -1,8 +1,11 @@
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 from utils.logger import setup_logger
 
 logger = setup_logger(__name__)
 
+# Заглушка вместо пустого SQL-контекста
+EMPTY_CONTEXT = "-- Контекст конфигурации не выбран или пуст."
+
 class PromptGenerator:
     """
     Класс для сборки финального текста промпта.
@@ -35,20 +38,62 @@ class PromptGenerator:
         logger.info(f"Сборка промпта для namespace '{namespace}'")
         
         # Если контекст пустой, пишем заглушку, чтобы было понятно
-        final_sql_context = sql_context if sql_context else "-- Контекст конфигурации не выбран или пуст."
+        final_sql_context = sql_context if sql_context else EMPTY_CONTEXT
+        
+        final_prompt = self._head(system_prompt) + final_sql_context + self._tail(user_query)
         
-        # F-string шаблон сборки
-        final_prompt = f"""-- СИСТЕМНЫЙ ПРОМПТ:
+        logger.info(f"✅ Промпт собран. Длина: {len(final_prompt)} символов")
+        return final_prompt
+
+    def iter_prompt(
+        self,
+        system_prompt: str,
+        user_query: str,
+        namespace: str,
+        sql_chunks: Iterable[str]
+    ) -> Iterator[str]:
+        """
+        Потоковая сборка того же промпта, что generate: части SQL-контекста (например,
+        OutputGenerator.iter_sql()) отдаются по мере генерации, без сборки всего текста в памяти.
+        "".join(iter_prompt(..., chunks)) == generate(..., "".join(chunks)).
+        """
+        logger.info(f"Потоковая сборка промпта для namespace '{namespace}'")
+        length = 0
+        head = self._head(system_prompt)
+        length += len(head)
+        yield head
+
+        empty = True
+        for chunk in sql_chunks:
+            if chunk:
+                empty = False
+                length += len(chunk)
+                yield chunk
+        if empty:
+            length += len(EMPTY_CONTEXT)
+            yield EMPTY_CONTEXT
+
+        tail = self._tail(user_query)
+        length += len(tail)
+        yield tail
+        logger.info(f"✅ Промпт собран (поток). Длина: {length} символов")
+
+    @staticmethod
+    def _head(system_prompt: str) -> str:
+        """Шаблон промпта до SQL-контекста."""
+        return f"""-- СИСТЕМНЫЙ ПРОМПТ:
 {system_prompt}
 
 
 -- КОНТЕКСТ:
 --=============================== SQL ===============================
-{final_sql_context}
+"""
+
+    @staticmethod
+    def _tail(user_query: str) -> str:
+        """Шаблон промпта после SQL-контекста."""
+        return f"""
 --=============================== SQL ===============================
 
 -- ПОЛЬЗОВАТЕЛЬСКИЙ ЗАПРОС:
 {user_query}"""
-        
-        logger.info(f"✅ Промпт собран. Длина: {len(final_prompt)} символов")
-        return final_prompt
\ No newline at end of file
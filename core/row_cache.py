@@ -0,0 +1,79 @@
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from config.settings import ROW_CACHE_SIZE
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Строка SQL: (VALUES строки или None, если строки нет в загрузчике; журнал новых масок [(значение, категория)])
+RowFragment = Tuple[Optional[str], Tuple[Tuple[str, str], ...]]
+
+
+class RowFragmentCache:
+    """
+    Общий для процесса кэш отрендеренных строк VALUES (OutputGenerator).
+    Ключ — (таблица, pk, маскирована ли строка, отпечаток словаря маскера до рендеринга).
+    Рендеринг строки детерминирован: из того же состояния маскера (ContextMasker.fingerprint)
+    получаются тот же текст и те же новые маски, поэтому при попадании маски из журнала
+    регистрируются заново (в том же порядке) и маскер приходит в то же состояние, что после рендеринга.
+
+    Отпечаток не зависит от clear(): повторные "Подобрать контекст" (маскер сбрасывается)
+    и "Сгенерировать промпт" по пересекающимся выборкам берут строки из кэша.
+    Загрузчики хранятся по слабым ссылкам (как в ResolutionCache); на загрузчик — LRU из ROW_CACHE_SIZE строк.
+    """
+
+    _instance: Optional['RowFragmentCache'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_rows: int = ROW_CACHE_SIZE) -> None:
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._by_loader: 'weakref.WeakKeyDictionary[Any, OrderedDict[Hashable, RowFragment]]' = \
+            weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def instance(cls) -> 'RowFragmentCache':
+        """Возвращает общий кэш процесса (создается при первом обращении)."""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def get(self, loader: Any, key: Hashable) -> Optional[RowFragment]:
+        with self._lock:
+            rows = self._by_loader.get(loader)
+            fragment = rows.get(key) if rows is not None else None
+            if fragment is None:
+                self.misses += 1
+                return None
+            rows.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, loader: Any, key: Hashable, fragment: RowFragment) -> None:
+        if self.max_rows <= 0:
+            return
+        with self._lock:
+            rows = self._by_loader.get(loader)
+            if rows is None:
+                rows = self._by_loader[loader] = OrderedDict()
+            rows[key] = fragment
+            rows.move_to_end(key)
+            while len(rows) > self.max_rows:
+                rows.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика кэша (для логов и отладки)."""
+        with self._lock:
+            return {
+                'loaders': len(self._by_loader),
+                'rows': sum(len(r) for r in self._by_loader.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -34,6 +34,7 @@ PRIMARY_KEYS: Dict[str, List[str]] = {
 # 🎭 ПРАВИЛА МАСКИРОВАНИЯ (FIELD MAPPING)
 # ==========================================
 # Определяет, как маскировать конкретные поля в таблицах при генерации SQL.
+# OutputGenerator компилирует его в планы таблиц (TablePlan): действие выбирается один раз на колонку.
 # Ключ: имя таблицы.
 # Значение: словарь {'имя_колонки': 'ДЕЙСТВИЕ'}.
 #
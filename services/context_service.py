@@ -1,7 +1,13 @@
-from typing import List, Dict, Any, Tuple
-from core.context_engine import DbDataLoader, ContextResolver, OutputGenerator
+from typing import List, Dict, Any, Tuple, Optional, Set, Iterator
+from config.settings import LOADER_STORAGE, CONTEXT_CLOSURES, CONTEXT_RESOLVER, CONTEXT_FORMAT, MAX_TOKENS
+from core.context_engine import DbDataLoader, ContextResolver, WorklistResolver, OutputGenerator
+from core.columnar import is_arrow_available
 from core.masking import ContextMasker
 from core.prompt_generator import PromptGenerator
+from services.database import DatabaseManager
+from services.loader_cache import LoaderCache, LoaderLease
+from services.resolution_cache import ResolutionCache, Resolution
+from services.snapshot_store import SnapshotStore, compute_content_hash
 from utils.logger import setup_logger
 from utils.tokenizer import TokenCounter
 
@@ -14,12 +20,351 @@ class ContextService:
     Вызывается напрямую из UI (Step 2).
     """
 
+    @staticmethod
+    def acquire_namespace(
+        db_manager: DatabaseManager,
+        namespace_id: str,
+        storage: str = LOADER_STORAGE,
+        current: Optional[LoaderLease] = None,
+        cache: Optional[LoaderCache] = None,
+        snapshot_store: Optional[SnapshotStore] = None
+    ) -> Tuple[LoaderLease, str]:
+        """
+        Выдает загрузчик namespace из общего для процесса LoaderCache.
+        Сессии с одним namespace и одной версией данных получают один и тот же (неизменяемый)
+        загрузчик; если его нет в кэше, он загружается один раз (load_namespace/refresh_namespace),
+        даже когда запросов несколько одновременно. Используется для кнопки "Загрузить контекст".
+
+        Args:
+            db_manager: Менеджер БД.
+            namespace_id: ID неймспейса.
+            storage: Режим хранения DbDataLoader ('dict' или 'arrow').
+            current: Текущая аренда сессии. Если это тот же namespace, новая версия строится
+                дельтой от него. Старую аренду освобождает вызывающий код.
+            cache: Кэш загрузчиков (по умолчанию — общий LoaderCache.instance()).
+            snapshot_store: Хранилище снимков (по умолчанию — каталог SNAPSHOT_DIR).
+
+        Returns:
+            Tuple[LoaderLease, str]: (аренда загрузчика, источник: 'unchanged', 'cache', 'snapshot',
+                'delta', 'database' или 'snapshot_offline')
+        """
+        cache = cache or LoaderCache.instance()
+        store = snapshot_store or SnapshotStore()
+        storage = ContextService._effective_storage(storage)
+
+        try:
+            fingerprint = db_manager.fetch_namespace_fingerprint(namespace_id)
+        except Exception as e:
+            logger.warning(f"Не удалось получить версию данных namespace {namespace_id}: {e}")
+            loader = ContextService._load_offline(store, namespace_id, storage)
+            key = (str(namespace_id), compute_content_hash(loader.fingerprint), storage)
+            return cache.acquire(key, lambda: loader), 'snapshot_offline'
+
+        key = (str(namespace_id), compute_content_hash(fingerprint), storage)
+        if current is not None and not current.released and current.key == key:
+            return current, 'unchanged'
+
+        sources: List[str] = []
+
+        def load() -> DbDataLoader:
+            if current is not None and not current.released and current.key[0] == key[0] \
+                    and current.loader.storage == storage:
+                loader, source = ContextService.refresh_namespace(
+                    db_manager, current.loader, namespace_id, store, fingerprint=fingerprint
+                )
+            else:
+                loader, source = ContextService.load_namespace(
+                    db_manager, namespace_id, storage, store, fingerprint=fingerprint
+                )
+            sources.append(source)
+            if CONTEXT_CLOSURES:
+                # Замыкания считаются в фоне, пока пользователь выбирает датасеты
+                loader.closures.start_background()
+            return loader
+
+        lease = cache.acquire(key, load)
+        return lease, sources[0] if sources else 'cache'
+
+    @staticmethod
+    def load_namespace(
+        db_manager: DatabaseManager,
+        namespace_id: str,
+        storage: str = LOADER_STORAGE,
+        snapshot_store: Optional[SnapshotStore] = None,
+        fingerprint: Optional[Dict[str, Dict[str, int]]] = None
+    ) -> Tuple[DbDataLoader, str]:
+        """
+        Загружает и индексирует данные namespace.
+        Если в БД ничего не менялось с прошлой загрузки, поднимает готовый снимок с диска
+        (без 21 запроса SELECT * и повторной индексации). Если данные изменились, более старый
+        снимок догоняется дельтой (см. refresh_namespace).
+
+        Args:
+            db_manager: Менеджер БД.
+            namespace_id: ID неймспейса.
+            storage: Режим хранения DbDataLoader ('dict' или 'arrow').
+            snapshot_store: Хранилище снимков (по умолчанию — каталог SNAPSHOT_DIR).
+            fingerprint: Уже полученная версия данных (иначе запрашивается из БД).
+
+        Returns:
+            Tuple[DbDataLoader, str]: (загрузчик, источник данных: 'snapshot', 'delta', 'database' или 'snapshot_offline')
+        """
+        store = snapshot_store or SnapshotStore()
+        storage = ContextService._effective_storage(storage)
+
+        # 1. Версия данных в БД (один легкий запрос)
+        if fingerprint is None:
+            try:
+                fingerprint = db_manager.fetch_namespace_fingerprint(namespace_id)
+            except Exception as e:
+                # БД недоступна или тормозит: работаем с последним известным снимком
+                logger.warning(f"Не удалось получить версию данных namespace {namespace_id}: {e}")
+                return ContextService._load_offline(store, namespace_id, storage), 'snapshot_offline'
+
+        content_hash = compute_content_hash(fingerprint)
+
+        # 2. Теплый старт из снимка той же версии
+        loader = store.load(namespace_id, content_hash, storage=storage)
+        if loader is not None:
+            return loader, 'snapshot'
+
+        # 3. Есть более старый снимок: догоняем его дельтой вместо полной выгрузки
+        loader = store.load(namespace_id, storage=storage)
+        if loader is not None and ContextService._apply_namespace_delta(db_manager, loader, namespace_id, fingerprint):
+            ContextService._save_snapshot(store, loader, namespace_id, content_hash)
+            return loader, 'delta'
+
+        # 4. Холодный старт: полная выгрузка из БД и сохранение снимка
+        loader = ContextService._load_full(db_manager, namespace_id, storage, fingerprint)
+        ContextService._save_snapshot(store, loader, namespace_id, content_hash)
+        return loader, 'database'
+
+    @staticmethod
+    def refresh_namespace(
+        db_manager: DatabaseManager,
+        loader: DbDataLoader,
+        namespace_id: str,
+        snapshot_store: Optional[SnapshotStore] = None,
+        fingerprint: Optional[Dict[str, Dict[str, int]]] = None
+    ) -> Tuple[DbDataLoader, str]:
+        """
+        Обновляет уже загруженный namespace: из БД выгружаются только строки,
+        вставленные, измененные или удаленные с прошлой загрузки, и применяются к копии loader.
+        Сам loader не изменяется (он может быть общим для нескольких сессий через LoaderCache).
+        Если дельту применить нельзя (нет версии данных, изменилась схема, переполнение xid),
+        выполняется полная перезагрузка.
+
+        Returns:
+            Tuple[DbDataLoader, str]: (загрузчик, источник: 'unchanged', 'delta' или 'database')
+        """
+        store = snapshot_store or SnapshotStore()
+        if fingerprint is None:
+            fingerprint = db_manager.fetch_namespace_fingerprint(namespace_id)
+        if fingerprint == loader.fingerprint:
+            return loader, 'unchanged'
+
+        content_hash = compute_content_hash(fingerprint)
+        updated = loader.copy()
+        if ContextService._apply_namespace_delta(db_manager, updated, namespace_id, fingerprint):
+            source = 'delta'
+        else:
+            updated = ContextService._load_full(db_manager, namespace_id, loader.storage, fingerprint)
+            source = 'database'
+        ContextService._save_snapshot(store, updated, namespace_id, content_hash)
+        return updated, source
+
+    @staticmethod
+    def _effective_storage(storage: str) -> str:
+        """Режим хранения, который реально получит загрузчик (от него зависят ключи снимков и кэша)."""
+        if storage == DbDataLoader.STORAGE_ARROW and not is_arrow_available():
+            # Без pyarrow загрузчик все равно будет 'dict'
+            return DbDataLoader.STORAGE_DICT
+        return storage
+
+    @staticmethod
+    def _load_offline(store: SnapshotStore, namespace_id: str, storage: str) -> DbDataLoader:
+        """Последний известный снимок namespace, когда версию данных в БД узнать нельзя."""
+        loader = store.load(namespace_id, storage=storage)
+        if loader is None:
+            raise RuntimeError(f"БД недоступна, и для namespace {namespace_id} нет сохраненного снимка")
+        return loader
+
+    @staticmethod
+    def _load_full(
+        db_manager: DatabaseManager,
+        namespace_id: str,
+        storage: str,
+        fingerprint: Dict[str, Dict[str, int]]
+    ) -> DbDataLoader:
+        """Полная выгрузка namespace из БД с запоминанием версии данных для следующих дельт."""
+        # Границу xmin берем до выгрузки: все, что закоммитят позже, попадет в следующую дельту
+        horizon = db_manager.fetch_xmin_horizon()
+        raw_data = db_manager.fetch_namespace_context(namespace_id)
+        loader = DbDataLoader(raw_data, storage=storage)
+        loader.fingerprint = fingerprint
+        loader.xmin_horizon = horizon
+        return loader
+
+    @staticmethod
+    def _apply_namespace_delta(
+        db_manager: DatabaseManager,
+        loader: DbDataLoader,
+        namespace_id: str,
+        fingerprint: Dict[str, Dict[str, int]]
+    ) -> bool:
+        """
+        Догоняет loader до версии fingerprint. Изменившиеся таблицы находятся по отпечатку,
+        вставки и обновления — по xmin, удаления — сверкой PK (только если не сходится число строк).
+
+        Returns:
+            bool: True, если дельта применена и число строк совпало с БД.
+                False — нужна полная перезагрузка (loader при этом мог быть частично изменен).
+        """
+        if loader.xmin_horizon is None or not loader.fingerprint:
+            return False
+        changed = [t for t in fingerprint if fingerprint[t] != loader.fingerprint.get(t)]
+        if not changed:
+            loader.fingerprint = fingerprint
+            return True
+
+        horizon = db_manager.fetch_xmin_horizon()
+        if horizon < loader.xmin_horizon:
+            # Счетчик транзакций (32 бита) переполнился: сравнение по xmin ненадежно
+            logger.warning(f"xmin horizon уменьшился ({loader.xmin_horizon} -> {horizon}), нужна полная загрузка")
+            return False
+
+        upserts = db_manager.fetch_namespace_delta(namespace_id, changed, loader.xmin_horizon)
+
+        # Удаления видны по числу строк: сверяем PK только там, где оно не сходится
+        need_keys = [t for t in changed
+                     if loader.count_after_upsert(t, upserts.get(t, [])) != fingerprint[t]['rows']]
+        if any(t not in loader.pks for t in need_keys):
+            return False
+        live_keys = db_manager.fetch_namespace_keys(
+            namespace_id, {t: loader.pks[t] for t in need_keys}
+        ) if need_keys else {}
+
+        try:
+            loader.apply_delta(upserts, live_keys)
+        except ValueError as e:
+            logger.warning(f"Дельта namespace {namespace_id} не применена: {e}")
+            return False
+
+        mismatched = [t for t in changed if len(loader.db.get(t, {})) != fingerprint[t]['rows']]
+        if mismatched:
+            logger.warning(f"После дельты не сходится число строк в {mismatched}, нужна полная загрузка")
+            return False
+
+        loader.fingerprint = fingerprint
+        loader.xmin_horizon = horizon
+        return True
+
+    @staticmethod
+    def _save_snapshot(store: SnapshotStore, loader: DbDataLoader, namespace_id: str, content_hash: str) -> None:
+        """Сохраняет снимок; ошибка записи на диск не мешает работе с загруженными данными."""
+        try:
+            store.save(loader, namespace_id, content_hash)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить снимок namespace {namespace_id}: {e}")
+
+    @staticmethod
+    def _resolve_context(
+        loader: DbDataLoader,
+        datasets: List[str],
+        entities: List[str]
+    ) -> Dict[str, Set[Tuple]]:
+        """
+        Контекст выборки: объединение готовых замыканий (ClosureIndex), а пока индекс
+        строится в фоне или отключен — обход графа (WorklistResolver или ContextResolver, см. CONTEXT_RESOLVER).
+        """
+        if CONTEXT_CLOSURES:
+            closures = loader.closures
+            closures.start_background()
+            context = closures.resolve(datasets, entities)
+            if context is not None:
+                return context
+
+        resolver = ContextService._make_resolver(loader)
+        for ds in datasets:
+            resolver.resolve_by_dataset(ds)
+        for ent in entities:
+            resolver.resolve_by_entity(ent)
+        return resolver.context
+
+    @staticmethod
+    def _make_resolver(loader: DbDataLoader) -> ContextResolver:
+        """Резолвер по настройке CONTEXT_RESOLVER (WorklistResolver или рекурсивный ContextResolver)."""
+        resolver_cls = ContextResolver if CONTEXT_RESOLVER == 'recursive' else WorklistResolver
+        return resolver_cls(loader)
+
+    @staticmethod
+    def _resolution(
+        loader: DbDataLoader,
+        datasets: List[str],
+        entities: List[str]
+    ) -> Resolution:
+        """Контекст выборки из ResolutionCache (при первом обращении — _resolve_context)."""
+        return ResolutionCache.instance().get_or_resolve(
+            loader, datasets, entities,
+            lambda: Resolution(ContextService._resolve_context(loader, datasets, entities))
+        )
+
+    @staticmethod
+    def _budgeted_resolution(
+        loader: DbDataLoader,
+        datasets: List[str],
+        entities: List[str],
+        token_budget: int,
+        output_format: str = CONTEXT_FORMAT
+    ) -> Resolution:
+        """
+        Контекст выборки, урезанный до token_budget токенов SQL (с отчетом о пропущенном).
+        Строки оцениваются в формате output_format, маскированными (отдельным маскером) и без маскирования.
+        """
+        def resolve() -> Resolution:
+            resolver = ContextService._make_resolver(loader)
+            estimator = OutputGenerator(loader, {}, masker=ContextMasker(), output_format=output_format)
+            report = resolver.resolve_budgeted(datasets, entities, token_budget, estimator)
+            if report['truncated']:
+                logger.warning(
+                    f"Контекст урезан до {token_budget} токенов: пропущено {len(report['omitted_nodes'])} "
+                    f"строк {report['omitted']}"
+                )
+            return Resolution(resolver.context, report)
+
+        return ResolutionCache.instance().get_or_resolve(
+            loader, datasets, entities, resolve, variant=('budget', token_budget, output_format)
+        )
+
+    @staticmethod
+    def _prompt_resolution(
+        loader: DbDataLoader,
+        datasets: List[str],
+        entities: List[str],
+        system_prompt: str,
+        user_query: str,
+        max_tokens: Optional[int],
+        output_format: str = CONTEXT_FORMAT
+    ) -> Resolution:
+        """Контекст для промпта: полный или, если задан max_tokens, урезанный под лимит всего промпта."""
+        if max_tokens is None:
+            return ContextService._resolution(loader, datasets, entities)
+        token_budget = ContextService.context_token_budget(system_prompt, user_query, max_tokens)
+        return ContextService._budgeted_resolution(loader, datasets, entities, token_budget, output_format)
+
+    @staticmethod
+    def context_token_budget(system_prompt: str, user_query: str, max_tokens: int = MAX_TOKENS) -> int:
+        """Сколько токенов остается на SQL-контекст, если промпт целиком должен уложиться в max_tokens."""
+        frame = PromptGenerator().generate(system_prompt, user_query, namespace='', sql_context=' ')
+        return max(0, max_tokens - TokenCounter.count_tokens(frame))
+
     @staticmethod
     def pick_context(
         loader: DbDataLoader,
         masker: ContextMasker,
         datasets: List[str],
-        entities: List[str]
+        entities: List[str],
+        output_format: Optional[str] = None
     ) -> Tuple[str, Dict[Any, Any]]:
         """
         Только подбирает контекст и маскирует его (без генерации полного промпта).
@@ -30,6 +375,7 @@ class ContextService:
             masker: Объект маскера.
             datasets: Список ID выбранных датасетов.
             entities: Список ID выбранных сущностей.
+            output_format: Формат контекста (OutputGenerator.OUTPUT_FORMATS), по умолчанию CONTEXT_FORMAT.
             
         Returns:
             Tuple[str, Dict]: (SQL-текст, Словарь масок)
@@ -39,16 +385,14 @@ class ContextService:
         # 1. Сбрасываем состояние маскера (начинаем нумерацию ENT_1 заново)
         masker.clear()
         
-        # 2. Резолвинг зависимостей (строим граф объектов)
-        resolver = ContextResolver(loader)
-        for ds in datasets:
-            resolver.resolve_by_dataset(ds)
-        for ent in entities:
-            resolver.resolve_by_entity(ent)
+        # 2. Резолвинг зависимостей (строим граф объектов или берем готовый из кэша)
+        resolution = ContextService._resolution(loader, datasets, entities)
         
         # 3. Генерация SQL с маскированием
         # OutputGenerator будет вызывать masker.register() для каждого поля
-        gen_masked = OutputGenerator(loader, resolver.context, masker=masker)
+        gen_masked = OutputGenerator(
+            loader, resolution.context_copy(), masker=masker, output_format=output_format or CONTEXT_FORMAT
+        )
         sql_masked = gen_masked.generate_sql()
         
         logger.info(f"Контекст подобран. Размер SQL: {len(sql_masked)} символов.")
@@ -56,6 +400,84 @@ class ContextService:
         # Возвращаем SQL и копию словаря масок (чтобы UI мог его отобразить)
         return sql_masked, masker.map_forward.copy()
 
+    @staticmethod
+    def pick_context_budgeted(
+        loader: DbDataLoader,
+        masker: ContextMasker,
+        datasets: List[str],
+        entities: List[str],
+        token_budget: int,
+        output_format: Optional[str] = None
+    ) -> Tuple[str, Dict[Any, Any], Dict[str, Any]]:
+        """
+        Как pick_context, но контекст подбирается по приоритету, пока SQL укладывается в token_budget
+        токенов (см. ContextResolver.resolve_budgeted). Строки оцениваются в формате output_format.
+        SQL строится тем же ContextBuilder, что и update_context(token_budget=...).
+
+        Returns:
+            Tuple[str, Dict, Dict]: (SQL-текст, Словарь масок, Отчет о пропущенных строках)
+        """
+        logger.info(f"Запуск подбора контекста с бюджетом {token_budget} токенов: "
+                    f"Datasets={len(datasets)}, Entities={len(entities)}")
+        masker.clear()
+        builder = ContextBuilder(loader, masker, output_format or CONTEXT_FORMAT)
+        sql_masked, _ = builder.update(datasets, entities, token_budget)
+        logger.info(f"Контекст подобран. Размер SQL: {len(sql_masked)} символов, "
+                    f"оценка {builder.report['used_tokens']} токенов.")
+        return sql_masked, masker.map_forward.copy(), builder.report
+
+    @staticmethod
+    def update_context(
+        builder: Optional['ContextBuilder'],
+        loader: DbDataLoader,
+        masker: ContextMasker,
+        datasets: List[str],
+        entities: List[str],
+        output_format: Optional[str] = None,
+        token_budget: Optional[int] = None
+    ) -> Tuple['ContextBuilder', str, Dict[Any, Any]]:
+        """
+        Инкрементальный вариант pick_context для повторных нажатий "Подобрать контекст".
+        Если builder построен для того же загрузчика, маскера и формата, в нем обновляются только
+        добавленные/убранные Datasets и Entities и перегенерируются только изменившиеся таблицы.
+        Иначе создается новый ContextBuilder (маскер сбрасывается, как в pick_context).
+        С token_budget контекст урезается, как в pick_context_budgeted (отчет — builder.report).
+
+        Returns:
+            Tuple[ContextBuilder, str, Dict]: (Состояние для следующего вызова, SQL-текст, Словарь масок)
+        """
+        logger.info(f"Обновление контекста: Datasets={len(datasets)}, Entities={len(entities)}")
+
+        output_format = output_format or CONTEXT_FORMAT
+        if builder is None or not builder.is_valid_for(loader, masker, output_format):
+            masker.clear()
+            builder = ContextBuilder(loader, masker, output_format)
+
+        sql_masked, changed = builder.update(datasets, entities, token_budget)
+
+        # Та же выборка при генерации промпта возьмет готовый контекст вместо нового обхода
+        # (урезанный контекст уже лежит в кэше под своим вариантом)
+        if token_budget is None:
+            ResolutionCache.instance().get_or_resolve(
+                loader, datasets, entities, lambda: Resolution(builder.context_copy())
+            )
+
+        logger.info(f"Контекст обновлен (изменились таблицы: {sorted(changed)}). Размер SQL: {len(sql_masked)} символов.")
+        return builder, sql_masked, masker.map_forward.copy()
+
+    @staticmethod
+    def _masked_generator(
+        loader: DbDataLoader, masker: ContextMasker, resolution: Resolution, output_format: str
+    ) -> OutputGenerator:
+        """
+        Генератор маскированного SQL выборки с уже зарегистрированными масками контекста
+        (OutputGenerator.register_masks). Общий шаг generate_final_prompts и iter_final_prompt:
+        генерация после него не меняет словарь, поэтому оба пути дают один и тот же промпт.
+        """
+        gen_masked = OutputGenerator(loader, resolution.context_copy(), masker=masker, output_format=output_format)
+        gen_masked.register_masks()
+        return gen_masked
+
     @staticmethod
     def generate_final_prompts(
         loader: DbDataLoader,
@@ -64,29 +486,52 @@ class ContextService:
         datasets: List[str],
         entities: List[str],
         system_prompt: str,
-        user_query: str
+        user_query: str,
+        max_tokens: Optional[int] = None,
+        output_format: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         Генерирует два варианта промптов: Маскированный (для LLM) и Оригинальный (для проверки).
         Используется для кнопки "Сгенерировать промпт".
+        Если задан max_tokens, контекст урезается так, чтобы весь промпт уложился в лимит
+        (отчет о пропущенном — в ключе "budget_report").
+        output_format — формат контекста в обоих промптах (по умолчанию CONTEXT_FORMAT).
+        Маски контекста регистрируются до генерации (OutputGenerator.register_masks), поэтому формулы
+        маскируются полным словарем: имя, которое раньше оставалось открытым, если встречалось в контексте
+        только ниже формулы, теперь тоже заменяется маской.
         """
         logger.info("Начало полной генерации промптов")
+        output_format = output_format or CONTEXT_FORMAT
         
-        # 1. Резолвинг (строим контекст заново для надежности)
-        resolver = ContextResolver(loader)
-        if datasets or entities:
-            for ds in datasets: resolver.resolve_by_dataset(ds)
-            for ent in entities: resolver.resolve_by_entity(ent)
+        # 1. Резолвинг: та же выборка, что в pick_context, берется из кэша
+        resolution = ContextService._prompt_resolution(
+            loader, datasets, entities, system_prompt, user_query, max_tokens, output_format
+        )
         
         # 2. Генерация МАСКИРОВАННОГО SQL
         # Предполагаем, что masker уже содержит нужные маски (после pick_context),
-        # либо наполняем его сейчас.
-        gen_masked = OutputGenerator(loader, resolver.context, masker=masker)
-        sql_masked = gen_masked.generate_sql()
+        # либо наполняем его сейчас до генерации (_masked_generator). Если прошлая генерация этой выборки не добавила масок
+        # и маскер с тех пор не менялся, результат будет тем же — берем готовый SQL.
+        # 3. Генерация ОРИГИНАЛЬНОГО SQL (без маскера); от маскера не зависит — один раз на выборку.
+        # Если нужны оба варианта, они строятся за один обход строк (generate_sql_dual).
+        sql_masked = resolution.masked_sql(masker, output_format)
+        sql_original = resolution.original_sql(output_format)
+        if sql_masked is None:
+            gen_masked = ContextService._masked_generator(loader, masker, resolution, output_format)
+            version_before = masker.version
+            if sql_original is None:
+                sql_masked, sql_original = gen_masked.generate_sql_dual()
+                resolution.remember_original_sql(output_format, sql_original)
+            else:
+                sql_masked = gen_masked.generate_sql()
+            resolution.remember_masked_sql(masker, output_format, sql_masked, version_before)
+        else:
+            logger.info("Маскированный SQL взят из кэша подбора контекста")
         
-        # 3. Генерация ОРИГИНАЛЬНОГО SQL (передаем masker=None)
-        gen_orig = OutputGenerator(loader, resolver.context, masker=None)
-        sql_original = gen_orig.generate_sql()
+        if sql_original is None:
+            gen_orig = OutputGenerator(loader, resolution.context_copy(), masker=None, output_format=output_format)
+            sql_original = gen_orig.generate_sql()
+            resolution.remember_original_sql(output_format, sql_original)
         
         # 4. Маскирование текстовых полей (System Prompt и User Query)
         system_prompt_masked = masker.mask_text(system_prompt)
@@ -121,5 +566,168 @@ class ContextService:
             "final_prompt_original": final_prompt_original,
             "sql_original": sql_original,
             "token_count": token_count,
-            "masking_dict": masker.map_forward.copy()
-        }
\ No newline at end of file
+            "masking_dict": masker.map_forward.copy(),
+            "budget_report": resolution.report
+        }
+
+    @staticmethod
+    def iter_final_prompt(
+        loader: DbDataLoader,
+        masker: ContextMasker,
+        namespace_id: str,
+        datasets: List[str],
+        entities: List[str],
+        system_prompt: str,
+        user_query: str,
+        masked: bool = True,
+        max_tokens: Optional[int] = None,
+        output_format: Optional[str] = None
+    ) -> Iterator[str]:
+        """
+        Потоковый вариант generate_final_prompts для одного промпта (masked — маскированный или оригинальный).
+        SQL-контекст отдается по таблицам (OutputGenerator.iter_sql), поэтому большой промпт можно писать
+        в файл или поток частями: "".join(...) дает тот же текст, пиковая память — одна таблица.
+
+        Системный промпт идет перед SQL, поэтому маски контекста регистрируются заранее — тем же шагом,
+        что в generate_final_prompts (_masked_generator): "".join(...) совпадает с "final_prompt_masked".
+        """
+        output_format = output_format or CONTEXT_FORMAT
+        resolution = ContextService._prompt_resolution(
+            loader, datasets, entities, system_prompt, user_query, max_tokens, output_format
+        )
+        generator = PromptGenerator()
+
+        if not masked:
+            sql_original = resolution.original_sql(output_format)
+            if sql_original is not None:
+                sql_chunks = [sql_original]
+            else:
+                sql_chunks = OutputGenerator(
+                    loader, resolution.context_copy(), masker=None, output_format=output_format
+                ).iter_sql()
+            yield from generator.iter_prompt(system_prompt, user_query, namespace_id, sql_chunks)
+            return
+
+        sql_masked = resolution.masked_sql(masker, output_format)
+        if sql_masked is not None:
+            logger.info("Маскированный SQL взят из кэша подбора контекста")
+            sql_chunks = [sql_masked]
+        else:
+            gen_masked = ContextService._masked_generator(loader, masker, resolution, output_format)
+            sql_chunks = gen_masked.iter_sql()
+
+        yield from generator.iter_prompt(
+            masker.mask_text(system_prompt), masker.mask_text(user_query), namespace_id, sql_chunks
+        )
+
+    @staticmethod
+    def format_token_report(
+        loader: DbDataLoader,
+        datasets: List[str],
+        entities: List[str],
+        masked: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        Бенчмарк форматов контекста: один и тот же контекст выборки в каждом из
+        OutputGenerator.OUTPUT_FORMATS — размер в символах и токенах (TokenCounter).
+        Маскирование — отдельным маскером на каждый формат, чтобы словарь сессии не менялся.
+        Токены считаются по блокам таблиц (OutputGenerator.iter_sql), как только блок отрендерен,
+        без склейки всего скрипта. Сумма по блокам отличается от подсчета по всему тексту не больше
+        чем на токен на блок (стыки блоков у токенизатора, округление у упрощенного подсчета).
+
+        Returns:
+            List[Dict]: [{'format', 'chars', 'tokens', 'ratio'}], ratio — доля токенов от формата sql.
+        """
+        resolution = ContextService._resolution(loader, datasets, entities)
+        report = []
+        for output_format in OutputGenerator.OUTPUT_FORMATS:
+            gen = OutputGenerator(
+                loader, resolution.context_copy(), masker=ContextMasker() if masked else None,
+                output_format=output_format
+            )
+            chars = tokens = 0
+            for block in gen.iter_sql():
+                chars += len(block)
+                tokens += TokenCounter.count_tokens(block)
+            report.append({
+                'format': output_format,
+                'chars': chars,
+                'tokens': tokens,
+            })
+        base = report[0]['tokens'] or 1
+        for row in report:
+            row['ratio'] = round(row['tokens'] / base, 3)
+            logger.info(f"Формат {row['format']}: {row['chars']} символов, {row['tokens']} токенов ({row['ratio']:.0%} от sql)")
+        return report
+
+
+class ContextBuilder:
+    """
+    Состояние инкрементального подбора контекста одной сессии (см. ContextService.update_context).
+    Резолвер хранит выбранные корни со счетчиками ссылок, генератор — SQL каждой таблицы.
+    Маскер между обновлениями не сбрасывается: маски уже показанных объектов не меняются,
+    а маски объектов, убранных из выборки, остаются в словаре (для расшифровки прошлых ответов).
+    """
+
+    def __init__(self, loader: DbDataLoader, masker: ContextMasker, output_format: str = CONTEXT_FORMAT) -> None:
+        self.loader = loader
+        self.masker = masker
+        self.output_format = output_format
+        self.resolver = ContextService._make_resolver(loader)
+        self.generator = OutputGenerator(loader, self.resolver.context, masker=masker, output_format=output_format)
+        # Поколение маскера, с которым сгенерирован SQL таблиц (после clear() он недействителен)
+        self.epoch = masker.epoch
+        # Бюджет токенов текущего контекста (None — полный) и отчет последнего подбора с бюджетом
+        self.token_budget: Optional[int] = None
+        self.report: Optional[Dict[str, Any]] = None
+
+    def is_valid_for(self, loader: DbDataLoader, masker: ContextMasker, output_format: str = CONTEXT_FORMAT) -> bool:
+        """Можно ли обновлять это состояние (тот же загрузчик, маскер и формат, маскер не сбрасывался)."""
+        return (self.loader is loader and self.masker is masker and masker.epoch == self.epoch
+                and self.output_format == output_format)
+
+    def update(
+        self, datasets: List[str], entities: List[str], token_budget: Optional[int] = None
+    ) -> Tuple[str, Set[str]]:
+        """
+        Приводит контекст к новой выборке.
+        С token_budget контекст берется из ContextService._budgeted_resolution (урезанный по приоритету),
+        а SQL перегенерируется так же инкрементально — только изменившиеся таблицы.
+        Returns:
+            Tuple[str, Set[str]]: (Маскированный SQL, Таблицы, набор PK которых изменился)
+        """
+        if token_budget is not None:
+            resolution = ContextService._budgeted_resolution(
+                self.loader, datasets, entities, token_budget, self.output_format
+            )
+            resolver = ContextService._make_resolver(self.loader)
+            resolver.context.update(resolution.context_copy())
+            changed = self._replace_resolver(resolver)
+            self.report = resolution.report
+        else:
+            if self.token_budget is not None:
+                # Урезанный контекст не разложен по корням: счетчики ссылок строятся заново
+                resolver = ContextService._make_resolver(self.loader)
+                resolver.sync(datasets, entities)
+                changed = self._replace_resolver(resolver)
+            else:
+                changed = self.resolver.sync(datasets, entities)
+            self.report = None
+        self.token_budget = token_budget
+        return self.generator.generate_sql(changed), changed
+
+    def _replace_resolver(self, resolver: ContextResolver) -> Set[str]:
+        """
+        Подменяет резолвер (и контекст генератора) новым.
+        Returns:
+            Set[str]: Таблицы, набор PK которых отличается от прежнего контекста.
+        """
+        previous = self.generator.context
+        self.resolver = resolver
+        self.generator.context = resolver.context
+        tables = (set(previous) | set(resolver.context)) - {'tenants'}
+        return {table for table in tables if set(previous.get(table, ())) != set(resolver.context.get(table, ()))}
+
+    def context_copy(self) -> Dict[str, Set[Tuple]]:
+        """Копия текущего контекста (без тенантов, которые добавляет OutputGenerator)."""
+        return {table: set(pks) for table, pks in self.resolver.context.items() if pks and table != 'tenants'}
@@ -20,6 +20,20 @@ class DatabaseManager:
     # Статическая переменная для хранения пула соединений (один на всё приложение)
     _connection_pool: Optional[pool.SimpleConnectionPool] = None
 
+    # Таблицы, которые зависят от namespace (фильтруем по namespace_id)
+    NAMESPACE_TABLES: List[str] = [
+        'namespaces', 'clients', 'entities', 'composed_entities', 
+        'entity_properties', 'tables', 'table_fields', 'parameters', 
+        'constraints', 'composed_constraints', 'vertices', 
+        'vertex_functions', 'edges', 'filters', 'datasets',
+        'aggregation', 'limitation', 'ordering', 'group_by', 'order_by'
+    ]
+
+    # Глобальные таблицы (справочники), которые общие для всех
+    GLOBAL_TABLES: List[str] = [
+        'tenants'
+    ]
+
     def __init__(self) -> None:
         """Инициализация менеджера. Создает пул соединений, если его еще нет."""
         logger.info("Инициализация DatabaseManager")
@@ -149,25 +163,11 @@ class DatabaseManager:
         """
         logger.info(f"Начало загрузки контекста для namespace_id: {namespace_id}")
         context_data = {}
-        
-        # 1. Список таблиц, которые зависят от namespace (фильтруем по namespace_id)
-        namespace_tables = [
-            'namespaces', 'clients', 'entities', 'composed_entities', 
-            'entity_properties', 'tables', 'table_fields', 'parameters', 
-            'constraints', 'composed_constraints', 'vertices', 
-            'vertex_functions', 'edges', 'filters', 'datasets',
-            'aggregation', 'limitation', 'ordering', 'group_by', 'order_by'
-        ]
-        
-        # 2. Глобальные таблицы (справочники), которые общие для всех
-        global_tables = [
-            'tenants'
-        ]
 
         try:
             with self.get_cursor() as cursor:
                 # А. Грузим глобальные данные (без фильтрации)
-                for table in global_tables:
+                for table in self.GLOBAL_TABLES:
                     query = f"SELECT * FROM qe_config.{table}"
                     cursor.execute(query)
                     rows = cursor.fetchall()
@@ -175,7 +175,7 @@ class DatabaseManager:
                     logger.debug(f"Загружено {len(rows)} строк из глобальной таблицы {table}")
 
                 # Б. Грузим данные конкретного namespace
-                for table in namespace_tables:
+                for table in self.NAMESPACE_TABLES:
                     query = f"SELECT * FROM qe_config.{table} WHERE namespace_id = %s"
                     cursor.execute(query, (namespace_id,))
                     rows = cursor.fetchall()
@@ -189,6 +189,118 @@ class DatabaseManager:
             logger.error(f"🔥 Ошибка загрузки контекста namespace {namespace_id}: {e}", exc_info=True)
             raise e
 
+    def fetch_namespace_fingerprint(self, namespace_id: str) -> Dict[str, Dict[str, int]]:
+        """
+        Легкий "отпечаток" данных namespace: для каждой таблицы число строк и
+        агрегаты по системной колонке xmin (меняется при INSERT/UPDATE каждой строки).
+        Один запрос без передачи самих строк; используется как версия данных для снимков.
+
+        Returns:
+            Dict: {'table_name': {'rows': N, 'max_xmin': X, 'xmin_sum': S}}
+        """
+        logger.info(f"Запрос отпечатка данных namespace {namespace_id}")
+        parts = []
+        params: List[Any] = []
+        for table in self.GLOBAL_TABLES + self.NAMESPACE_TABLES:
+            where = "" if table in self.GLOBAL_TABLES else " WHERE namespace_id = %s"
+            parts.append(
+                f"SELECT '{table}' AS table_name, count(*) AS row_count, "
+                f"coalesce(max(xmin::text::bigint), 0) AS max_xmin, "
+                f"coalesce(sum(xmin::text::bigint), 0) AS xmin_sum "
+                f"FROM qe_config.{table}{where}"
+            )
+            if where:
+                params.append(namespace_id)
+
+        with self.get_cursor() as cursor:
+            cursor.execute(" UNION ALL ".join(parts), params)
+            return {
+                row['table_name']: {
+                    'rows': int(row['row_count']),
+                    'max_xmin': int(row['max_xmin']),
+                    'xmin_sum': int(row['xmin_sum']),
+                }
+                for row in cursor.fetchall()
+            }
+
+    def fetch_xmin_horizon(self) -> int:
+        """
+        Нижняя граница xmin для следующей дельты: все транзакции с меньшим номером
+        на момент вызова уже завершены. Строки, закоммиченные позже, получат xmin не меньше этой границы.
+        Значение приводится к 32 битам, как системная колонка xmin.
+        """
+        with self.get_cursor() as cursor:
+            cursor.execute(
+                "SELECT txid_snapshot_xmin(txid_current_snapshot()) % 4294967296 AS horizon"
+            )
+            return int(cursor.fetchone()['horizon'])
+
+    def fetch_namespace_delta(
+        self,
+        namespace_id: str,
+        tables: List[str],
+        since_xmin: int
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Выгружает только строки, вставленные или измененные начиная с транзакции since_xmin
+        (см. fetch_xmin_horizon). Удаленные строки сюда не попадают — для них fetch_namespace_keys.
+
+        Args:
+            namespace_id (str): ID неймспейса.
+            tables (List[str]): Таблицы, у которых изменился отпечаток.
+            since_xmin (int): Граница xmin, сохраненная при прошлой загрузке.
+
+        Returns:
+            Dict: {'table_name': [rows...]} только для переданных таблиц.
+        """
+        logger.info(f"Загрузка изменений namespace {namespace_id} (xmin >= {since_xmin}): {tables}")
+        delta: Dict[str, List[Dict[str, Any]]] = {}
+        with self.get_cursor() as cursor:
+            for table in tables:
+                if table in self.GLOBAL_TABLES:
+                    cursor.execute(
+                        f"SELECT * FROM qe_config.{table} WHERE xmin::text::bigint >= %s",
+                        (since_xmin,)
+                    )
+                else:
+                    cursor.execute(
+                        f"SELECT * FROM qe_config.{table} WHERE namespace_id = %s AND xmin::text::bigint >= %s",
+                        (namespace_id, since_xmin)
+                    )
+                delta[table] = cursor.fetchall()
+                logger.debug(f"Изменено {len(delta[table])} строк в {table}")
+        return delta
+
+    def fetch_namespace_keys(
+        self,
+        namespace_id: str,
+        key_columns: Dict[str, List[str]]
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Выгружает только колонки Primary Key (без остальных данных).
+        Используется, чтобы найти строки, удаленные после прошлой загрузки.
+
+        Args:
+            namespace_id (str): ID неймспейса.
+            key_columns (Dict): {'table_name': ['pk_col', ...]}.
+
+        Returns:
+            Dict: {'table_name': [{'pk_col': value, ...}, ...]}
+        """
+        keys: Dict[str, List[Dict[str, Any]]] = {}
+        with self.get_cursor() as cursor:
+            for table, columns in key_columns.items():
+                select = ", ".join(columns)
+                if table in self.GLOBAL_TABLES:
+                    cursor.execute(f"SELECT {select} FROM qe_config.{table}")
+                else:
+                    cursor.execute(
+                        f"SELECT {select} FROM qe_config.{table} WHERE namespace_id = %s",
+                        (namespace_id,)
+                    )
+                keys[table] = cursor.fetchall()
+        return keys
+
     def close_all_connections(self) -> None:
         """Закрывает пул соединений (при остановке приложения)"""
         if DatabaseManager._connection_pool is not None:
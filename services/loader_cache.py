@@ -0,0 +1,180 @@
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Any
+
+from config.settings import LOADER_CACHE_MAX_MB
+from core.context_engine import DbDataLoader
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class LoaderLease:
+    """
+    "Аренда" общего загрузчика из LoaderCache одной сессией.
+    Пока аренда жива, загрузчик не вытесняется из кэша. Освобождается явно через release()
+    или автоматически, когда объект удаляется (например, вместе с st.session_state завершенной сессии).
+    Загрузчик общий для всех сессий — изменять его нельзя (для изменений есть DbDataLoader.copy()).
+    """
+
+    def __init__(self, cache: 'LoaderCache', key: Hashable, loader: DbDataLoader) -> None:
+        self.key = key
+        self.loader = loader
+        self._finalizer = weakref.finalize(self, cache._release, key)
+
+    def release(self) -> None:
+        """Возвращает загрузчик в кэш (повторный вызов ничего не делает)."""
+        self._finalizer()
+
+    @property
+    def released(self) -> bool:
+        return not self._finalizer.alive
+
+
+class _CacheEntry:
+    """Загрузчик в кэше: число активных аренд и оценка занимаемой памяти."""
+
+    def __init__(self, loader: DbDataLoader, nbytes: int) -> None:
+        self.loader = loader
+        self.nbytes = nbytes
+        self.refs = 0
+
+
+class _Flight:
+    """Загрузка, которая выполняется прямо сейчас: остальные запросы того же ключа ждут её результат."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class LoaderCache:
+    """
+    Общий для процесса кэш неизменяемых DbDataLoader.
+    Ключ — (namespace_id, версия данных, режим хранения), поэтому сессии с одним namespace
+    используют один проиндексированный загрузчик и одну выгрузку из Postgres.
+
+    - Подсчет ссылок: каждая выдача — LoaderLease, занятые загрузчики не вытесняются.
+    - LRU: при превышении бюджета памяти вытесняются давно не использованные свободные загрузчики.
+    - Single-flight: параллельные запросы одного ключа ждут одну загрузку, а не запускают свои.
+    """
+
+    # Один экземпляр на процесс (как пул соединений в DatabaseManager)
+    _instance: Optional['LoaderCache'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_bytes: int = LOADER_CACHE_MAX_MB * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, _CacheEntry]' = OrderedDict()
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def instance(cls) -> 'LoaderCache':
+        """Возвращает общий кэш процесса (создается при первом обращении)."""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+                    logger.info(f"LoaderCache создан, бюджет памяти {LOADER_CACHE_MAX_MB} MB")
+        return cls._instance
+
+    def acquire(self, key: Hashable, factory: Callable[[], DbDataLoader]) -> LoaderLease:
+        """
+        Выдает загрузчик по ключу. Если его нет в кэше, создает через factory();
+        одновременные запросы того же ключа ждут эту же загрузку.
+
+        Raises:
+            Exception: Ошибка factory() пробрасывается всем ожидающим, в кэш ничего не попадает.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    return self._lease(key, entry)
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+
+            if not leader:
+                flight.done.wait()
+                if flight.error is not None:
+                    raise flight.error
+                # Загрузчик уже в кэше: забираем его на следующей итерации
+                continue
+
+            try:
+                loader = factory()
+                nbytes = loader.estimate_nbytes()
+            except BaseException as e:
+                with self._lock:
+                    flight.error = e
+                    del self._inflight[key]
+                flight.done.set()
+                raise
+
+            with self._lock:
+                entry = self._entries[key] = _CacheEntry(loader, nbytes)
+                self.misses += 1
+                lease = self._lease(key, entry)
+                del self._inflight[key]
+                self._evict()
+            flight.done.set()
+            logger.info(f"LoaderCache: загружен {key} (~{nbytes / 1024 / 1024:.1f} MB), "
+                        f"в кэше {len(self._entries)}, занято ~{self.total_bytes() / 1024 / 1024:.1f} MB")
+            return lease
+
+    def _lease(self, key: Hashable, entry: _CacheEntry) -> LoaderLease:
+        """Выдает аренду (вызывается под self._lock)."""
+        entry.refs += 1
+        self._entries.move_to_end(key)
+        return LoaderLease(self, key, entry.loader)
+
+    def _release(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs == 0:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Вытесняет свободные загрузчики, начиная с самых старых, пока кэш не уложится в бюджет."""
+        total = sum(entry.nbytes for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.refs > 0:
+                continue
+            del self._entries[key]
+            total -= entry.nbytes
+            self.evictions += 1
+            logger.info(f"LoaderCache: вытеснен {key} (~{entry.nbytes / 1024 / 1024:.1f} MB)")
+        if total > self.max_bytes:
+            logger.warning(f"LoaderCache: занятые загрузчики (~{total / 1024 / 1024:.1f} MB) "
+                           f"не укладываются в бюджет {self.max_bytes / 1024 / 1024:.0f} MB")
+
+    def total_bytes(self) -> int:
+        """Оценка памяти, занятой всеми загрузчиками в кэше."""
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика кэша (для логов и отладки)."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'leases': sum(entry.refs for entry in self._entries.values()),
+                'bytes': sum(entry.nbytes for entry in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
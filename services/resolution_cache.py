@@ -0,0 +1,149 @@
+import threading
+import weakref
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, FrozenSet, Hashable, Iterable, Optional, Set, Tuple, Any
+
+from config.settings import RESOLUTION_CACHE_SIZE
+from core.context_engine import DbDataLoader
+from core.masking import ContextMasker
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Выборка пользователя: (datasets, entities) без учета порядка и повторов + вариант подбора (например, бюджет)
+SelectionKey = Tuple[FrozenSet[str], FrozenSet[str], Hashable]
+
+
+class Resolution:
+    """
+    Подобранный контекст одной выборки и SQL, уже сгенерированный по нему.
+    Оригинальный SQL зависит только от загрузчика и контекста, маскированный — еще и от состояния
+    маскера, поэтому хранится для каждого маскера вместе с его версией (ContextMasker.version).
+
+    Маскированный SQL запоминается, только если генерация не добавила в маскер ни одной маски.
+    Маскирование формул зависит от уже известных масок (Entity.Property маскируется, только если
+    сущность зарегистрирована), поэтому первая генерация с пустым маскером и повторная дают разный SQL.
+    Повторная генерация с тем же маскером совпадает с сохраненной, только если маскер не менялся.
+    Оба варианта хранятся отдельно для каждого формата контекста (OutputGenerator.OUTPUT_FORMATS).
+    """
+
+    def __init__(self, context: Dict[str, Set[Tuple]], report: Optional[Dict[str, Any]] = None) -> None:
+        self.context = context
+        # Отчет подбора с бюджетом токенов (ContextResolver.resolve_budgeted), для обычного подбора None
+        self.report = report
+        self._original: Dict[str, str] = {}
+        self._masked: 'weakref.WeakKeyDictionary[ContextMasker, Dict[str, Tuple[int, str]]]' = \
+            weakref.WeakKeyDictionary()
+
+    def context_copy(self) -> Dict[str, Set[Tuple]]:
+        """Копия контекста для OutputGenerator (он дополняет контекст тенантами)."""
+        return defaultdict(set, {table: set(pks) for table, pks in self.context.items()})
+
+    def original_sql(self, output_format: str) -> Optional[str]:
+        """Оригинальный SQL в формате output_format, если уже сгенерирован."""
+        return self._original.get(output_format)
+
+    def remember_original_sql(self, output_format: str, sql: str) -> None:
+        self._original[output_format] = sql
+
+    def masked_sql(self, masker: ContextMasker, output_format: str) -> Optional[str]:
+        """Маскированный SQL, если маскер не менялся с момента генерации, иначе None."""
+        cached = self._masked.get(masker, {}).get(output_format)
+        if cached is None or cached[0] != masker.version:
+            return None
+        return cached[1]
+
+    def remember_masked_sql(self, masker: ContextMasker, output_format: str, sql: str, version_before: int) -> None:
+        """
+        Запоминает SQL, только что сгенерированный с этим маскером.
+        version_before — версия маскера перед генерацией: если она изменилась, SQL не сохраняется.
+        """
+        by_format = self._masked.get(masker)
+        if by_format is None:
+            by_format = self._masked[masker] = {}
+        if masker.version == version_before:
+            by_format[output_format] = (version_before, sql)
+        else:
+            by_format.pop(output_format, None)
+
+
+class ResolutionCache:
+    """
+    Общий для процесса кэш подобранных контекстов.
+    Ключ — (загрузчик, frozenset(datasets), frozenset(entities)): "Подобрать контекст" и
+    "Сгенерировать промпт" для той же выборки не обходят граф повторно, оригинальный SQL
+    генерируется один раз, а маскированный — пока маскер не меняется (см. Resolution).
+
+    Загрузчики хранятся по слабым ссылкам: вместе с загрузчиком (вытеснен из LoaderCache,
+    заменен обновленной копией) исчезают и его выборки. На загрузчик — LRU из RESOLUTION_CACHE_SIZE выборок.
+    """
+
+    _instance: Optional['ResolutionCache'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_selections: int = RESOLUTION_CACHE_SIZE) -> None:
+        self.max_selections = max_selections
+        self._lock = threading.Lock()
+        self._by_loader: 'weakref.WeakKeyDictionary[DbDataLoader, OrderedDict[SelectionKey, Resolution]]' = \
+            weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def instance(cls) -> 'ResolutionCache':
+        """Возвращает общий кэш процесса (создается при первом обращении)."""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def selection_key(datasets: Iterable[str], entities: Iterable[str], variant: Hashable = None) -> SelectionKey:
+        return frozenset(datasets), frozenset(entities), variant
+
+    def get_or_resolve(
+        self,
+        loader: DbDataLoader,
+        datasets: Iterable[str],
+        entities: Iterable[str],
+        resolve: Callable[[], Resolution],
+        variant: Hashable = None
+    ) -> Resolution:
+        """
+        Возвращает Resolution выборки; при промахе строит её через resolve().
+        variant различает способы подбора одной выборки (None — полный контекст, ('budget', N, формат) — с бюджетом).
+        Обход графа выполняется без блокировки: параллельный промах той же выборки
+        просто посчитает контекст дважды.
+        """
+        key = self.selection_key(datasets, entities, variant)
+        with self._lock:
+            selections = self._by_loader.get(loader)
+            resolution = selections.get(key) if selections is not None else None
+            if resolution is not None:
+                selections.move_to_end(key)
+                self.hits += 1
+                return resolution
+            self.misses += 1
+
+        resolution = resolve()
+        with self._lock:
+            selections = self._by_loader.get(loader)
+            if selections is None:
+                selections = self._by_loader[loader] = OrderedDict()
+            # Если параллельный запрос успел раньше — используем его результат (и его SQL)
+            resolution = selections.setdefault(key, resolution)
+            selections.move_to_end(key)
+            while len(selections) > self.max_selections:
+                selections.popitem(last=False)
+        return resolution
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика кэша (для логов и отладки)."""
+        with self._lock:
+            return {
+                'loaders': len(self._by_loader),
+                'selections': sum(len(s) for s in self._by_loader.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
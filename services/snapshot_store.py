@@ -0,0 +1,265 @@
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from config.settings import SNAPSHOT_DIR, SNAPSHOT_KEEP
+from core.context_engine import DbDataLoader
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# ==========================================
+# 📦 ФОРМАТ ФАЙЛА СНИМКА
+# ==========================================
+# [MAGIC 6 байт][FORMAT_VERSION uint16][длина заголовка uint32][заголовок JSON]
+# [payload: pickle (protocol 5) загрузчика][буферы Arrow, выровненные по 64 байта]
+#
+# Буферы Arrow сериализуются вне pickle (out-of-band) и при загрузке
+# отдаются обратно как срезы mmap — данные таблиц не копируются в память процесса.
+#
+# ⚠️ РЕЖИМ 'dict': внешних буферов нет, строки таблиц лежат внутри payload.
+# pickle.loads сразу восстанавливает все строки как объекты Python, поэтому mmap
+# здесь экономит только одну копию файла при чтении: загрузка снимка занимает
+# столько же памяти, сколько полная выгрузка, и время растет с размером namespace.
+# Выигрыш снимка в этом режиме — без SELECT из БД и без повторной индексации.
+# Ленивое чтение с диска дает только режим 'arrow' (LOADER_STORAGE=arrow).
+#
+# Заголовок хранит SHA-256 секции данных (payload + буферы). Перед pickle.loads
+# проверяются заголовок, границы секций и контрольная сумма, поэтому обрезанный
+# или поврежденный файл отбрасывается, а не распаковывается.
+#
+# ⚠️ ДОВЕРИЕ: pickle исполняет код при распаковке, а контрольная сумма защищает
+# только от порчи, но не от подмены (ее можно пересчитать). Каталог SNAPSHOT_DIR
+# должен быть доступен на запись только пользователю, от имени которого работает приложение.
+MAGIC = b'PBSNAP'
+FORMAT_VERSION = 2
+_PREFIX = struct.Struct('<6sHI')
+_ALIGN = 64
+SNAPSHOT_SUFFIX = '.pbsnap'
+
+
+def compute_content_hash(fingerprint: Dict[str, Any]) -> str:
+    """
+    Считает хэш содержимого namespace по "отпечатку" таблиц
+    (например, результат DatabaseManager.fetch_namespace_fingerprint).
+    """
+    canonical = json.dumps(fingerprint, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class SnapshotStore:
+    """
+    Хранилище снимков проиндексированного DbDataLoader на диске.
+    Один файл на (namespace_id, content_hash, режим хранения). Позволяет стартовать
+    без 21 запроса SELECT * и без повторной индексации, а также работать
+    с последним известным снимком, когда PostgreSQL недоступен или медленный.
+    """
+
+    def __init__(self, directory: Path = SNAPSHOT_DIR) -> None:
+        self.directory = Path(directory)
+
+    def _path(self, namespace_id: str, content_hash: str, storage: str) -> Path:
+        return self.directory / f"{namespace_id}-{content_hash[:16]}-{storage}{SNAPSHOT_SUFFIX}"
+
+    def exists(self, namespace_id: str, content_hash: str, storage: str = DbDataLoader.STORAGE_DICT) -> bool:
+        """Проверяет, есть ли снимок для указанной версии данных."""
+        return self._path(namespace_id, content_hash, storage).exists()
+
+    def save(self, loader: DbDataLoader, namespace_id: str, content_hash: str) -> Path:
+        """
+        Сериализует загрузчик в файл снимка (атомарно: через временный файл).
+
+        Returns:
+            Path: Путь к созданному файлу.
+        """
+        buffers: List[pickle.PickleBuffer] = []
+        payload = pickle.dumps(loader, protocol=5, buffer_callback=buffers.append)
+        raw_buffers = [buf.raw() for buf in buffers]
+
+        # Смещения в заголовке считаются от начала секции данных (она выровнена по 64 байта)
+        buffer_layout = []
+        offset = len(payload)
+        for raw in raw_buffers:
+            offset = self._align(offset)
+            buffer_layout.append([offset, raw.nbytes])
+            offset += raw.nbytes
+
+        checksum = hashlib.sha256(payload)
+        for raw in raw_buffers:
+            checksum.update(raw)
+
+        header: Dict[str, Any] = {
+            'namespace_id': str(namespace_id),
+            'content_hash': content_hash,
+            'loader_version': DbDataLoader.SNAPSHOT_VERSION,
+            'storage': loader.storage,
+            'created': datetime.now().isoformat(),
+            'payload': [0, len(payload)],
+            'buffers': buffer_layout,
+            'sha256': checksum.hexdigest(),
+        }
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = self._align(_PREFIX.size + len(header_bytes))
+
+        path = self._path(namespace_id, content_hash, loader.storage)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(path.suffix + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\0' * (data_start - f.tell()))
+            f.write(payload)
+            for (offset, _), raw in zip(buffer_layout, raw_buffers):
+                f.write(b'\0' * (data_start + offset - f.tell()))
+                f.write(raw)
+        os.replace(tmp_path, path)
+
+        size_mb = path.stat().st_size / 1024 / 1024
+        logger.info(f"💾 Снимок namespace {namespace_id} сохранен: {path} ({size_mb:.1f} MB)")
+        self.prune(namespace_id, loader.storage, keep_path=path)
+        return path
+
+    def prune(self, namespace_id: str, storage: str, keep: int = SNAPSHOT_KEEP,
+              keep_path: Optional[Path] = None) -> List[Path]:
+        """
+        Удаляет старые снимки namespace, оставляя keep самых свежих (по времени изменения).
+
+        Args:
+            namespace_id: ID неймспейса.
+            storage: Режим хранения ('dict'/'arrow'); снимки другого режима не трогаются.
+            keep: Сколько снимков оставить (не меньше 1).
+            keep_path: Снимок, который нельзя удалять (только что записанный).
+
+        Returns:
+            List[Path]: Удаленные файлы.
+        """
+        candidates = sorted(self._snapshot_paths(namespace_id, storage),
+                            key=lambda p: p.stat().st_mtime, reverse=True)
+        if keep_path is not None and keep_path in candidates:
+            candidates.remove(keep_path)
+            candidates.insert(0, keep_path)
+        removed = []
+        for old in candidates[max(keep, 1):]:
+            try:
+                old.unlink()
+                removed.append(old)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старый снимок {old}: {e}")
+        if removed:
+            logger.info(f"🧹 Удалено старых снимков namespace {namespace_id}: {len(removed)}")
+        return removed
+
+    def load(
+        self,
+        namespace_id: str,
+        content_hash: Optional[str] = None,
+        storage: str = DbDataLoader.STORAGE_DICT
+    ) -> Optional[DbDataLoader]:
+        """
+        Загружает загрузчик из снимка через memory-map.
+        Таблицы Arrow ссылаются на отображенный файл; в режиме 'dict' все строки
+        распаковываются в память сразу (см. заголовок модуля).
+
+        Args:
+            namespace_id: ID неймспейса.
+            content_hash: Версия данных. Если None — берется самый свежий снимок namespace.
+            storage: Режим хранения загрузчика ('dict'/'arrow').
+
+        Returns:
+            DbDataLoader или None, если подходящего (совместимого) снимка нет.
+        """
+        if content_hash is not None:
+            path = self._path(namespace_id, content_hash, storage)
+            if not path.exists():
+                return None
+        else:
+            path = self.latest_path(namespace_id, storage)
+            if path is None:
+                return None
+
+        try:
+            loader, header = self._read(path, namespace_id)
+        except Exception as e:
+            logger.warning(f"Снимок {path} не прочитан, будет проигнорирован: {e}")
+            return None
+        if content_hash is not None and header.get('content_hash') != content_hash:
+            logger.warning(f"Снимок {path} относится к другой версии данных, игнорируем")
+            return None
+        logger.info(f"⚡ Namespace {namespace_id} загружен из снимка {path.name} ({header.get('created')})")
+        return loader
+
+    def latest_path(self, namespace_id: str, storage: str = DbDataLoader.STORAGE_DICT) -> Optional[Path]:
+        """Возвращает путь к самому свежему снимку namespace (по времени изменения файла)."""
+        candidates = self._snapshot_paths(namespace_id, storage)
+        if not candidates:
+            return None
+        return max(candidates, key=lambda p: p.stat().st_mtime)
+
+    def _snapshot_paths(self, namespace_id: str, storage: str) -> List[Path]:
+        """
+        Файлы снимков ровно этого namespace и режима хранения.
+        Имя разбирается справа ({namespace_id}-{hash}-{storage}), поэтому снимки
+        namespace '1-a' не принимаются за снимки namespace '1', а спецсимволы
+        glob в namespace_id ничего не расширяют.
+        """
+        if not self.directory.exists():
+            return []
+        result = []
+        for path in self.directory.iterdir():
+            if not path.name.endswith(SNAPSHOT_SUFFIX):
+                continue
+            parts = path.name[:-len(SNAPSHOT_SUFFIX)].rsplit('-', 2)
+            if len(parts) == 3 and parts[0] == str(namespace_id) and parts[2] == storage:
+                result.append(path)
+        return result
+
+    def _read(self, path: Path, namespace_id: Optional[str] = None) -> Tuple[DbDataLoader, Dict[str, Any]]:
+        """
+        Читает заголовок и восстанавливает загрузчик из mmap файла.
+        До pickle.loads проверяются формат, заголовок, границы секций и SHA-256 данных.
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        if len(view) < _PREFIX.size:
+            raise ValueError("файл короче заголовка")
+        magic, version, header_len = _PREFIX.unpack_from(view, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"неподдерживаемый формат снимка (magic={magic!r}, version={version})")
+        if _PREFIX.size + header_len > len(view):
+            raise ValueError("заголовок выходит за границы файла")
+        header = json.loads(bytes(view[_PREFIX.size:_PREFIX.size + header_len]))
+        if header.get('loader_version') != DbDataLoader.SNAPSHOT_VERSION:
+            raise ValueError(f"снимок создан другой версией DbDataLoader ({header.get('loader_version')})")
+        if namespace_id is not None and header.get('namespace_id') != str(namespace_id):
+            raise ValueError(f"снимок относится к namespace {header.get('namespace_id')!r}")
+
+        data_start = self._align(_PREFIX.size + header_len)
+        payload_offset, payload_len = header['payload']
+        sections = [(payload_offset, payload_len)] + [tuple(b) for b in header['buffers']]
+        if any(offset < 0 or length < 0 or data_start + offset + length > len(view)
+               for offset, length in sections):
+            raise ValueError("секции данных выходят за границы файла (файл обрезан?)")
+        # Срезы memoryview держат ссылку на mmap: файл остается отображенным,
+        # пока живут таблицы Arrow, которые на него ссылаются.
+        start = data_start + payload_offset
+        payload = view[start:start + payload_len]
+        buffers = [view[data_start + offset:data_start + offset + length]
+                   for offset, length in header['buffers']]
+        checksum = hashlib.sha256(payload)
+        for buf in buffers:
+            checksum.update(buf)
+        if checksum.hexdigest() != header.get('sha256'):
+            raise ValueError("контрольная сумма данных не совпадает")
+        loader = pickle.loads(payload, buffers=buffers)
+        return loader, header
+
+    @staticmethod
+    def _align(offset: int) -> int:
+        return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
@@ -0,0 +1,197 @@
+"""
+Корпус формул для проверки маскирования (ContextMasker.mask_formula).
+
+Эталон (tests/data/formula_golden.json) снят последовательными regex-проходами
+ревизии до лексера формул: для каждой формулы — результат и маски, которые она добавила
+в словарь (в порядке регистрации). Каждая формула маскируется новым маскером,
+подготовленным setup_masker. Пересоздать эталон на копии любой ревизии:
+
+    git worktree add /tmp/pb-016 <commit>
+    python tests/formula_cases.py --repo /tmp/pb-016
+
+Модуль не импортирует core на уровне модуля, чтобы при запуске скриптом
+маскер брался из указанной копии.
+"""
+import argparse
+import json
+import random
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+GOLDEN_PATH = Path(__file__).resolve().parent / 'data' / 'formula_golden.json'
+
+ENTITIES = ['person', 'acc', 'order']
+TABLES = ['orders', 'tbl_a']
+PARAMETERS = ['client_id', 'p_date', 'limit', 'x1']
+
+# Подготовка маскера: 'default' — обычный словарь; 'db_entity' — 'DB' еще и сущность;
+# 'params_collide' — среди параметров есть слово, которое вставляет разбор формулы
+SETUPS = ('default', 'db_entity', 'params_collide')
+
+# (setup, формула, причина отказа лексера или None): ручные случаи, в том числе
+# по примеру на каждую причину ContextMasker.FALLBACK_*
+CASES: List[Tuple[str, str, Optional[str]]] = [
+    ('default', "", None),
+    ('default', "sum(amount)", None),
+    ('default', "person.name", None),
+    ('default', "person.name + acc.amount * 2", None),
+    ('default', "unknown.name", None),
+    ('default', "orders.client_id", None),
+    ('default', "person.1st", None),
+    ('default', "{client_id}", None),
+    ('default', "{client_id} + {unknown_param} + {1x} + {b c}", None),
+    ('default', "if client_id != null then limit else 0", None),
+    ('default', "client_id.x1 + x1.client_id", None),
+    ('default', "'value_1'", None),
+    ('default', "'sum'", None),
+    ('default', "''", None),
+    ('default', "'it''s'", None),
+    ('default', "'person.name'", None),
+    ('default', "'{client_id}'", None),
+    ('default', "'client_id and x1'", None),
+    ('default', "'Привет мир'", None),
+    ('default', "'ENT_1.P_2'", None),
+    ('default', "'a' 'b'", None),
+    ('default', "dictGet('db.dict_1', 'col_1', k)", None),
+    ('default', "dictGet ( 'db.dict_1' , 'name' , k)", None),
+    ('default', "dictGet('db.d1', tuple('col_a', 'col_b'))", None),
+    ('default', "dictGet('db.d1', tuple('col_a', person.name, {client_id}, ''))", None),
+    ('default', "dictGet('db.d1', tuple())", None),
+    ('default', "dictGet\n(\n'dict_2', tuple ('c'))", None),
+    ('default', "tupleElement(t, 'col')", None),
+    ('default', "TupleElement( person.name , 'it''s' )", None),
+    ('default', "tupleelement(x.y, '')", None),
+    ('default', "if(person.name = 'x', dictGet('d', 'c', k), tupleElement(t, 'c'))", None),
+    ('default', "dictGet('d', 'c', k) + dictGet('d', 'c', k) + 'c' + 'd'", None),
+    ('default', "яperson.name + client_idя + яx1", None),
+    ('default', "{", None),
+    ('default', "}", None),
+    ('default', "f(", None),
+    # Отказы лексера
+    ('params_collide', "tuple + client_id + 'tuple'", 'params_collide'),
+    ('default', "x = 'abc", 'unpaired_quote'),
+    ('default', "dictGet('d', tuple('a)) + 'b'", 'unpaired_quote'),
+    ('default', "'a.b tupleElement(p, '''')'", 'nested_call'),
+    ('default', "dictGet('d', tuple(dictGet('e', 'c'), k))", 'call_in_tuple'),
+    ('default', "dictGet('d', tuple(tupleElement(t, 'c')))", 'call_in_tuple'),
+    ('default', "dictGet('d', 'c'')", 'quote_after_dictget'),
+    ('default', "xdictGet('a', 'b')", 'unlexed_call'),
+    ('default', "xtupleElement(t, 'c')", 'unlexed_call'),
+    ('db_entity', "dictGet('d', 'c', DB.x)", 'db_entity'),
+    ('db_entity', "dictGet('d', tuple('c'))", 'db_entity'),
+    # Без словарей 'DB' как сущность лексеру не мешает
+    ('db_entity', "DB.name + person.name", None),
+]
+
+
+def setup_masker(masker, setup: str):
+    """Готовит маскер к разбору формулы: сущности, таблицы, колонка и известные параметры."""
+    for entity in ENTITIES:
+        masker.register(entity, 'ENT')
+    for table in TABLES:
+        masker.register(table, 'TBL')
+    masker.register('name', 'COL')
+    if setup == 'db_entity':
+        masker.register('DB', 'ENT')
+    params = set(PARAMETERS)
+    if setup == 'params_collide':
+        params.add('tuple')
+    masker.set_known_parameters(params)
+    return masker
+
+
+class FormulaFuzzer:
+    """Случайные формулы из фрагментов, на которых regex-проходы влияют друг на друга."""
+
+    IDENTS = ENTITIES + TABLES + PARAMETERS + ['DB', 'ENT_1', 'TBL_x', 'name', 'amount', '1st', 'val',
+                                               'a', 'b', 'foo', 'bar_9', '_hid', 'sum', 'dictGet', 'tuple', 'if']
+    PROPS = ['name', 'amount', 'x1', '1st', 'client_id', 'val']
+    LITERALS = ['x', 'value_1', 'db.dict_1', 'a,b', 'a, b', 'f(x)', '', 'none', "it''s", 'person.name',
+                '{client_id}', 'client_id', 'acc.amount', 'name', 'Привет мир', 'order.val x', "''",
+                'ENT_1.P_2', 'sum', 'z.y_w']
+
+    def __init__(self, seed: int) -> None:
+        self.rnd = random.Random(seed)
+
+    def ident(self) -> str:
+        return self.rnd.choice(self.IDENTS)
+
+    def literal(self) -> str:
+        return "'" + self.rnd.choice(self.LITERALS) + "'"
+
+    def args(self) -> str:
+        choice = self.rnd.choice
+        return ', '.join(choice([self.literal(), self.ident(), f"{self.ident()}.{choice(self.PROPS)}",
+                                 '{client_id}', "''", self.literal() + self.literal()])
+                         for _ in range(self.rnd.randint(0, 3)))
+
+    def fragment(self, depth: int = 0) -> str:
+        choice = self.rnd.choice
+        k = self.rnd.random()
+        if k < .12:
+            return (f"dictGet{choice(['', ' ', chr(10)])}({choice(['', ' '])}'{choice(['db.d1', 'dict_2', 'x'])}'"
+                    f"{choice(['', ' '])},{choice(['', ' '])}tuple{choice(['', ' '])}({self.args()})")
+        if k < .22:
+            return (f"dictGet('{choice(['db.d1', 'dict_2', 'a.b'])}', '{choice(['col_1', 'name', 'client_id', 'ENT_1'])}'"
+                    f"{choice([', k)', ')', ' ', chr(39), ''])}")
+        if k < .30:
+            return (f"{choice(['tupleElement', 'TupleElement', 'tupleelement'])}"
+                    f"( {choice(['t', 'x.y', 'person.name', '1a'])} , {self.literal()} )")
+        if k < .40:
+            return '{' + choice(PARAMETERS + ['a', '1x', 'b c']) + '}'
+        if k < .60:
+            return f"{self.ident()}.{choice(self.PROPS + ['1', 'b'])}"
+        if k < .75:
+            return self.literal()
+        if k < .80 and depth < 2:
+            return f"if({self.fragment(depth + 1)}, {self.fragment(depth + 1)})"
+        if k < .83:
+            return choice(["'", '{', '}', ')', '(', "xdictGet('a', 'b')", "xtupleElement(t, 'c')",
+                           'я' + self.ident(), self.ident() + 'я'])
+        return self.ident()
+
+    def formula(self) -> str:
+        separator = self.rnd.choice([' ', ' + ', ' = ', ' and ', ', ', '', '\n'])
+        return separator.join(self.fragment() for _ in range(self.rnd.randint(1, 6)))
+
+
+def corpus() -> List[Tuple[str, str]]:
+    """(setup, формула): ручные случаи и случайные формулы с фиксированным seed."""
+    fuzzer = FormulaFuzzer(17)
+    result = [(setup, formula) for setup, formula, _ in CASES]
+    result += [(fuzzer.rnd.choice(SETUPS[:2]), fuzzer.formula()) for _ in range(600)]
+    return result
+
+
+def mask_case(masker_cls, setup: str, formula: str, mask) -> Dict[str, object]:
+    """Маскирует формулу новым маскером: {результат, добавленные маски [категория, значение, маска]}."""
+    masker = setup_masker(masker_cls(), setup)
+    before = len(masker.map_forward)
+    masked = mask(masker, formula)
+    added = [[category, value, m] for (category, value), m in list(masker.map_forward.items())[before:]]
+    return {'masked': masked, 'registered': added}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Снимает эталон tests/data/formula_golden.json')
+    parser.add_argument('--repo', required=True, help='Копия ревизии, чей разбор формул считается эталоном')
+    args = parser.parse_args()
+    sys.path.insert(0, str(Path(args.repo).resolve()))
+    import logging
+    logging.disable(logging.CRITICAL)
+    from core.masking import ContextMasker
+
+    golden = []
+    for setup, formula in corpus():
+        case = mask_case(ContextMasker, setup, formula, lambda m, f: m.mask_formula(f))
+        golden.append({'setup': setup, 'formula': formula, **case})
+    GOLDEN_PATH.parent.mkdir(exist_ok=True)
+    # Одна формула на строку: правки эталона видны в diff построчно
+    lines = ',\n'.join(json.dumps(case, ensure_ascii=False) for case in golden)
+    GOLDEN_PATH.write_text('[\n' + lines + '\n]\n', encoding='utf-8')
+    print(f'{len(golden)} formulas -> {GOLDEN_PATH}')
+
+
+if __name__ == '__main__':
+    main()
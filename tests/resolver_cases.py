@@ -0,0 +1,87 @@
+"""
+Сценарии подбора контекста для проверки эквивалентности резолверов.
+
+Эталонные отпечатки контекстов (tests/data/resolver_golden.json) сняты рекурсивным
+ContextResolver исходной ревизии (до индексов, WorklistResolver и ClosureIndex).
+Пересоздать эталон на копии любой ревизии:
+
+    git worktree add /tmp/pb-base <commit>
+    python tests/resolver_cases.py --repo /tmp/pb-base
+
+Модуль не импортирует core на уровне модуля, чтобы при запуске скриптом
+резолвер брался из указанной копии.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import random
+import sys
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+GOLDEN_PATH = Path(__file__).resolve().parent / 'data' / 'resolver_golden.json'
+
+NAMESPACE_ARGS = dict(n_entities=40, props_per_entity=15, n_params=100, n_tables=30, n_vertices=300,
+                      n_edges=400, n_datasets=60, n_constraints=200, seed=21)
+
+
+def make_raw(json_as_str: bool = True) -> Dict[str, List[Dict]]:
+    """Сырые данные синтетического namespace (tests/synth.py загружается по пути)."""
+    spec = importlib.util.spec_from_file_location('pb_synth', Path(__file__).resolve().parent / 'synth.py')
+    synth = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(synth)
+    return synth.make_namespace(json_as_str=json_as_str, **NAMESPACE_ARGS)
+
+
+def selections() -> List[Tuple[List[str], List[str]]]:
+    """Выборки (datasets, entities): по одному корню, случайные сочетания и несуществующие id."""
+    datasets = [f"ds{i}" for i in range(NAMESPACE_ARGS['n_datasets'])]
+    entities = [f"entity{i}" for i in range(NAMESPACE_ARGS['n_entities'])]
+    rnd = random.Random(7)
+    result = [([ds], []) for ds in datasets] + [([], [ent]) for ent in entities]
+    result += [(rnd.sample(datasets, rnd.randint(0, 12)), rnd.sample(entities, rnd.randint(0, 6)))
+               for _ in range(30)]
+    result += [(['missing'], ['missing']), ([], [])]
+    return result
+
+
+def context_digest(context: Dict[str, Set[Tuple]]) -> str:
+    """Отпечаток контекста, не зависящий от порядка обхода и типа контейнеров."""
+    canonical = {table: sorted(map(repr, pks)) for table, pks in context.items() if pks}
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def selection_key(datasets: List[str], entities: List[str]) -> str:
+    return ','.join(datasets) + '|' + ','.join(entities)
+
+
+def resolve(resolver_cls, loader, datasets: List[str], entities: List[str]) -> Tuple[Dict[str, Set[Tuple]], List[bool]]:
+    """Подбор через resolve_by_*: (контекст, результаты вызовов)."""
+    resolver = resolver_cls(loader)
+    found = [resolver.resolve_by_dataset(ds) for ds in datasets]
+    found += [resolver.resolve_by_entity(ent) for ent in entities]
+    return resolver.context, found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Снимает эталон tests/data/resolver_golden.json')
+    parser.add_argument('--repo', required=True, help='Копия ревизии, чей ContextResolver считается эталоном')
+    args = parser.parse_args()
+    sys.path.insert(0, str(Path(args.repo).resolve()))
+    import logging
+    logging.disable(logging.CRITICAL)
+    from core.context_engine import ContextResolver, DbDataLoader
+
+    loader = DbDataLoader(make_raw())
+    golden = {}
+    for datasets, entities in selections():
+        context, found = resolve(ContextResolver, loader, datasets, entities)
+        golden[selection_key(datasets, entities)] = {'context': context_digest(context), 'found': found}
+    GOLDEN_PATH.parent.mkdir(exist_ok=True)
+    GOLDEN_PATH.write_text(json.dumps(golden, indent=1, sort_keys=True) + '\n', encoding='utf-8')
+    print(f'{len(golden)} selections -> {GOLDEN_PATH}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Генератор синтетического namespace для тестов и бенчмарков.
+
+Формирует словарь «таблица → список строк» той же формы, что возвращает
+DatabaseManager.fetch_namespace_context: сущности со свойствами и формулами
+(SQL-функции, dictGet/tupleElement, параметры в фигурных скобках, Java-условия),
+таблицы, вершины, рёбра, ограничения и датасеты. Генерация детерминирована по seed.
+"""
+import json
+import random
+
+
+def make_namespace(n_entities=50, props_per_entity=40, n_params=200, n_tables=60,
+                   n_vertices=300, n_edges=400, n_datasets=60, n_constraints=300,
+                   seed=1, json_as_str=True):
+    """
+    Строит синтетический namespace.
+
+    Args:
+        n_entities: Количество сущностей.
+        props_per_entity: Количество свойств у каждой сущности.
+        n_params, n_tables, n_vertices, n_edges, n_datasets, n_constraints: Размеры остальных таблиц.
+        seed: Зерно генератора случайных чисел.
+        json_as_str: True — поля config хранятся строкой JSON (как в БД), False — словарём.
+
+    Returns:
+        dict: Сырые данные namespace для DbDataLoader.
+    """
+    rnd = random.Random(seed)
+    tenants = ['', 't1']
+    d = {k: [] for k in ['namespaces', 'tenants', 'clients', 'entities', 'composed_entities',
+                         'entity_properties', 'tables', 'table_fields', 'parameters', 'constraints',
+                         'composed_constraints', 'vertices', 'vertex_functions', 'edges', 'filters',
+                         'datasets', 'aggregation', 'limitation', 'ordering', 'group_by', 'order_by']}
+    J = (lambda o: json.dumps(o)) if json_as_str else (lambda o: o)
+    d['namespaces'].append({'namespace_id': 1, 'namespace_name': 'main'})
+    for t in tenants:
+        d['tenants'].append({'tenant_id': t, 'tenant_name': f'tenant {t or "default"}'})
+    ents = [f'entity{i}' for i in range(n_entities)]
+    params = [f'param_{i}' for i in range(n_params)]
+    for p in params:
+        d['parameters'].append({'namespace_id': 1, 'tenant_id': '', 'parameter_id': p,
+                                'request_path': '{a,' + p + '}', 'type': 'String', 'default_value': None})
+    props = []
+    for e in ents:
+        d['entities'].append({'namespace_id': 1, 'tenant_id': rnd.choice(tenants), 'entity_type': e,
+                              'entity_name': e.upper(), 'description': None})
+        for j in range(props_per_entity):
+            pid = f'prop{j}'
+            props.append((e, pid))
+    for i in range(n_entities // 10):
+        d['composed_entities'].append({'namespace_id': 1, 'tenant_id': '', 'composed_entity': ents[i],
+                                       'entity_type': ents[i + 1]})
+
+    def formula():
+        e, p = rnd.choice(props)
+        e2, p2 = rnd.choice(props)
+        kind = rnd.random()
+        if kind < 0.3:
+            return f"sum({e}.{p}) + {e2}.{p2}"
+        if kind < 0.5:
+            return f"dictGet('db.dict_{rnd.randint(0, 30)}', 'col_{rnd.randint(0, 9)}', tuple({e}.{p}, 'x'))"
+        if kind < 0.65:
+            return f"if({e}.{p} = {{{rnd.choice(params)}}}, 'value_{rnd.randint(0, 5)}', 'none')"
+        if kind < 0.8:
+            return f"{rnd.choice(params)} != null && {rnd.choice(params)}.equals(\"a\")"
+        if kind < 0.9:
+            return f"tupleElement(t.x, 'col_{rnd.randint(0, 9)}')\n    and dictGet('db.d_{rnd.randint(0, 9)}', tuple('a', 'b'))"
+        return None
+
+    for e, p in props:
+        d['entity_properties'].append({'namespace_id': 1, 'tenant_id': '', 'entity_type': e, 'property_id': p,
+                                       'type': 'String', 'calculation_func': formula(),
+                                       'aggregation_func': rnd.choice([None, 'max', f'groupArray({e}.{p})']),
+                                       'conversion_func': None, 'is_array': False})
+    tables = [f'tbl{i}' for i in range(n_tables)]
+    for t in tables:
+        d['tables'].append({'namespace_id': 1, 'tenant_id': '', 'table_id': t, 'physical_name': f'db.{t}_phys'})
+        for e, p in rnd.sample(props, 8):
+            d['table_fields'].append({'namespace_id': 1, 'tenant_id': '', 'table_id': t, 'entity_type': e,
+                                      'property_id': p, 'field_name': f'f_{p}'})
+    for i in range(n_constraints):
+        e, p = rnd.choice(props)
+        d['constraints'].append({'namespace_id': 1, 'tenant_id': '', 'constraint_id': i, 'entity_type': e,
+                                 'property_id': p, 'config': J({'parameter': rnd.choice(params)}),
+                                 'condition': formula()})
+    for i in range(n_constraints // 10):
+        d['composed_constraints'].append({'namespace_id': 1, 'tenant_id': '', 'constraint_id': 10000 + i,
+                                          'constraints': [rnd.randrange(n_constraints) for _ in range(3)],
+                                          'condition': 'a and b'})
+    for i in range(20):
+        d['aggregation'].append({'namespace_id': 1, 'tenant_id': '', 'aggregation_id': f'agg{i}', 'group_id': f'g{i}'})
+        d['limitation'].append({'namespace_id': 1, 'tenant_id': '', 'limitation_id': f'lim{i}',
+                                'total_limit': formula(), 'group_limit': formula()})
+        d['ordering'].append({'namespace_id': 1, 'tenant_id': '', 'ordering_id': f'ord{i}', 'order_id': f'o{i}'})
+        for k in range(2):
+            e, p = rnd.choice(props)
+            d['group_by'].append({'namespace_id': 1, 'tenant_id': '', 'group_id': f'g{i}', 'index': k,
+                                  'entity_type': e, 'property_id': p})
+            d['order_by'].append({'namespace_id': 1, 'tenant_id': '', 'order_id': f'o{i}', 'index': k,
+                                  'entity_type': e, 'property_id': p})
+    datasets = [f'ds{i}' for i in range(n_datasets)]
+    for i in range(n_vertices):
+        vt = rnd.choice(['table', 'table', 'dataset', 'calc'])
+        if vt == 'table':
+            conf = {'table': rnd.choice(tables), 'aggregation': f'agg{rnd.randrange(20)}'}
+        elif vt == 'dataset':
+            conf = {'dataset': rnd.choice(datasets), 'limitation': f'lim{rnd.randrange(20)}'}
+        else:
+            e, p = rnd.choice(props)
+            conf = {'fields': [{'entity': e, 'property': p, 'valueExpr': formula() or 'x'}],
+                    'ordering': f'ord{rnd.randrange(20)}'}
+        d['vertices'].append({'namespace_id': 1, 'tenant_id': '', 'vertex_id': i, 'vertex_type': vt,
+                              'config': J(conf), 'constraints': [rnd.randrange(n_constraints)]})
+        for e, p in rnd.sample(props, 3):
+            d['vertex_functions'].append({'namespace_id': 1, 'tenant_id': '', 'vertex_id': i, 'entity_type': e,
+                                          'property_id': p, 'calculation_func': formula(),
+                                          'aggregation_func': rnd.choice([None, 'sum'])})
+        d['filters'].append({'namespace_id': 1, 'tenant_id': '', 'vertex_id': i, 'index': 0,
+                             'config': J({'parameter': rnd.choice(params)})})
+    for i in range(n_edges):
+        d['edges'].append({'namespace_id': 1, 'tenant_id': '', 'edge_id': i,
+                           'source_vertex': rnd.randrange(n_vertices), 'target_vertex': rnd.randrange(n_vertices),
+                           'constraints': [rnd.randrange(n_constraints)], 'config': J({'x': 1}),
+                           'condition': formula()})
+    for i, ds in enumerate(datasets):
+        e = rnd.choice(ents)
+        d['datasets'].append({'namespace_id': 1, 'tenant_id': '', 'dataset_id': ds, 'entity_type': e,
+                              'edges': [rnd.randrange(n_edges) for _ in range(3)],
+                              'config': J({'entity': e, 'property': 'prop0', 'parameter': rnd.choice(params)})})
+    d['clients'].append({'service_id': 's', 'component_id': 'c', 'namespace_id': 1})
+    return d
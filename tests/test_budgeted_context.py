@@ -0,0 +1,116 @@
+"""Подбор контекста с бюджетом токенов (ContextResolver.resolve_budgeted, ContextBuilder)."""
+import pytest
+
+from core.context_engine import DbDataLoader, OutputGenerator, WorklistResolver
+from core.masking import ContextMasker
+from services.context_service import ContextService
+from tests.synth import make_namespace
+from utils.tokenizer import TokenCounter
+
+DATASETS = ['ds0', 'ds1', 'ds2', 'ds3']
+ENTITIES = ['entity0', 'entity1']
+
+
+@pytest.fixture(scope='module')
+def loader():
+    raw = make_namespace(n_entities=20, props_per_entity=10, n_params=40, n_tables=10, n_vertices=80,
+                         n_edges=100, n_datasets=10, n_constraints=60, seed=8)
+    # Одно свойство с очень длинной формулой без ссылок: дороже любой другой строки
+    for row in raw['entity_properties']:
+        if row['entity_type'] == 'entity0' and row['property_id'] == 'prop0':
+            row['calculation_func'] = "'" + ' '.join(f'w{i}' for i in range(3000)) + "'"
+    return DbDataLoader(raw)
+
+
+def _budgeted(loader, budget, output_format):
+    resolver = WorklistResolver(loader)
+    estimator = OutputGenerator(loader, {}, masker=ContextMasker(), output_format=output_format)
+    report = resolver.resolve_budgeted(DATASETS, ENTITIES, budget, estimator)
+    return {t: set(pks) for t, pks in resolver.context.items() if pks}, report
+
+
+@pytest.mark.parametrize('output_format', OutputGenerator.OUTPUT_FORMATS)
+@pytest.mark.parametrize('share', [0.2, 0.5, 0.8])
+def test_rendered_context_fits_budget(loader, output_format, share):
+    budget = int(_budgeted(loader, 10 ** 9, output_format)[1]['used_tokens'] * share)
+    context, report = _budgeted(loader, budget, output_format)
+    assert report['truncated']
+    for masker in (ContextMasker(), None):
+        sql = OutputGenerator(loader, {t: set(p) for t, p in context.items()}, masker=masker,
+                              output_format=output_format).generate_sql()
+        assert TokenCounter.count_tokens(sql) <= budget * 1.02
+
+
+@pytest.mark.parametrize('output_format', OutputGenerator.OUTPUT_FORMATS)
+def test_row_that_does_not_fit_is_skipped(loader, output_format):
+    huge = ('entity_properties', ('1', '', 'entity0', 'prop0'))
+    estimator = OutputGenerator(loader, {}, masker=ContextMasker(), output_format=output_format)
+    huge_cost = estimator.row_tokens(*huge)
+    assert huge_cost > 2000
+
+    # Дорогая строка (расстояние 0 от корня) не помещается никогда: обход не останавливается на ней,
+    # а добирает бюджет строками поменьше, в том числе из той же таблицы и дальше по графу
+    rest = _budgeted(loader, 10 ** 9, output_format)[1]['used_tokens'] - huge_cost
+    budget = int(min(huge_cost, rest) * 0.8)
+    context, report = _budgeted(loader, budget, output_format)
+    assert huge in report['omitted_nodes']
+    assert huge[1] not in context['entity_properties']
+    assert report['used_tokens'] > budget * 0.9
+    assert len(context['entity_properties']) > 1
+
+
+def test_estimate_follows_output_format(loader):
+    used = {fmt: _budgeted(loader, 10 ** 9, fmt)[1]['used_tokens'] for fmt in OutputGenerator.OUTPUT_FORMATS}
+    assert used['sql_min'] < used['sql']
+    assert used['csv'] < used['sql']
+
+
+@pytest.mark.parametrize('output_format', ['sql', 'csv'])
+def test_budgeted_pick_goes_through_context_builder(loader, output_format):
+    budget = 4000
+    sql, _, report = ContextService.pick_context_budgeted(
+        loader, ContextMasker(), DATASETS, ENTITIES, budget, output_format=output_format
+    )
+
+    # Инкрементальный подбор: сначала без бюджета, затем с бюджетом и обратно
+    masker = ContextMasker()
+    builder, full_sql, _ = ContextService.update_context(None, loader, masker, DATASETS, ENTITIES, output_format)
+    builder, budget_sql, _ = ContextService.update_context(
+        builder, loader, masker, DATASETS, ENTITIES, output_format, token_budget=budget
+    )
+    assert builder.report == report
+    context, _ = _budgeted(loader, budget, output_format)
+    assert builder.context_copy() == context
+    assert budget_sql == OutputGenerator(loader, builder.context_copy(), masker=masker,
+                                         output_format=output_format).generate_sql()
+
+    builder, again_sql, _ = ContextService.update_context(builder, loader, masker, DATASETS, ENTITIES, output_format)
+    assert builder.report is None
+    assert again_sql == OutputGenerator(loader, builder.context_copy(), masker=masker,
+                                        output_format=output_format).generate_sql()
+    assert len(again_sql) == len(full_sql)
+
+
+def test_row_estimate_tokenizes_once(loader, monkeypatch):
+    estimator = OutputGenerator(loader, {}, masker=ContextMasker(), output_format='sql')
+    pks = sorted(loader.db['entity_properties'])[:20]
+    counted = []
+    count_tokens = TokenCounter.count_tokens
+    monkeypatch.setattr(TokenCounter, 'count_tokens', lambda text: counted.append(text) or count_tokens(text))
+    costs = [estimator.row_tokens('entity_properties', pk) for pk in pks]
+    # Токенизируется только маскированная строка, оригинальная оценивается по длине
+    assert len(counted) == len(pks)
+    assert all(cost > 1 for cost in costs)
+
+
+@pytest.mark.parametrize('masked', [True, False])
+def test_format_token_report_counts_blocks(loader, masked):
+    report = ContextService.format_token_report(loader, DATASETS, ENTITIES, masked=masked)
+    assert [row['format'] for row in report] == list(OutputGenerator.OUTPUT_FORMATS)
+    context = ContextService._resolution(loader, DATASETS, ENTITIES).context_copy()
+    for row in report:
+        sql = OutputGenerator(loader, context, masker=ContextMasker() if masked else None,
+                              output_format=row['format']).generate_sql()
+        assert row['chars'] == len(sql)
+        # Токены считаются по блокам таблиц: не больше токена расхождения на блок
+        assert abs(row['tokens'] - TokenCounter.count_tokens(sql)) <= len(OutputGenerator.TABLE_ORDER) + 1
@@ -0,0 +1,47 @@
+"""Дедупликация контекста: OutputGenerator.expand_values точно восстанавливает SQL без дедупликации."""
+import pytest
+
+from core.context_engine import DbDataLoader, OutputGenerator, WorklistResolver
+from core.masking import ContextMasker
+from tests.synth import make_namespace
+
+DEDUPE_MIN_CHARS = 20
+
+
+@pytest.fixture(scope='module')
+def context():
+    loader = DbDataLoader(make_namespace(n_entities=15, props_per_entity=8, n_params=30, n_tables=8,
+                                         n_vertices=60, n_edges=50, n_datasets=8, n_constraints=40, seed=3))
+    resolver = WorklistResolver(loader)
+    for i in range(8):
+        resolver.resolve_by_dataset(f'ds{i}')
+    return loader, {t: set(p) for t, p in resolver.context.items()}
+
+
+def _generator(context, output_format, masked, dedupe_min_chars):
+    loader, ctx = context
+    return OutputGenerator(loader, {t: set(p) for t, p in ctx.items()}, masker=ContextMasker() if masked else None,
+                           output_format=output_format, dedupe_min_chars=dedupe_min_chars)
+
+
+@pytest.mark.parametrize('masked', [True, False])
+@pytest.mark.parametrize('output_format', OutputGenerator.OUTPUT_FORMATS)
+def test_expand_values_restores_plain_sql(context, output_format, masked):
+    sql_plain = _generator(context, output_format, masked, 0).generate_sql()
+    sql_deduped = _generator(context, output_format, masked, DEDUPE_MIN_CHARS).generate_sql()
+    if output_format == 'csv':
+        # В csv дедупликация не выполняется
+        assert sql_deduped == sql_plain
+    else:
+        assert OutputGenerator.VALUES_TABLE in sql_deduped and '@V1' in sql_deduped
+        assert len(sql_deduped) < len(sql_plain)
+    assert OutputGenerator.expand_values(sql_deduped) == sql_plain
+    assert OutputGenerator.expand_values(sql_plain) == sql_plain
+
+    # Потоковая и двойная генерация дают тот же SQL с дедупликацией
+    assert ''.join(_generator(context, output_format, masked, DEDUPE_MIN_CHARS).iter_sql()) == sql_deduped
+    if masked:
+        dual_masked, dual_original = _generator(context, output_format, True, DEDUPE_MIN_CHARS).generate_sql_dual()
+        assert dual_masked == sql_deduped
+        original_plain = _generator(context, output_format, False, 0).generate_sql()
+        assert OutputGenerator.expand_values(dual_original) == original_plain
@@ -0,0 +1,125 @@
+"""
+Финальный промпт: потоковый iter_final_prompt совпадает с generate_final_prompts,
+маски контекста регистрируются одним и тем же шагом до генерации SQL.
+"""
+import json
+
+import pytest
+
+from core.context_engine import DbDataLoader, OutputGenerator
+from core.masking import ContextMasker
+from core.schema_config import PRIMARY_KEYS
+from services.context_service import ContextService
+from tests.synth import make_namespace
+
+SYSTEM_PROMPT = 'Ты аналитик. Сущности: person, order, entity3.'
+USER_QUERY = 'Сколько person.salary у order и entity3.prop1?'
+
+
+def _late_entity_namespace():
+    """Имя сущности person впервые регистрируется в JSON датасета — после формулы, которая на него ссылается."""
+    raw = {table: [] for table in PRIMARY_KEYS}
+    raw['namespaces'].append({'namespace_id': 1, 'namespace_name': 'main'})
+    raw['tenants'].append({'tenant_id': '', 'tenant_name': 'default'})
+    raw['entities'].append({'namespace_id': 1, 'tenant_id': '', 'entity_type': 'order',
+                            'entity_name': 'Order', 'description': None})
+    raw['entity_properties'].append(
+        {'namespace_id': 1, 'tenant_id': '', 'entity_type': 'order', 'property_id': 'total', 'type': 'Int',
+         'calculation_func': 'sum(person.salary) * 2', 'aggregation_func': None, 'conversion_func': None})
+    raw['datasets'].append({'namespace_id': 1, 'tenant_id': '', 'dataset_id': 'order_ds', 'entity_type': 'order',
+                            'edges': [], 'config': json.dumps({'entity': 'person', 'property': 'total'})})
+    return DbDataLoader(raw)
+
+
+def _prompts(loader, datasets, entities, output_format, masker=None):
+    masker = masker or ContextMasker()
+    result = ContextService.generate_final_prompts(
+        loader, masker, 'ns', datasets, entities, SYSTEM_PROMPT, USER_QUERY, output_format=output_format
+    )
+    return result, masker
+
+
+def _stream(loader, datasets, entities, output_format, masker=None, masked=True):
+    masker = masker or ContextMasker()
+    text = ''.join(ContextService.iter_final_prompt(
+        loader, masker, 'ns', datasets, entities, SYSTEM_PROMPT, USER_QUERY, masked=masked,
+        output_format=output_format
+    ))
+    return text, masker
+
+
+@pytest.mark.parametrize('output_format', OutputGenerator.OUTPUT_FORMATS)
+def test_stream_matches_generate_when_masks_appear_late(output_format):
+    loader = _late_entity_namespace()
+    result, masker = _prompts(loader, ['order_ds'], ['order'], output_format)
+    streamed, stream_masker = _stream(loader, ['order_ds'], ['order'], output_format)
+    assert streamed == result['final_prompt_masked']
+    assert stream_masker.map_forward == masker.map_forward
+    # Формула, отрендеренная до датасета, тоже замаскирована полным словарем
+    assert 'person' not in result['final_prompt_masked']
+    assert f"{masker.map_forward[('ENT', 'person')]}." in result['final_prompt_masked']
+
+    original, _ = _stream(loader, ['order_ds'], ['order'], output_format, masked=False)
+    assert original == result['final_prompt_original']
+
+
+@pytest.fixture(scope='module')
+def synthetic_loader():
+    return DbDataLoader(make_namespace(n_entities=20, props_per_entity=8, n_params=40, n_tables=10,
+                                       n_vertices=80, n_edges=100, n_datasets=15, n_constraints=60, seed=6))
+
+
+@pytest.mark.parametrize('output_format', ['sql', 'csv'])
+@pytest.mark.parametrize('datasets, entities', [(['ds0'], []), (['ds1', 'ds4', 'ds9'], ['entity3']),
+                                                ([], ['entity3', 'entity11'])])
+def test_stream_matches_generate_on_synthetic_namespace(synthetic_loader, datasets, entities, output_format):
+    result, masker = _prompts(synthetic_loader, datasets, entities, output_format)
+    streamed, stream_masker = _stream(synthetic_loader, datasets, entities, output_format)
+    assert streamed == result['final_prompt_masked']
+    assert stream_masker.map_forward == masker.map_forward
+
+    # Тот же маскер: поток после генерации (SQL из кэша выборки) и генерация после потока
+    again, _ = _stream(synthetic_loader, datasets, entities, output_format, masker=masker)
+    assert again == result['final_prompt_masked']
+    regenerated, _ = _prompts(synthetic_loader, datasets, entities, output_format, masker=stream_masker)
+    assert regenerated['final_prompt_masked'] == streamed
+
+
+def test_pick_context_then_prompt(synthetic_loader):
+    masker = ContextMasker()
+    ContextService.pick_context(synthetic_loader, masker, ['ds2', 'ds3'], ['entity5'])
+    result, _ = _prompts(synthetic_loader, ['ds2', 'ds3'], ['entity5'], None, masker=masker)
+    streamed, _ = _stream(synthetic_loader, ['ds2', 'ds3'], ['entity5'], None, masker=masker)
+    assert streamed == result['final_prompt_masked']
+
+
+# Маскированный контекст _late_entity_namespace: формула замаскирована именами, зарегистрированными ниже
+LATE_MASKS_GOLDEN = """-- entity_properties (1)
+INSERT INTO entity_properties (namespace_id, tenant_id, entity_type, property_id, type, calculation_func, aggregation_func, conversion_func) VALUES
+(
+  1, '', 'ENT_1', 'P_1', 'Int',
+  'sum(ENT_2.P_2) * 2', 
+  null, 
+  null
+);
+
+-- datasets (1)
+INSERT INTO datasets (namespace_id, tenant_id, dataset_id, entity_type, edges, config) VALUES
+(1, '', 'DS_1', 'ENT_1', '{}', '{"entity": "ENT_2", "property": "P_1"}');
+"""
+
+
+def test_late_masks_golden():
+    loader = _late_entity_namespace()
+    result, masker = _prompts(loader, ['order_ds'], ['order'], 'sql')
+    assert LATE_MASKS_GOLDEN in result['final_prompt_masked']
+    assert masker.map_forward == {
+        ('TEN_NAME', 'default'): 'TEN_NAME_1', ('ENT', 'order'): 'ENT_1', ('ENT_NAME', 'Order'): 'ENT_NAME_1',
+        ('P', 'total'): 'P_1', ('DS', 'order_ds'): 'DS_1', ('ENT', 'person'): 'ENT_2', ('P', 'salary'): 'P_2',
+    }
+
+    # Однопроходная генерация на свежем маскере оставляет формулу открытой — это отличие намеренное
+    context = {table: set(rows) for table, rows in loader.db.items() if rows}
+    single_pass = OutputGenerator(loader, context, masker=ContextMasker()).generate_sql()
+    assert "'sum(person.salary) * 2'" in single_pass
+    assert LATE_MASKS_GOLDEN.replace('ENT_2.P_2', 'person.salary') in single_pass
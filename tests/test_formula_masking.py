@@ -0,0 +1,107 @@
+"""
+Маскирование формул: лексер (_mask_formula_lexer) против прежних regex-проходов
+(_mask_formula_passes) на эталоне tests/data/formula_golden.json и случайных формулах.
+"""
+import json
+
+import pytest
+
+from core.context_engine import DbDataLoader
+from core.masking import ContextMasker
+from tests.formula_cases import CASES, GOLDEN_PATH, PARAMETERS, FormulaFuzzer, mask_case, setup_masker
+from tests.synth import make_namespace
+
+GOLDEN = json.loads(GOLDEN_PATH.read_text(encoding='utf-8'))
+
+FALLBACKS = {value for name, value in vars(ContextMasker).items() if name.startswith('FALLBACK_')}
+
+
+def _expected(case):
+    return {'masked': case['masked'], 'registered': case['registered']}
+
+
+def _lexer_only(masker, formula):
+    masked, fallback = masker._mask_formula_lexer(formula)
+    return masked if fallback is None else fallback
+
+
+def test_passes_match_golden():
+    for case in GOLDEN:
+        result = mask_case(ContextMasker, case['setup'], case['formula'], lambda m, f: m._mask_formula_passes(f))
+        assert result == _expected(case), case['formula']
+
+
+def test_mask_formula_matches_golden():
+    for case in GOLDEN:
+        result = mask_case(ContextMasker, case['setup'], case['formula'], lambda m, f: m.mask_formula(f))
+        assert result == _expected(case), case['formula']
+
+
+def test_lexer_matches_golden_byte_for_byte():
+    lexed = 0
+    for case in GOLDEN:
+        result = mask_case(ContextMasker, case['setup'], case['formula'], _lexer_only)
+        if result['masked'] in FALLBACKS:
+            # Отказ лексера ничего не регистрирует: прежний разбор начинает с того же словаря
+            assert result['registered'] == [], case['formula']
+            continue
+        lexed += 1
+        assert result == _expected(case), case['formula']
+    assert lexed > len(GOLDEN) // 2
+
+
+def test_every_fallback_reason_has_a_case():
+    assert {fallback for _, _, fallback in CASES if fallback} == FALLBACKS
+
+
+@pytest.mark.parametrize('setup, formula, fallback', CASES)
+def test_fallback_reason(setup, formula, fallback):
+    case = next(c for c in GOLDEN if c['setup'] == setup and c['formula'] == formula)
+    result = mask_case(ContextMasker, setup, formula, _lexer_only)
+    if fallback is None:
+        assert result == _expected(case)
+    else:
+        assert result['masked'] == fallback
+    # Отказ учитывается в статистике, а результат совпадает с эталоном
+    masker = setup_masker(ContextMasker(), setup)
+    assert masker.mask_formula(formula) == case['masked']
+    assert masker.cache_stats()['lexer_fallbacks'] == ({fallback: 1} if fallback and formula else {})
+
+
+def _shared_state_differential(formulas, params):
+    """Одна последовательность формул двумя маскерами: только проходы и mask_formula (лексер + отказы)."""
+    passes, lexer = ContextMasker(), ContextMasker()
+    for masker in (passes, lexer):
+        masker.cache_size = 0
+        masker.register('person', 'ENT')
+        masker.register('orders', 'TBL')
+        masker.set_known_parameters(set(params))
+    for formula in formulas:
+        expected = passes._mask_formula_passes(formula)
+        assert lexer.mask_formula(formula) == expected, formula
+        assert list(lexer.map_forward.items()) == list(passes.map_forward.items()), formula
+    return lexer
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_lexer_matches_passes_on_random_formulas(seed):
+    fuzzer = FormulaFuzzer(seed)
+    lexer = _shared_state_differential([fuzzer.formula() for _ in range(1500)], PARAMETERS)
+    assert set(lexer.cache_stats()['lexer_fallbacks']) <= FALLBACKS
+
+
+def test_lexer_matches_passes_on_synthetic_namespace():
+    raw = make_namespace(n_entities=40, props_per_entity=15, n_params=80, n_vertices=300, n_edges=50,
+                         n_datasets=10, n_constraints=200, seed=13)
+    loader = DbDataLoader(raw)
+    formulas = []
+    for table, columns in (('entity_properties', ('calculation_func', 'aggregation_func')),
+                           ('vertex_functions', ('calculation_func', 'aggregation_func')),
+                           ('constraints', ('condition',))):
+        for row in loader.db[table].values():
+            formulas += [row[col] for col in columns if row.get(col)]
+    params = [row['parameter_id'] for row in raw['parameters']]
+    lexer = _shared_state_differential(formulas, params)
+    # Обычные формулы лексер разбирает сам
+    assert sum(lexer.lexer_fallbacks.values()) == 0
+
@@ -0,0 +1,83 @@
+"""
+Инкрементальный подбор контекста (ContextBuilder.update): строки, отрендеренные раньше,
+должны маскироваться заново, когда новая выборка добавляет маски в словарь.
+"""
+import json
+
+import pytest
+
+from core.context_engine import DbDataLoader, OutputGenerator
+from core.masking import ContextMasker
+from core.schema_config import PRIMARY_KEYS
+from services.context_service import ContextBuilder
+from tests.synth import make_namespace
+
+
+def _namespace():
+    raw = {table: [] for table in PRIMARY_KEYS}
+    raw['namespaces'].append({'namespace_id': 1, 'namespace_name': 'main'})
+    raw['tenants'].append({'tenant_id': '', 'tenant_name': 'default'})
+    for entity in ('order', 'person'):
+        raw['entities'].append({'namespace_id': 1, 'tenant_id': '', 'entity_type': entity,
+                                'entity_name': entity.title(), 'description': None})
+    # Формула ссылается на сущность person, но не на её существующее свойство:
+    # датасет order_ds не тянет person в контекст, и в первой выдаче имя не маскируется
+    raw['entity_properties'] += [
+        {'namespace_id': 1, 'tenant_id': '', 'entity_type': 'order', 'property_id': 'total', 'type': 'Int',
+         'calculation_func': 'sum(person.salary) * 2', 'aggregation_func': None, 'conversion_func': None},
+        {'namespace_id': 1, 'tenant_id': '', 'entity_type': 'person', 'property_id': 'name', 'type': 'String',
+         'calculation_func': None, 'aggregation_func': None, 'conversion_func': None},
+    ]
+    raw['datasets'].append({'namespace_id': 1, 'tenant_id': '', 'dataset_id': 'order_ds', 'entity_type': 'order',
+                            'edges': [], 'config': json.dumps({'entity': 'order', 'property': 'total',
+                                                               'valueExpr': 'person.salary + 1'})})
+    return raw
+
+
+def _full_render(loader, builder, output_format):
+    """Полная генерация того же контекста тем же маскером (словарь уже полный)."""
+    return OutputGenerator(loader, builder.context_copy(), masker=builder.masker,
+                           output_format=output_format).generate_sql()
+
+
+@pytest.mark.parametrize('output_format', OutputGenerator.OUTPUT_FORMATS)
+def test_added_entity_masks_rendered_rows(output_format):
+    loader = DbDataLoader(_namespace())
+    masker = ContextMasker()
+    builder = ContextBuilder(loader, masker, output_format)
+
+    first, _ = builder.update(['order_ds'], [])
+    assert 'person.salary' in first
+
+    second, changed = builder.update(['order_ds'], ['person'])
+    assert 'entities' in changed
+    assert 'person' not in second
+    assert f"{masker.map_forward[('ENT', 'person')]}." in second
+    assert second == _full_render(loader, builder, output_format)
+
+
+def test_incremental_matches_full_render_on_synthetic_namespace():
+    raw = make_namespace(n_entities=30, props_per_entity=10, n_params=60, n_tables=20, n_vertices=150,
+                         n_edges=200, n_datasets=30, n_constraints=100, seed=4)
+    loader = DbDataLoader(raw)
+    masker = ContextMasker()
+    builder = ContextBuilder(loader, masker, 'sql')
+    steps = [(['ds0'], []), (['ds0', 'ds3'], ['entity5']), (['ds3'], ['entity5', 'entity7']),
+             (['ds3', 'ds9', 'ds11'], ['entity7']), ([], ['entity1'])]
+    for datasets, entities in steps:
+        sql, _ = builder.update(datasets, entities)
+        assert sql == _full_render(loader, builder, 'sql'), (datasets, entities)
+
+
+def test_dual_incremental_rerenders_masked_rows_only():
+    loader = DbDataLoader(_namespace())
+    masker = ContextMasker()
+    generator = OutputGenerator(loader, {}, masker=masker)
+    generator.context.update({'datasets': {('1', '', 'order_ds')}, 'entities': {('1', '', 'order')},
+                              'entity_properties': {('1', '', 'order', 'total')}})
+    generator.generate_sql_dual(list(generator.context))
+    generator.context['entities'].add(('1', '', 'person'))
+    masked, original = generator.generate_sql_dual(['entities'])
+    assert 'person' not in masked
+    assert 'sum(person.salary) * 2' in original
+    assert original == OutputGenerator(loader, {t: set(p) for t, p in generator.context.items()}).generate_sql()
@@ -0,0 +1,205 @@
+"""
+Общий кэш загрузчиков (LoaderCache): подсчет аренд, LRU только среди свободных загрузчиков,
+бюджет памяти, single-flight загрузка и освобождение аренды сборщиком мусора.
+"""
+import gc
+import threading
+
+import services.loader_cache as loader_cache
+from services.loader_cache import LoaderCache
+
+MB = 100
+
+
+class _Loader:
+    """Загрузчик с заданной оценкой памяти (LoaderCache нужен только estimate_nbytes)."""
+
+    def __init__(self, key, nbytes=MB):
+        self.key = key
+        self.nbytes = nbytes
+
+    def estimate_nbytes(self):
+        return self.nbytes
+
+
+class _CountingFactory:
+    """factory для acquire(): считает вызовы по ключам."""
+
+    def __init__(self, nbytes=MB):
+        self.nbytes = nbytes
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        def factory():
+            with self.lock:
+                self.calls.append(key)
+            return _Loader(key, self.nbytes)
+        return factory
+
+
+def _keys(cache):
+    return list(cache._entries)
+
+
+def test_leases_are_refcounted():
+    cache, factory = LoaderCache(max_bytes=10 * MB), _CountingFactory()
+    first = cache.acquire('a', factory('a'))
+    second = cache.acquire('a', factory('a'))
+    assert factory.calls == ['a']
+    assert first.loader is second.loader
+    assert cache.stats() == {'entries': 1, 'leases': 2, 'bytes': MB, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+    first.release()
+    first.release()
+    assert first.released and not second.released
+    assert cache.stats()['leases'] == 1
+    second.release()
+    assert cache.stats()['leases'] == 0
+    # Свободный загрузчик в пределах бюджета остается в кэше
+    assert cache.acquire('a', factory('a')).loader is second.loader
+    assert factory.calls == ['a']
+
+
+def test_lru_evicts_only_free_loaders():
+    cache, factory = LoaderCache(max_bytes=3 * MB), _CountingFactory()
+    held = cache.acquire('a', factory('a'))
+    cache.acquire('b', factory('b')).release()
+    cache.acquire('c', factory('c')).release()
+    assert _keys(cache) == ['a', 'b', 'c']
+
+    # Обращение к 'b' делает его самым свежим: вытесняется 'c',
+    # а занятый 'a' остается, хотя он старше всех
+    cache.acquire('b', factory('b')).release()
+    lease_d = cache.acquire('d', factory('d'))
+    assert _keys(cache) == ['a', 'b', 'd']
+    assert cache.evictions == 1
+
+    # Освобожденный 'a' — теперь первый кандидат на вытеснение
+    held.release()
+    assert _keys(cache) == ['a', 'b', 'd']
+    lease_e = cache.acquire('e', factory('e'))
+    assert _keys(cache) == ['b', 'd', 'e']
+    assert cache.evictions == 2
+    lease_d.release()
+    lease_e.release()
+    assert factory.calls == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_byte_budget():
+    cache, factory = LoaderCache(max_bytes=2 * MB), _CountingFactory()
+    leases = [cache.acquire(key, factory(key)) for key in 'abcd']
+    # Занятые загрузчики не вытесняются, даже если не укладываются в бюджет
+    assert _keys(cache) == ['a', 'b', 'c', 'd']
+    assert cache.total_bytes() == 4 * MB
+
+    leases[1].release()
+    assert _keys(cache) == ['a', 'c', 'd']
+    for lease in leases:
+        lease.release()
+    assert _keys(cache) == ['c', 'd']
+    assert cache.total_bytes() == 2 * MB
+    assert cache.evictions == 2
+
+    # Загрузчик крупнее всего бюджета выдается, но после освобождения не задерживается
+    big = cache.acquire('big', lambda: _Loader('big', 5 * MB))
+    assert big.loader.key == 'big'
+    big.release()
+    assert 'big' not in _keys(cache)
+    assert cache.total_bytes() <= 2 * MB
+
+
+class _CountingEvent(threading.Event):
+    """Event, который считает потоки, ждущие в wait()."""
+
+    waiting = 0
+    lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with _CountingEvent.lock:
+            _CountingEvent.waiting += 1
+        return super().wait(timeout)
+
+
+def _run_concurrently(monkeypatch, cache, factory, count):
+    """
+    Запускает count потоков acquire('k'). Загрузка лидера держится, пока остальные
+    не встанут в ожидание этой же загрузки. Возвращает результаты (аренда или исключение) по потокам.
+    """
+    class Flight(loader_cache._Flight):
+        def __init__(self):
+            super().__init__()
+            self.done = _CountingEvent()
+
+    monkeypatch.setattr(loader_cache, '_Flight', Flight)
+    monkeypatch.setattr(_CountingEvent, 'waiting', 0)
+    started, go = threading.Event(), threading.Event()
+
+    def slow_factory():
+        started.set()
+        go.wait(10)
+        return factory()
+
+    results = [None] * count
+
+    def worker(i):
+        try:
+            results[i] = cache.acquire('k', slow_factory)
+        except Exception as e:
+            results[i] = e
+
+    leader = threading.Thread(target=worker, args=(0,))
+    leader.start()
+    assert started.wait(10)
+    others = [threading.Thread(target=worker, args=(i,)) for i in range(1, count)]
+    for thread in others:
+        thread.start()
+    while _CountingEvent.waiting < count - 1:
+        threading.Event().wait(0.001)
+    go.set()
+    for thread in [leader] + others:
+        thread.join(10)
+    return results
+
+
+def test_single_flight_loads_once(monkeypatch):
+    cache, factory = LoaderCache(max_bytes=10 * MB), _CountingFactory()
+    leases = _run_concurrently(monkeypatch, cache, factory('k'), 8)
+    assert factory.calls == ['k']
+    assert len({id(lease.loader) for lease in leases}) == 1
+    assert cache.stats()['leases'] == 8
+    assert (cache.misses, cache.hits) == (1, 7)
+    assert not cache._inflight
+
+
+def test_single_flight_error_reaches_waiters(monkeypatch):
+    cache, calls = LoaderCache(max_bytes=10 * MB), []
+    error = RuntimeError('БД недоступна')
+
+    def failing():
+        calls.append(1)
+        raise error
+
+    results = _run_concurrently(monkeypatch, cache, failing, 6)
+    assert calls == [1]
+    assert all(result is error for result in results)
+    assert not cache._entries and not cache._inflight
+    # Следующий запрос запускает новую загрузку
+    factory = _CountingFactory()
+    assert cache.acquire('k', factory('k')).loader.key == 'k'
+    assert factory.calls == ['k']
+
+
+def test_lease_released_on_garbage_collection():
+    cache, factory = LoaderCache(max_bytes=MB), _CountingFactory()
+    lease = cache.acquire('a', factory('a'))
+    second = cache.acquire('b', factory('b'))
+    assert _keys(cache) == ['a', 'b']
+
+    # Аренда, потерянная вместе с сессией, освобождается weakref.finalize
+    del lease
+    gc.collect()
+    assert _keys(cache) == ['b']
+    assert cache.stats()['leases'] == 1
+    second.release()
+    assert cache.stats()['leases'] == 0
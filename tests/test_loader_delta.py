@@ -0,0 +1,190 @@
+"""
+Инкрементальное обновление namespace (DbDataLoader.apply_delta, ContextService.refresh_namespace):
+после вставок, изменений и удалений загрузчик совпадает с полной загрузкой тех же данных —
+строки, вторичные индексы, ссылки формул и подобранный контекст.
+"""
+import random
+
+import pytest
+
+from core.columnar import is_arrow_available
+from core.context_engine import DbDataLoader, WorklistResolver
+from services.context_service import ContextService
+from services.snapshot_store import SnapshotStore
+from tests.synth import make_namespace
+
+STORAGES = ['dict'] + (['arrow'] if is_arrow_available() else [])
+SELECTIONS = [(['ds0', 'ds3'], ['entity4']), ([], ['entity1', 'entity9']), ([f'ds{i}' for i in range(12)], [])]
+
+
+class FakeDatabase:
+    """
+    Таблицы namespace в памяти с системной колонкой xmin: строки — пары [xmin, row],
+    каждое изменение — новая транзакция. Повторяет контракт DatabaseManager для дельт.
+    """
+
+    def __init__(self, raw):
+        self.xid = 100
+        self.tables = {table: [[self.xid, dict(row)] for row in rows] for table, rows in raw.items()}
+
+    def fetch_namespace_fingerprint(self, namespace_id):
+        return {table: {'rows': len(rows), 'max_xmin': max((x for x, _ in rows), default=0),
+                        'xmin_sum': sum(x for x, _ in rows)}
+                for table, rows in self.tables.items()}
+
+    def fetch_xmin_horizon(self):
+        return self.xid + 1
+
+    def fetch_namespace_context(self, namespace_id):
+        return {table: [dict(row) for _, row in rows] for table, rows in self.tables.items()}
+
+    def fetch_namespace_delta(self, namespace_id, tables, since_xmin):
+        return {table: [dict(row) for x, row in self.tables[table] if x >= since_xmin] for table in tables}
+
+    def fetch_namespace_keys(self, namespace_id, key_columns):
+        return {table: [{col: row.get(col) for col in cols} for _, row in self.tables[table]]
+                for table, cols in key_columns.items()}
+
+    def update(self, table, index, **values):
+        self.xid += 1
+        self.tables[table][index] = [self.xid, dict(self.tables[table][index][1], **values)]
+
+    def insert(self, table, row):
+        self.xid += 1
+        self.tables[table].append([self.xid, row])
+
+    def delete(self, table, index):
+        self.xid += 1
+        del self.tables[table][index]
+
+
+def _state(loader):
+    """Строки и вторичные индексы загрузчика (порядок PK в индексе не важен)."""
+    db = {table: {pk: dict(rows[pk]) for pk in rows} for table, rows in loader.db.items() if len(rows)}
+    indexes = {key: {value: sorted(pks) for value, pks in index.items()}
+               for key, index in loader.indexes.items() if index}
+    return db, indexes
+
+
+def _contexts(loader):
+    result = []
+    for datasets, entities in SELECTIONS:
+        resolver = WorklistResolver(loader)
+        found = [resolver.resolve_by_dataset(ds) for ds in datasets]
+        found += [resolver.resolve_by_entity(ent) for ent in entities]
+        result.append((found, {table: set(pks) for table, pks in resolver.context.items() if pks}))
+    return result
+
+
+def _assert_same_as_full_load(loader, database, storage):
+    fresh = DbDataLoader(database.fetch_namespace_context('1'), storage=storage)
+    assert _state(loader) == _state(fresh)
+    assert {f: loader.formula_refs(f) for f in fresh.formula_refs_cache} == fresh.formula_refs_cache
+    assert _contexts(loader) == _contexts(fresh)
+    loader.closures.build()
+    fresh.closures.build()
+    for datasets, entities in SELECTIONS:
+        assert loader.closures.resolve(datasets, entities) == fresh.closures.resolve(datasets, entities)
+
+
+def _property(entity, prop, formula):
+    return {'namespace_id': 1, 'tenant_id': '', 'entity_type': entity, 'property_id': prop, 'type': 'String',
+            'calculation_func': formula, 'aggregation_func': None, 'conversion_func': None, 'is_array': False}
+
+
+def _parameter(param_id):
+    return {'namespace_id': 1, 'tenant_id': '', 'parameter_id': param_id, 'request_path': '{a,b}',
+            'type': 'String', 'default_value': None}
+
+
+@pytest.fixture
+def database():
+    return FakeDatabase(make_namespace(n_entities=20, props_per_entity=10, n_params=60, n_tables=10,
+                                       n_vertices=150, n_edges=120, n_datasets=15, n_constraints=80, seed=5))
+
+
+@pytest.mark.parametrize('storage', STORAGES)
+def test_refresh_matches_full_load(database, storage, tmp_path):
+    store = SnapshotStore(tmp_path)
+    loader, source = ContextService.load_namespace(database, '1', storage=storage, snapshot_store=store)
+    assert source == 'database'
+    assert ContextService.refresh_namespace(database, loader, '1', snapshot_store=store) == (loader, 'unchanged')
+
+    rnd = random.Random(7)
+    for step in range(3):
+        before = _state(loader)
+        database.update('vertices', rnd.randrange(len(database.tables['vertices'])),
+                        config='{"table": "tbl1", "aggregation": "agg2"}')
+        database.update('entity_properties', rnd.randrange(len(database.tables['entity_properties'])),
+                        calculation_func='sum(entity3.prop4) + {param_5}')
+        # Новый параметр и свойство, на которые ссылаются формулы (старая и новая)
+        database.insert('parameters', _parameter(f'new_param_{step}'))
+        database.insert('entity_properties', _property('entity1', f'new_prop{step}', f'new_param_{step} != null'))
+        database.update('constraints', 0, condition=f'entity1.new_prop{step} > 0')
+        database.delete('edges', rnd.randrange(len(database.tables['edges'])))
+        database.delete('entity_properties', rnd.randrange(len(database.tables['entity_properties'])))
+        if step == 1:
+            database.delete('datasets', 0)
+            database.insert('datasets', dict(database.tables['datasets'][0][1], dataset_id='ds0'))
+        database.delete('parameters', rnd.randrange(len(database.tables['parameters'])))
+
+        updated, source = ContextService.refresh_namespace(database, loader, '1', snapshot_store=store)
+        assert source == 'delta'
+        # Исходный загрузчик (общий для сессий) не изменился
+        assert _state(loader) == before
+        _assert_same_as_full_load(updated, database, storage)
+        loader = updated
+
+
+@pytest.mark.parametrize('storage', STORAGES)
+def test_schema_change_needs_full_load(database, storage, tmp_path):
+    store = SnapshotStore(tmp_path)
+    loader, _ = ContextService.load_namespace(database, '1', storage=storage, snapshot_store=store)
+    row = dict(database.tables['tenants'][0][1], extra=1)
+
+    copy = loader.copy()
+    before = _state(copy)
+    with pytest.raises(ValueError):
+        copy.apply_delta({'parameters': [_parameter('new_param')], 'tenants': [row]})
+    # Проверка схемы выполняется до любых изменений
+    assert _state(copy) == before
+
+    for _, tenant in database.tables['tenants']:
+        tenant['extra'] = 1
+    database.update('tenants', 0)
+    updated, source = ContextService.refresh_namespace(database, loader, '1', snapshot_store=store)
+    assert source == 'database'
+    assert 'extra' in updated.table_cols['tenants']
+    _assert_same_as_full_load(updated, database, storage)
+
+
+def test_formula_refs_follow_inserts_and_deletes(monkeypatch):
+    raw = make_namespace(n_entities=5, props_per_entity=3, n_params=5, n_tables=2, n_vertices=5,
+                         n_edges=5, n_datasets=2, n_constraints=5, seed=1)
+    formulas = ['Property2 != null', 'sum(person.salary) + {param_1}', 'Prop + 1']
+    raw['entity_properties'] += [_property('entity0', f'calc{i}', f) for i, f in enumerate(formulas)]
+    loader = DbDataLoader(raw)
+    assert [loader.formula_refs(f) for f in formulas] == [((), ()), ((), ('param_1',)), ((), ())]
+
+    extracted = []
+    extract = DbDataLoader._extract_formula_refs
+    monkeypatch.setattr(DbDataLoader, '_extract_formula_refs',
+                        lambda self, formula, *args: extracted.append(formula) or extract(self, formula, *args))
+
+    # 'Prop' — подстрока 'Property2', но пересчитывается только формула, где Prop — отдельное слово
+    loader.apply_delta({'parameters': [_parameter('Prop')]})
+    assert extracted == ['Prop + 1']
+    assert loader.formula_refs('Prop + 1') == ((), ('Prop',))
+    assert loader.formula_refs('Property2 != null') == ((), ())
+
+    extracted.clear()
+    loader.apply_delta({'parameters': [_parameter('Property2')], 'entity_properties': [_property('person', 'salary', None)]})
+    assert sorted(extracted) == ['Property2 != null', 'sum(person.salary) + {param_1}']
+    assert loader.formula_refs('Property2 != null') == ((), ('Property2',))
+    assert loader.formula_refs('sum(person.salary) + {param_1}') == ((('person', 'salary'),), ('param_1',))
+
+    # Удаление: живые ключи без Property2 и без person.salary
+    live = {table: [dict(row) for row in raw[table]] for table in ('parameters', 'entity_properties')}
+    live['parameters'].append(_parameter('Prop'))
+    loader.apply_delta({}, live)
+    assert [loader.formula_refs(f) for f in formulas] == [((), ()), ((), ('param_1',)), ((), ('Prop',))]
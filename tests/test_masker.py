@@ -0,0 +1,213 @@
+"""ContextMasker: расшифровка ответа (unmask_text), индекс значений (value_index), кэши mask_formula и mask_json_dumps."""
+import random
+import re
+
+import pytest
+
+from core.context_engine import DbDataLoader, OutputGenerator, WorklistResolver
+from core.masking import ContextMasker
+from tests.synth import make_namespace
+
+
+def _unmask_sequential(masker, text):
+    """Исходный unmask_text: отдельный re.sub на каждую маску, от длинных к коротким."""
+    for mask, value in sorted(masker.map_reverse.items(), key=lambda x: len(x[0]), reverse=True):
+        text = re.sub(r'\b' + re.escape(mask) + r'\b', value, text)
+    return text
+
+
+def _masker():
+    masker = ContextMasker()
+    for value, category in [('person', 'ENT'), ('salary', 'P'), ('orders', 'TBL'), ('db_orders', 'DB.TBL'),
+                            ('region', 'PARAM'), ('d_person', 'DB.DICT'), ('person_name', 'ENT_NAME')]:
+        masker.register(value, category)
+    return masker
+
+
+def test_unmask_prefixed_and_punctuated_tokens():
+    masker = _masker()
+    ent, prop = masker.map_forward[('ENT', 'person')], masker.map_forward[('P', 'salary')]
+    db_tbl, db_dict = masker.map_forward[('DB.TBL', 'db_orders')], masker.map_forward[('DB.DICT', 'd_person')]
+    assert db_tbl.startswith('DB.') and db_dict.startswith('DB.')
+    # DB.-маска, которая сама зарегистрирована, расшифровывается целиком, иначе — без префикса
+    assert db_tbl[3:] == masker.map_forward[('TBL', 'orders')]
+
+    text = (f"SELECT {ent}.{prop} FROM {db_tbl}, DB.{ent}; dictGet('{db_dict}', ({prop}))"
+            f" [{ent}] \"{ent}\" {ent}: {prop}! {ent}_{prop} X{ent} {ent}1 ENT_999 DB.ENT_999")
+    assert masker.unmask_text(text) == (
+        "SELECT person.salary FROM db_orders, DB.person; dictGet('d_person', (salary))"
+        f" [person] \"person\" person: salary! {ent}_{prop} X{ent} {ent}1 ENT_999 DB.ENT_999"
+    )
+    # Маска с подчеркиванием в категории (ENT_NAME_1) не путается с ENT_1
+    assert masker.unmask_text(masker.map_forward[('ENT_NAME', 'person_name')] + ' ' + ent) == 'person_name person'
+
+
+def test_unmask_irregular_masks():
+    # Маски, которые не похожи на сгенерированные (категория в нижнем регистре, с цифрами),
+    # re_mask_token не находит: они заменяются отдельно, по одной
+    masker = _masker()
+    lower = masker.register('secret_table', 'tbl')
+    digits = masker.register('v2', 'P2')
+    assert not masker.re_mask_token.fullmatch(lower) and not masker.re_mask_token.fullmatch(digits)
+
+    text = f"{lower}, ({digits}) {lower}x {masker.map_forward[('ENT', 'person')]}.{digits}"
+    assert masker.unmask_text(text) == "secret_table, (v2) tbl_1x person.v2"
+    assert masker.unmask_text(text) == _unmask_sequential(masker, text)
+
+    # Словарь изменился — список нестандартных масок пересчитывается
+    later = masker.register('late', 'late')
+    assert masker.unmask_text(later) == 'late'
+    masker.clear()
+    assert masker.unmask_text(text) == text
+
+
+def _corpus(masker):
+    """Маскированный контекст синтетического namespace и тексты в духе ответа модели."""
+    loader = DbDataLoader(make_namespace(n_entities=15, props_per_entity=8, n_params=30, n_tables=8,
+                                         n_vertices=60, n_edges=50, n_datasets=8, n_constraints=40, seed=3))
+    resolver = WorklistResolver(loader)
+    for i in range(8):
+        resolver.resolve_by_dataset(f'ds{i}')
+    texts = [OutputGenerator(loader, {t: set(p) for t, p in resolver.context.items()}, masker=masker,
+                             output_format=fmt).generate_sql() for fmt in OutputGenerator.OUTPUT_FORMATS]
+
+    rnd = random.Random(4)
+    masks = sorted(masker.map_reverse)
+    noise = ['ENT_0', 'P_99999', 'DB.X_1', 'TBL__1', 'A_1B', '_1', 'ENT_', 'db.TBL_1']
+    seps = [' ', '.', ', ', '(', ')', "'", '"', '\n', '`', '=', '_', '-', '']
+    for _ in range(300):
+        words = [rnd.choice(masks) if rnd.random() < .7 else rnd.choice(noise) for _ in range(rnd.randint(1, 30))]
+        texts.append(''.join(word + rnd.choice(seps) for word in words))
+    return texts
+
+
+def test_unmask_matches_sequential_replacement():
+    masker = ContextMasker()
+    corpus = _corpus(masker)
+    masker.register('irregular_value', 'misc')
+    assert len(masker.map_reverse) > 100
+    for text in corpus:
+        assert masker.unmask_text(text) == _unmask_sequential(masker, text)
+    # Маскирование и расшифровка обратимы на контексте
+    assert 'ENT_' not in masker.unmask_text(corpus[0])
+
+
+@pytest.mark.parametrize('text', ['', 'plain text without masks'])
+def test_unmask_trivial(text):
+    assert ContextMasker().unmask_text(text) == text
+    assert _masker().unmask_text(text) == text
+
+
+def _first_registration(masker):
+    """Индекс, как его строил исходный поиск литерала: первая маска значения в порядке map_forward."""
+    index = {}
+    for (_, value), mask in masker.map_forward.items():
+        index.setdefault(value, mask)
+    return index
+
+
+def test_value_index_first_registration_wins():
+    masker = ContextMasker()
+    first = masker.register('shared', 'ENT')
+    masker.register('shared', 'P')
+    masker.register('shared', 'TBL')
+    assert masker.value_index['shared'] == first
+    # Литерал в формуле получает маску первой регистрации
+    assert masker.mask_formula("x == 'shared'") == f"x == '{first}'"
+
+    rnd = random.Random(5)
+    for _ in range(500):
+        masker.register(f'v{rnd.randint(0, 60)}', rnd.choice(['ENT', 'P', 'TBL', 'PARAM', 'DB.TBL']))
+    assert masker.value_index == _first_registration(masker)
+    assert all(masker.map_reverse[mask] == value for value, mask in masker.value_index.items())
+
+
+def test_value_index_after_clear():
+    masker = ContextMasker()
+    masker.register('shared', 'ENT')
+    masker.register('other', 'P')
+    assert masker.mask_formula("'shared'") == "'ENT_1'"
+    masker.clear()
+    assert masker.value_index == {}
+    assert masker.mask_formula("'shared'") == "'shared'"
+
+    # Новое поколение: первой теперь стала другая категория
+    masker.register('shared', 'P')
+    masker.register('shared', 'ENT')
+    assert masker.value_index == _first_registration(masker) == {'shared': 'P_1'}
+    assert masker.mask_formula("'shared'") == "'P_1'"
+    # Маски и пустые значения в индекс не попадают
+    masker.register('ENT_7', 'ENT')
+    masker.register('', 'ENT')
+    assert masker.value_index == {'shared': 'P_1'}
+
+
+def _counts(masker):
+    return masker.cache_hits, masker.cache_misses
+
+
+def test_formula_cache_counters():
+    masker = ContextMasker()
+    masker.register('person', 'ENT')
+    assert masker.mask_formula("person.salary + 1") == "ENT_1.P_1 + 1"
+    assert _counts(masker) == (0, 1)
+    assert masker.mask_formula("person.salary + 1") == "ENT_1.P_1 + 1"
+    assert _counts(masker) == (1, 1)
+    assert masker.cache_stats()['formulas'] == 1
+
+    # Новая маска, которую формула не пробовала: запись остается верной и переходит на новую version
+    masker.register('unrelated', 'TBL')
+    assert masker.mask_formula("person.salary + 1") == "ENT_1.P_1 + 1"
+    assert _counts(masker) == (2, 1)
+    assert masker._formula_cache["person.salary + 1"][1] == masker.version
+
+
+def test_stale_entry_is_masked_again():
+    masker = ContextMasker()
+    assert masker.mask_formula("x == 'late'") == "x == 'late'"
+    assert masker.mask_json_dumps({'condition': "x == 'late'"}) == '{"condition": "x == \'late\'"}'
+    hits, misses = _counts(masker)
+
+    # Значение, которого не было при маскировании, появилось в словаре: старые записи не отдаются
+    mask = masker.register('late', 'P')
+    assert masker.mask_formula("x == 'late'") == f"x == '{mask}'"
+    assert masker.mask_json_dumps({'condition': "x == 'late'"}) == f'{{"condition": "x == \'{mask}\'"}}'
+    # Обе записи пересчитаны (формула внутри JSON — уже из обновленного кэша формул)
+    assert _counts(masker) == (hits + 1, misses + 2)
+    assert masker._formula_cache["x == 'late'"][1] == masker.version
+
+
+def test_set_known_parameters_invalidates():
+    masker = ContextMasker()
+    assert masker.mask_formula("if region != null") == "if region != null"
+    assert masker.mask_json_dumps({'expression': "if region != null"}) == '{"expression": "if region != null"}'
+    masker.set_known_parameters({'region'})
+    assert masker.cache_stats()['formulas'] == masker.cache_stats()['json'] == 0
+
+    hits, misses = _counts(masker)
+    assert masker.mask_formula("if region != null") == "if PARAM_1 != null"
+    assert masker.mask_json_dumps({'expression': "if region != null"}) == '{"expression": "if PARAM_1 != null"}'
+    assert _counts(masker) == (hits + 1, misses + 2)
+
+    # Те же параметры — кэш не сбрасывается
+    masker.set_known_parameters({'region'})
+    assert masker.mask_formula("if region != null") == "if PARAM_1 != null"
+    assert _counts(masker) == (hits + 2, misses + 2)
+
+
+def test_clear_invalidates():
+    masker = ContextMasker()
+    masker.register('person', 'ENT')
+    data = {'entity': 'person', 'condition': "'person'"}
+    assert masker.mask_json_dumps(data) == '{"entity": "ENT_1", "condition": "\'ENT_1\'"}'
+    assert masker.mask_formula("'person'") == "'ENT_1'"
+    masker.clear()
+    assert masker.cache_stats()['formulas'] == masker.cache_stats()['json'] == 0
+
+    # После clear() маски выдаются заново: первой регистрируется другая категория
+    masker.register('person', 'P')
+    hits, misses = _counts(masker)
+    assert masker.mask_formula("'person'") == "'P_1'"
+    assert masker.mask_json_dumps(data) == '{"entity": "ENT_1", "condition": "\'P_1\'"}'
+    assert masker.map_forward[('ENT', 'person')] == 'ENT_1'
+    assert _counts(masker) == (hits + 1, misses + 2)
@@ -0,0 +1,76 @@
+"""
+Время разбора патологических формул (ContextMasker.mask_formula, DbDataLoader._extract_formula_refs)
+и бюджет разбора formula_over_budget.
+"""
+import time
+
+import pytest
+
+from core.context_engine import DbDataLoader
+from core.masking import ContextMasker, formula_over_budget
+from tests.synth import make_namespace
+
+# Патологические формулы: вызовы без закрывающей скобки/кавычки, непарные кавычки, длинные цепочки.
+# Прежний разбор просматривал остаток формулы на каждый такой вызов (время ~ длина x вызовы).
+# Для каждой: (построение по длине, значения, которых не должно остаться в результате)
+PATHOLOGICAL = {
+    'dictGet tuple unclosed': (lambda n: "dictGet('d', tuple(" * (n // 19), ["'d'"]),
+    'dictGet single unclosed': (lambda n: "dictGet('d" * (n // 10), []),
+    'tupleElement unclosed': (lambda n: "tupleElement(x, 'a" * (n // 18), []),
+    'quotes odd': (lambda n: "'" + "a''" * (n // 3), []),
+    'dots': (lambda n: 'a.' * (n // 2), []),
+    'braces': (lambda n: '{a' * (n // 2), []),
+    'long word': (lambda n: 'a' * n, []),
+    'mixed unclosed': (lambda n: "dictGet('d', tuple(x.y, 'c' tupleElement(t, 'x {p} " * (n // 50), ['{p}']),
+    'mixed closed': (lambda n: "dictGet('db.d_x', tuple(x.y, 'c')) + tupleElement(t, 'x') + {p} " * (n // 60),
+                     ["'db.d_x'", "'c'", "'x'", '{p}']),
+    # Без dictGet/tupleElement: глубокая вложенность скобок и вложенные цепочки if(..., if(...))
+    'parens nested': (lambda n: '(' * (n // 4) + "x.y + {p}" + ')' * (n // 4), ['{p}']),
+    'if chain nested': (lambda n: "if(x.y, {p}, " * (n // 24) + "'z'" + ')' * (n // 24), ['{p}']),
+    'if chain unclosed': (lambda n: "if(a, {p}, f(" * (n // 13), ['{p}']),
+}
+
+# Предел времени на формулу (с запасом на медленную машину): до FORMULA_MAX_CHARS,
+# сверх FORMULA_SCAN_BUDGET и сверх FORMULA_MAX_CHARS
+TIME_LIMITS = {8000: 0.5, 40000: 1.5, 200000: 3.0}
+
+
+@pytest.fixture(scope='module')
+def loader():
+    return DbDataLoader(make_namespace(n_entities=5, props_per_entity=3, n_params=5, n_tables=2, n_vertices=5,
+                                       n_edges=5, n_datasets=2, n_constraints=5, seed=1))
+
+
+@pytest.mark.parametrize('size', sorted(TIME_LIMITS))
+@pytest.mark.parametrize('name', sorted(PATHOLOGICAL))
+def test_pathological_formula_time(loader, name, size):
+    build, secrets = PATHOLOGICAL[name]
+    text = build(size)
+    masker = ContextMasker()
+    masker.cache_size = 0
+    masker.set_known_parameters({'a', 'p'})
+
+    started = time.perf_counter()
+    masked = masker.mask_formula(text, row=('test', name))
+    elapsed = time.perf_counter() - started
+    assert elapsed < TIME_LIMITS[size], f'{name}: {elapsed:.2f}s'
+
+    started = time.perf_counter()
+    loader._extract_formula_refs(text)
+    elapsed = time.perf_counter() - started
+    assert elapsed < TIME_LIMITS[size], f'{name} refs: {elapsed:.2f}s'
+
+    # Значения не остаются открытым текстом, каким бы путем ни шел разбор
+    for secret in secrets:
+        assert secret not in masked
+
+
+def test_nesting_counts_toward_budget():
+    # Та же длина и то же число вызовов: плоская цепочка укладывается в бюджет, вложенная — нет
+    flat = "if(x.y, {p}, 'z') + " * 400
+    nested = "if(x.y, {p}, " * 400 + "'z'" + ')' * 400
+    assert not formula_over_budget(flat)
+    assert formula_over_budget(nested)
+    assert formula_over_budget('(' * 2000 + 'x' + ')' * 2000)
+    # Скобки внутри литерала тоже считаются: оценка сверху, а не разбор
+    assert not formula_over_budget("concat('(((', x.y)")
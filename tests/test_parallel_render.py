@@ -0,0 +1,83 @@
+"""Параллельная генерация SQL (SQL_RENDER_WORKERS > 1) совпадает с последовательной generate_sql()."""
+import pytest
+
+import core.context_engine as engine
+from core.columnar import is_arrow_available
+from core.context_engine import DbDataLoader, OutputGenerator, WorklistResolver
+from core.masking import ContextMasker
+from core.row_cache import RowFragmentCache
+from tests.synth import make_namespace
+
+STORAGES = ['dict'] + (['arrow'] if is_arrow_available() else [])
+
+
+@pytest.fixture(scope='module', params=STORAGES)
+def loader(request):
+    raw = make_namespace(n_entities=30, props_per_entity=10, n_params=40, n_tables=10, n_vertices=120,
+                         n_edges=60, n_datasets=10, n_constraints=60, seed=11)
+    return DbDataLoader(raw, storage=request.param)
+
+
+def _context(loader, datasets):
+    resolver = WorklistResolver(loader)
+    for ds in datasets:
+        resolver.resolve_by_dataset(ds)
+    return {table: set(pks) for table, pks in resolver.context.items()}
+
+
+def _generator(loader, context, masked, workers, row_cache=None, output_format='sql'):
+    generator = OutputGenerator(loader, {t: set(p) for t, p in context.items()},
+                                masker=ContextMasker() if masked else None, workers=workers,
+                                output_format=output_format)
+    generator.row_cache = row_cache
+    # Мелкие части, чтобы форматирование действительно шло в пуле
+    generator.RENDER_CHUNK_ROWS = 40
+    return generator
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+@pytest.mark.parametrize('masked', [True, False])
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_parallel_matches_serial(loader, monkeypatch, executor, masked, use_cache):
+    monkeypatch.setattr(engine, 'SQL_RENDER_EXECUTOR', executor)
+    context = _context(loader, [f'ds{i}' for i in range(10)])
+    serial = _generator(loader, context, masked, workers=1)
+    expected = serial.generate_sql()
+    expected_again = serial.generate_sql()
+
+    parallel = _generator(loader, context, masked, workers=3, row_cache=RowFragmentCache() if use_cache else None)
+    assert parallel.generate_sql() == expected
+    assert parallel.generate_sql() == expected_again
+    if masked:
+        assert parallel.masker.map_forward == serial.masker.map_forward
+
+    # Инкрементальная генерация после параллельной полной
+    table = 'entity_properties'
+    parallel.context[table].discard(sorted(parallel.context[table])[0])
+    incremental = parallel.generate_sql([table])
+    assert incremental == OutputGenerator(loader, {t: set(p) for t, p in parallel.context.items()},
+                                          masker=parallel.masker, workers=1).generate_sql()
+
+
+@pytest.mark.parametrize('output_format', OutputGenerator.OUTPUT_FORMATS)
+def test_parallel_matches_serial_in_every_format(loader, monkeypatch, output_format):
+    monkeypatch.setattr(engine, 'SQL_RENDER_EXECUTOR', 'thread')
+    context = _context(loader, ['ds1', 'ds5', 'ds7'])
+    expected = _generator(loader, context, True, workers=1, output_format=output_format).generate_sql()
+    assert _generator(loader, context, True, workers=4, output_format=output_format).generate_sql() == expected
+
+
+def test_render_pools_shut_down(loader, monkeypatch):
+    monkeypatch.setattr(engine, 'SQL_RENDER_EXECUTOR', 'thread')
+    context = _context(loader, ['ds0', 'ds2'])
+    expected = _generator(loader, context, True, workers=1).generate_sql()
+    assert _generator(loader, context, True, workers=2).generate_sql() == expected
+    pool = engine._RENDER_POOLS[('thread', 2)]
+
+    engine._shutdown_render_pools()
+    assert not engine._RENDER_POOLS
+    with pytest.raises(RuntimeError):
+        pool.submit(len, '')
+    # Следующая генерация создает пул заново
+    assert _generator(loader, context, True, workers=2).generate_sql() == expected
+    engine._shutdown_render_pools()
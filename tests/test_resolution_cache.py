@@ -0,0 +1,107 @@
+"""
+Кэш подобранных контекстов (ResolutionCache, Resolution): попадания и промахи, LRU выборок
+на загрузчик, исчезновение выборок вместе с загрузчиком и условия хранения маскированного SQL.
+"""
+import gc
+
+from config.settings import RESOLUTION_CACHE_SIZE
+from core.context_engine import DbDataLoader
+from core.masking import ContextMasker
+from services.resolution_cache import Resolution, ResolutionCache
+
+
+class _Resolver:
+    """resolve() для get_or_resolve: считает вызовы и выдает новый Resolution на каждый."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return Resolution({'datasets': {('1', '', f'ds{self.calls}')}})
+
+
+def test_hit_and_miss():
+    cache, loader, resolve = ResolutionCache(), DbDataLoader({}), _Resolver()
+    first = cache.get_or_resolve(loader, ['ds1', 'ds2'], ['e1'], resolve)
+    # Порядок и повторы в выборке не важны
+    assert cache.get_or_resolve(loader, ['ds2', 'ds1', 'ds1'], ['e1'], resolve) is first
+    assert resolve.calls == 1
+
+    # Другой вариант подбора и другая выборка — промахи
+    budgeted = cache.get_or_resolve(loader, ['ds1', 'ds2'], ['e1'], resolve, variant=('budget', 100, 'sql'))
+    other = cache.get_or_resolve(loader, ['ds1'], ['e1'], resolve)
+    assert len({id(first), id(budgeted), id(other)}) == 3
+    assert resolve.calls == 3
+    assert cache.stats() == {'loaders': 1, 'selections': 3, 'hits': 1, 'misses': 3}
+
+    # Выборки разных загрузчиков не смешиваются
+    assert cache.get_or_resolve(DbDataLoader({}), ['ds1', 'ds2'], ['e1'], resolve) is not first
+    assert resolve.calls == 4
+
+
+def test_lru_per_loader():
+    cache, resolve = ResolutionCache(), _Resolver()
+    assert cache.max_selections == RESOLUTION_CACHE_SIZE
+    loader, other_loader = DbDataLoader({}), DbDataLoader({})
+    first = [cache.get_or_resolve(loader, [f'ds{i}'], [], resolve) for i in range(RESOLUTION_CACHE_SIZE)]
+    kept = cache.get_or_resolve(other_loader, ['ds0'], [], resolve)
+
+    # Обращение к ds0 делает её самой свежей: при переполнении вытесняется ds1
+    assert cache.get_or_resolve(loader, ['ds0'], [], resolve) is first[0]
+    cache.get_or_resolve(loader, ['new'], [], resolve)
+    assert cache.stats()['selections'] == RESOLUTION_CACHE_SIZE + 1
+    calls = resolve.calls
+    assert cache.get_or_resolve(loader, ['ds0'], [], resolve) is first[0]
+    assert cache.get_or_resolve(loader, [f'ds{RESOLUTION_CACHE_SIZE - 1}'], [], resolve) is first[-1]
+    assert resolve.calls == calls
+    assert cache.get_or_resolve(loader, ['ds1'], [], resolve) is not first[1]
+    assert resolve.calls == calls + 1
+
+    # LRU у каждого загрузчика свой
+    assert cache.get_or_resolve(other_loader, ['ds0'], [], resolve) is kept
+
+
+def test_selections_disappear_with_loader():
+    cache, resolve = ResolutionCache(), _Resolver()
+    loader, other_loader = DbDataLoader({}), DbDataLoader({})
+    cache.get_or_resolve(loader, ['ds1'], [], resolve)
+    cache.get_or_resolve(loader, ['ds2'], [], resolve)
+    cache.get_or_resolve(other_loader, ['ds1'], [], resolve)
+    assert cache.stats()['loaders'] == 2
+
+    del loader
+    gc.collect()
+    assert cache.stats()['loaders'] == 1
+    assert cache.stats()['selections'] == 1
+
+
+def test_masked_sql_stored_only_for_unchanged_masker():
+    resolution, masker = Resolution({}), ContextMasker()
+    version = masker.version
+    resolution.remember_masked_sql(masker, 'sql', 'masked sql', version)
+    assert resolution.masked_sql(masker, 'sql') == 'masked sql'
+    assert resolution.masked_sql(masker, 'csv') is None
+    assert resolution.masked_sql(ContextMasker(), 'sql') is None
+
+    # Генерация добавила маску: SQL не сохраняется, прежний вариант формата забывается
+    version = masker.version
+    masker.register('order', 'ENT')
+    resolution.remember_masked_sql(masker, 'sql', 'masked sql v2', version)
+    assert resolution.masked_sql(masker, 'sql') is None
+    resolution.remember_masked_sql(masker, 'csv', 'masked csv', masker.version)
+    assert resolution.masked_sql(masker, 'csv') == 'masked csv'
+
+    # Маскер изменился после сохранения: сохраненный SQL больше не выдается
+    masker.register('person', 'ENT')
+    assert resolution.masked_sql(masker, 'csv') is None
+
+    # Оригинальный SQL от маскера не зависит
+    resolution.remember_original_sql('sql', 'original sql')
+    assert resolution.original_sql('sql') == 'original sql'
+    assert resolution.original_sql('csv') is None
+
+    # Записи маскера исчезают вместе с ним
+    del masker
+    gc.collect()
+    assert len(resolution._masked) == 0
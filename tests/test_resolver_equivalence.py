@@ -0,0 +1,94 @@
+"""
+Эквивалентность подбора контекста: рекурсивный ContextResolver, WorklistResolver,
+ClosureIndex и инкрементальный режим (sync) дают те же контексты, что исходный
+рекурсивный обход (эталон tests/data/resolver_golden.json, см. tests/resolver_cases.py).
+"""
+import json
+
+import pytest
+
+from core.context_engine import ClosureIndex, ContextResolver, DbDataLoader, WorklistResolver
+from tests.resolver_cases import GOLDEN_PATH, context_digest, make_raw, resolve, selection_key, selections
+
+GOLDEN = json.loads(GOLDEN_PATH.read_text(encoding='utf-8'))
+SELECTIONS = selections()
+
+
+@pytest.fixture(scope='module', params=[('dict', True), ('dict', False), ('arrow', True)],
+                ids=['dict', 'dict-parsed-json', 'arrow'])
+def loader(request):
+    storage, json_as_str = request.param
+    if storage == 'arrow':
+        pytest.importorskip('pyarrow')
+    return DbDataLoader(make_raw(json_as_str=json_as_str), storage=storage)
+
+
+def test_golden_covers_selections():
+    assert set(GOLDEN) == {selection_key(ds, ents) for ds, ents in SELECTIONS}
+
+
+@pytest.mark.parametrize('resolver_cls', [ContextResolver, WorklistResolver])
+def test_resolvers_match_baseline(loader, resolver_cls):
+    for datasets, entities in SELECTIONS:
+        context, found = resolve(resolver_cls, loader, datasets, entities)
+        expected = GOLDEN[selection_key(datasets, entities)]
+        assert found == expected['found'], (datasets, entities)
+        assert context_digest(context) == expected['context'], (datasets, entities)
+
+
+def test_closure_index_matches_baseline(loader):
+    closures = ClosureIndex(loader)
+    closures.build()
+    for datasets, entities in SELECTIONS:
+        context = closures.resolve(datasets, entities)
+        assert context_digest(context) == GOLDEN[selection_key(datasets, entities)]['context'], (datasets, entities)
+
+
+@pytest.mark.parametrize('resolver_cls', [ContextResolver, WorklistResolver])
+def test_incremental_sync_matches_baseline(loader, resolver_cls):
+    # Одна и та же инкрементальная выборка проходит все сценарии подряд:
+    # корни добавляются и убираются, а контекст должен совпадать с полным подбором
+    resolver = resolver_cls(loader)
+    for datasets, entities in SELECTIONS:
+        resolver.sync(datasets, entities)
+        assert context_digest(resolver.context) == GOLDEN[selection_key(datasets, entities)]['context'], \
+            (datasets, entities)
+
+
+def test_worklist_deep_chain():
+    # Цепочка Dataset -> Dataset глубже лимита рекурсии Python
+    depth = 20000
+    raw = make_raw()
+    for i in range(depth):
+        config = {'dataset': f'chain{i + 1}'} if i + 1 < depth else {}
+        raw['datasets'].append({'namespace_id': 1, 'tenant_id': '', 'dataset_id': f'chain{i}', 'entity_type': 'x',
+                                'edges': [], 'config': json.dumps(config)})
+    loader = DbDataLoader(raw)
+    context, found = resolve(WorklistResolver, loader, ['chain0'], [])
+    assert found == [True]
+    assert {pk[2] for pk in context['datasets']} == {f'chain{i}' for i in range(depth)}
+
+
+def test_arrow_resolver_reads_cells_without_rows(monkeypatch):
+    # Резолвер читает только нужные колонки через смещение PK, строки целиком не собираются
+    pytest.importorskip('pyarrow')
+    from core.columnar import ENC_JSON, ColumnarTable
+
+    raw = make_raw(json_as_str=False)
+    loader = DbDataLoader(raw, storage='arrow')
+    plain = DbDataLoader(raw)
+    with monkeypatch.context() as patch:
+        patch.setattr(ColumnarTable, 'row_at', lambda self, offset: pytest.fail('row_at в резолвере'))
+        for datasets, entities in SELECTIONS:
+            context, found = resolve(WorklistResolver, loader, datasets, entities)
+            expected_context, expected_found = resolve(WorklistResolver, plain, datasets, entities)
+            assert found == expected_found, (datasets, entities)
+            assert context_digest(context) == context_digest(expected_context), (datasets, entities)
+
+    # Ячейка JSON разбирается один раз и совпадает с исходным значением
+    table = loader.db['datasets']
+    assert table.encodings['config'] == ENC_JSON
+    pk = next(iter(table))
+    offset = table.offsets[pk]
+    assert table.value_at('config', offset) is table.value_at('config', offset)
+    assert table[pk]['config'] == plain.db['datasets'][pk]['config']
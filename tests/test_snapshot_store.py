@@ -0,0 +1,94 @@
+"""Тесты SnapshotStore: ротация снимков, точное совпадение namespace, проверка целостности."""
+import os
+
+import pytest
+
+from core.context_engine import DbDataLoader
+from config.settings import SNAPSHOT_KEEP
+from services.snapshot_store import SnapshotStore
+from tests.synth import make_namespace
+
+
+@pytest.fixture(scope='module')
+def loader():
+    return DbDataLoader(make_namespace(n_entities=5, props_per_entity=3, n_vertices=10, n_edges=10,
+                                       n_datasets=3, n_constraints=10, seed=3))
+
+
+def _age(path, seconds):
+    stat = path.stat()
+    os.utime(path, (stat.st_atime - seconds, stat.st_mtime - seconds))
+
+
+def test_roundtrip(tmp_path, loader):
+    store = SnapshotStore(tmp_path)
+    store.save(loader, '1', 'a' * 64)
+    restored = store.load('1', 'a' * 64)
+    assert restored is not None
+    assert restored.db.keys() == loader.db.keys()
+    assert all(len(restored.db[t]) == len(loader.db[t]) for t in loader.db)
+
+
+def test_save_keeps_latest_n(tmp_path, loader):
+    store = SnapshotStore(tmp_path)
+    paths = []
+    for i in range(5):
+        for old in paths:
+            if old.exists():
+                _age(old, 10)
+        paths.append(store.save(loader, '1', f'{i:x}' * 64))
+    left = sorted(p.name for p in tmp_path.iterdir())
+    assert left == sorted(p.name for p in paths[-SNAPSHOT_KEEP:])
+    store.prune('1', loader.storage, keep=1)
+    assert [p.name for p in tmp_path.iterdir()] == [paths[-1].name]
+    assert store.latest_path('1') == paths[-1]
+
+
+def test_prune_does_not_touch_other_namespaces(tmp_path, loader):
+    store = SnapshotStore(tmp_path)
+    other = store.save(loader, '1-a', 'b' * 64)
+    _age(other, 10)
+    for i in range(3):
+        store.prune('1', loader.storage, keep=1, keep_path=store.save(loader, '1', f'{i}' * 64))
+    assert other.exists()
+    assert len(store._snapshot_paths('1', loader.storage)) == 1
+
+
+def test_namespace_matched_exactly(tmp_path, loader):
+    store = SnapshotStore(tmp_path)
+    store.save(loader, '1-a', 'b' * 64)
+    store.save(loader, '12', 'c' * 64)
+    assert store.latest_path('1') is None
+    assert store.load('1') is None
+    assert store.latest_path('1-a').name.startswith('1-a-')
+    # Спецсимволы glob в id не расширяются
+    assert store.latest_path('1*') is None
+    assert store.latest_path('1?a') is None
+
+
+def test_foreign_header_rejected(tmp_path, loader):
+    store = SnapshotStore(tmp_path)
+    path = store.save(loader, '7', 'd' * 64)
+    # Файл переименован так, будто он принадлежит другому namespace
+    os.replace(path, tmp_path / path.name.replace('7-', '8-', 1))
+    assert store.load('8') is None
+
+
+@pytest.mark.parametrize('damage', ['flip', 'truncate'])
+def test_corrupted_snapshot_not_unpickled(tmp_path, loader, monkeypatch, damage):
+    store = SnapshotStore(tmp_path)
+    path = store.save(loader, '1', 'e' * 64)
+    data = bytearray(path.read_bytes())
+    if damage == 'flip':
+        data[-1] ^= 0xFF
+    else:
+        data = data[:len(data) // 2]
+    path.write_bytes(bytes(data))
+
+    import services.snapshot_store as snapshot_store
+
+    def fail(*args, **kwargs):
+        raise AssertionError('pickle.loads вызван для поврежденного снимка')
+
+    monkeypatch.setattr(snapshot_store.pickle, 'loads', fail)
+    assert store.load('1', 'e' * 64) is None
@@ -0,0 +1,113 @@
+"""
+Маскирование текста: префиксное дерево (_trie_regex) и mask_text против прежнего
+перечисления слов через '|' и исходной последовательной замены по одному значению.
+"""
+import random
+import re
+
+import pytest
+
+from core.masking import ContextMasker, _trie_regex
+
+SKIPPED_VALUES = ('null', 'true', 'false')
+
+
+def _alternation(words):
+    """Прежний regex: экранированные слова от длинных к коротким через '|'."""
+    return '(?:' + '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True)) + ')'
+
+
+def _matches(pattern, text):
+    return [(m.start(), m.group(0)) for m in re.finditer(r'\b' + pattern + r'\b', text)]
+
+
+def _random_words(rnd, alphabet, count, max_len):
+    words = {''.join(rnd.choice(alphabet) for _ in range(rnd.randint(1, max_len))) for _ in range(count)}
+    return sorted(words)
+
+
+def _random_text(rnd, words, alphabet, size):
+    parts = [rnd.choice(words) if rnd.random() < .6 else ''.join(rnd.choice(alphabet) for _ in range(3))
+             for _ in range(size)]
+    return ''.join(p + rnd.choice(['', ' ', '.', ', ', '\n']) for p in parts)
+
+
+WORD_SETS = {
+    # Много общих префиксов: слова из символов a, b, _
+    'prefixes': ('ab_', 300, 6),
+    # Спецсимволы regex, пробелы, точки, кириллица
+    'metachars': ('a.^$*+?{}[]\\|() я', 200, 5),
+    'dots_spaces': ('ab. ', 150, 7),
+    'identifiers': ('abcdefgh_0123456789', 500, 9),
+}
+
+
+@pytest.mark.parametrize('kind', sorted(WORD_SETS))
+@pytest.mark.parametrize('seed', [1, 2])
+def test_trie_matches_alternation(kind, seed):
+    alphabet, count, max_len = WORD_SETS[kind]
+    rnd = random.Random(seed)
+    words = _random_words(rnd, alphabet, count, max_len)
+    trie = _trie_regex(words)
+    alternation = _alternation(words)
+    for _ in range(20):
+        text = _random_text(rnd, words, alphabet, 200)
+        assert _matches(trie, text) == _matches(alternation, text)
+    # Дерево совпадает ровно со словами из набора
+    for candidate in words + _random_words(rnd, alphabet, 300, max_len + 1):
+        assert bool(re.fullmatch(trie, candidate)) == (candidate in words), candidate
+
+
+def test_trie_nested_prefixes():
+    # Каждое слово — префикс следующего; откат из-за \b должен выбрать самое длинное подходящее
+    words = ['a' * k for k in range(1, 80)] + ['a b', 'a.b', 'a' * 10 + '.']
+    trie = _trie_regex(words)
+    for text in ['a' * n for n in (1, 50, 79, 80, 200)] + ['a b a.b aaa', 'aaaaaaaaaa. a', 'ba a_ a']:
+        assert _matches(trie, text) == _matches(_alternation(words), text), text
+
+
+def _mask_text_alternation(masker, text):
+    """mask_text одним проходом по прежнему regex (тот же выбор маски для значения)."""
+    lookup = {}
+    for (_, value), mask in sorted(masker.map_forward.items(), key=lambda x: len(x[0][1]), reverse=True):
+        if value.lower() not in SKIPPED_VALUES:
+            lookup.setdefault(value, mask)
+    return re.sub(r'\b' + _alternation(lookup) + r'\b', lambda m: lookup[m.group(0)], text)
+
+
+def _mask_text_sequential(masker, text):
+    """Исходный mask_text: отдельный re.sub на каждое значение, от длинных к коротким."""
+    for (_, value), mask in sorted(masker.map_forward.items(), key=lambda x: len(x[0][1]), reverse=True):
+        if value.lower() not in SKIPPED_VALUES:
+            text = re.sub(r'\b' + re.escape(value) + r'\b', mask, text)
+    return text
+
+
+@pytest.mark.parametrize('kind', sorted(WORD_SETS))
+def test_mask_text_matches_alternation(kind):
+    alphabet, count, max_len = WORD_SETS[kind]
+    rnd = random.Random(5)
+    words = _random_words(rnd, alphabet, count, max_len)
+    masker = ContextMasker()
+    for word in words + ['null', 'True']:
+        masker.register(word, rnd.choice(['ENT', 'P', 'TBL', 'PARAM', 'VAL']))
+    # Одно значение в нескольких категориях
+    masker.register(words[0], 'COL')
+    for _ in range(20):
+        text = _random_text(rnd, words + ['null', 'True'], alphabet, 200)
+        assert masker.mask_text(text) == _mask_text_alternation(masker, text)
+
+    # Словарь вырос — regex перестраивается
+    masker.register('zz_new', 'ENT')
+    assert masker.mask_text('zz_new') == masker.map_forward[('ENT', 'zz_new')]
+
+
+def test_mask_text_matches_sequential_replacement():
+    rnd = random.Random(1)
+    words = _random_words(rnd, 'abcdefgh_', 400, 9)
+    masker = ContextMasker()
+    for word in words:
+        masker.register(word, rnd.choice(['ENT', 'DB.TBL', 'P', 'PARAM', 'VAL']))
+    for _ in range(10):
+        text = _random_text(rnd, words, 'abcdefgh_', 150)
+        assert masker.mask_text(text) == _mask_text_sequential(masker, text)
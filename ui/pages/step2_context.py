@@ -1,18 +1,21 @@
 import streamlit as st
-from typing import Optional, Dict, Any
+from typing import TYPE_CHECKING, Optional, Dict, Any
 
 from ui.components import (
     render_step_toggle_button,
     render_token_counter
 )
-from core.context_engine import DbDataLoader
 from core.masking import ContextMasker
 from services.database import DatabaseManager
 from services.context_service import ContextService
-from config.settings import TEXTAREA_HEIGHTS, MAX_TOKENS
+from config.settings import TEXTAREA_HEIGHTS, MAX_TOKENS, LOADER_STORAGE
 from utils.logger import setup_logger
 from utils.helpers import copy_to_clipboard
 
+if TYPE_CHECKING:
+    # Только для аннотаций: страница не обращается к DbDataLoader во время выполнения
+    from core.context_engine import DbDataLoader
+
 # Настройка логгера
 logger = setup_logger(__name__)
 
@@ -116,9 +119,18 @@ def _render_data_loading_section() -> None:
             if ns_id:
                 with st.spinner(f"Загрузка схемы для {ns_id}..."):
                     try:
-                        raw_data = db_manager.fetch_namespace_context(ns_id)
+                        # Загрузчик общий для всех сессий процесса (LoaderCache); сессия держит аренду.
+                        # Для того же namespace новая версия строится дельтой от текущей.
+                        current_lease = st.session_state.get("loader_lease")
+                        lease, source = ContextService.acquire_namespace(
+                            db_manager, ns_id, storage=LOADER_STORAGE, current=current_lease
+                        )
+                        if current_lease is not None and current_lease is not lease:
+                            current_lease.release()
+                        loader = lease.loader
                         
-                        st.session_state["loader"] = DbDataLoader(raw_data)
+                        st.session_state["loader_lease"] = lease
+                        st.session_state["loader"] = loader
                         st.session_state["current_ns_loaded"] = ns_id
                         
                         # Сброс выбранных датасетов/сущностей
@@ -127,9 +139,20 @@ def _render_data_loading_section() -> None:
                         # Явно обнуляем ключи виджетов, чтобы очистить выбор визуально
                         st.session_state["selected_datasets"] = []
                         st.session_state["selected_entities"] = []
+                        # Инкрементальный подбор привязан к прежнему загрузчику
+                        st.session_state.pop("context_builder", None)
                         
-                        logger.info(f"Контекст загружен для namespace {ns_id}")
-                        st.toast(f"Данные загружены: {sum(len(v) for v in raw_data.values())} записей", icon="✅")
+                        total_records = sum(len(v) for v in loader.db.values())
+                        logger.info(f"Контекст загружен для namespace {ns_id} (источник: {source})")
+                        if source == 'snapshot_offline':
+                            st.warning("⚠️ БД недоступна: загружен последний сохраненный снимок namespace.")
+                        source_label = {
+                            'database': "из БД",
+                            'delta': "(применены изменения из БД)",
+                            'unchanged': "(изменений в БД нет)",
+                            'cache': "из общего кэша",
+                        }.get(source, "из снимка")
+                        st.toast(f"Данные загружены {source_label}: {total_records} записей", icon="✅")
                         
                     except Exception as e:
                         logger.error(f"Ошибка загрузки контекста: {e}", exc_info=True)
@@ -141,7 +164,7 @@ def _render_data_loading_section() -> None:
 
 def _render_context_selection_section() -> None:
     """Рендерит мультиселекты для выбора Datasets и Entities."""
-    loader: DbDataLoader = st.session_state["loader"]
+    loader: "DbDataLoader" = st.session_state["loader"]
     
     all_ds_ids = sorted(list(set(k[2] for k in loader.db['datasets'].keys())))
     all_ent_ids = sorted(list(set(k[2] for k in loader.db['entities'].keys())))
@@ -192,10 +215,28 @@ def _render_context_selection_section() -> None:
         ):
             _handle_context_pickup()
 
+    st.checkbox(
+        f"✂️ Уложить контекст в лимит {MAX_TOKENS} токенов",
+        key="fit_token_budget",
+        help="Зависимости добавляются по близости к выбранным датасетам/сущностям, пока промпт помещается в лимит"
+    )
+    _render_budget_report(st.session_state.get("budget_report"))
+
+
+def _render_budget_report(report: Optional[Dict[str, Any]]) -> None:
+    """Показывает, что не поместилось в лимит токенов при подборе с бюджетом."""
+    if not report or not report.get("truncated"):
+        return
+    omitted = ", ".join(f"{table}: {count}" for table, count in sorted(report["omitted"].items()))
+    st.warning(
+        f"Контекст урезан до ~{report['used_tokens']} из {report['max_tokens']} токенов. "
+        f"Не вошли (вместе с их зависимостями): {omitted}"
+    )
+
 
 def _handle_context_pickup() -> None:
     """Обработчик логики подбора контекста."""
-    loader: Optional[DbDataLoader] = st.session_state.get("loader")
+    loader: Optional["DbDataLoader"] = st.session_state.get("loader")
     masker: Optional[ContextMasker] = st.session_state.get("masker")
     
     if loader is None or masker is None:
@@ -211,9 +252,18 @@ def _handle_context_pickup() -> None:
     
     with st.spinner("Анализ графа и построение масок..."):
         try:
-            sql_masked, mask_map = ContextService.pick_context(
-                loader, masker, datasets, entities
+            token_budget = None
+            if st.session_state.get("fit_token_budget"):
+                token_budget = ContextService.context_token_budget(
+                    st.session_state.get('system_prompt', ''), st.session_state.get('user_query', '')
+                )
+            # Повторный подбор после изменения выборки (и с бюджетом, и без) обновляет контекст инкрементально
+            builder, sql_masked, mask_map = ContextService.update_context(
+                st.session_state.get("context_builder"), loader, masker, datasets, entities,
+                token_budget=token_budget
             )
+            st.session_state.context_builder = builder
+            st.session_state.budget_report = builder.report
             
             st.session_state.context_sql_masked = sql_masked
             st.session_state.masking_dictionary = mask_map
@@ -330,7 +380,7 @@ def _render_masking_dictionary(mask_map: Dict[Any, Any]) -> None:
 
 def _handle_generate_combined() -> None:
     """Обработчик полной генерации промпта."""
-    loader: Optional[DbDataLoader] = st.session_state.get("loader")
+    loader: Optional["DbDataLoader"] = st.session_state.get("loader")
     if loader is None:
         st.error("Данные не загружены.")
         return
@@ -346,7 +396,8 @@ def _handle_generate_combined() -> None:
     with st.spinner("Генерация промпта и маскирование..."):
         try:
             result = ContextService.generate_final_prompts(
-                loader, masker, ns_id, datasets, entities, system_prompt, user_query
+                loader, masker, ns_id, datasets, entities, system_prompt, user_query,
+                max_tokens=MAX_TOKENS if st.session_state.get("fit_token_budget") else None
             )
             
             st.session_state.final_prompt_masked = result["final_prompt_masked"]
@@ -355,6 +406,7 @@ def _handle_generate_combined() -> None:
             st.session_state.token_count = result["token_count"]
             st.session_state.masking_dictionary = result["masking_dict"]
             st.session_state.enable_masking = len(result["masking_dict"]) > 0
+            st.session_state.budget_report = result["budget_report"]
             
             logger.info(f"Промпт сгенерирован. Токенов: {result['token_count']}")
             st.toast("✅ Промпт успешно сгенерирован!")
@@ -46,6 +46,8 @@ def init_session_state() -> None:
         'show_step2': False,      # Развернут ли Шаг 2
         'show_step3': False,      # Развернут ли Шаг 3
         'enable_masking': True,   # Включено ли маскирование (по умолчанию да)
+        'fit_token_budget': False, # Урезать контекст, чтобы промпт уложился в MAX_TOKENS
+        'budget_report': None,    # Отчет о пропущенных строках при подборе с бюджетом
         
         # --- Персистентность выбора (Multiselect) ---
         'stored_datasets': [],    # Сохраненный выбор датасетов
@@ -25,6 +25,8 @@ class TokenCounter:
     # Используем тип Any, так как класс Tokenizer может не существовать,
     # если библиотека не установлена. Это предотвращает ошибку Pylance.
     _tokenizer: Any = None
+    # Загрузка уже не удалась (нет библиотеки или файла): повторно не пробуем и не пишем в лог
+    _unavailable: bool = False
     
     # Путь к файлу tokenizer.json. 
     # parent.parent поднимает нас из utils/ в корень проекта.
@@ -34,15 +36,17 @@ class TokenCounter:
     def get_tokenizer(cls) -> Any:
         """
         Ленивая загрузка токенизатора (Singleton).
-        Загружает файл только при первом обращении.
+        Загружает файл только при первом обращении; неудачная попытка тоже запоминается,
+        поэтому предупреждение пишется в лог один раз, а не на каждый подсчет.
         
         Returns:
             Any: Объект Tokenizer или None, если загрузка не удалась.
         """
-        if cls._tokenizer is None:
+        if cls._tokenizer is None and not cls._unavailable:
             # 1. Проверяем, установлена ли библиотека
             if Tokenizer is None:
                 logger.warning("Библиотека `tokenizers` не установлена. Используется упрощенный подсчет.")
+                cls._unavailable = True
                 return None
                 
             # 2. Пробуем загрузить файл
@@ -53,8 +57,10 @@ class TokenCounter:
                 else:
                     logger.warning(f"⚠️ Файл токенизатора не найден: {cls._tokenizer_path}")
                     # Не выбрасываем исключение, чтобы приложение продолжило работать
+                    cls._unavailable = True
             except Exception as e:
                 logger.error(f"❌ Ошибка инициализации токенизатора: {e}")
+                cls._unavailable = True
                 
         return cls._tokenizer
     